@@ -3,6 +3,30 @@
 """
 Script used to compile and deploy a tagged configuration on a deployment server.
 This script is intended to be called by SVN post-commit hook script.
+
+With --queue, the tag is only added to a deployment queue and a worker (--worker)
+is started in the background if none is running. The worker deploys queued tags
+until the queue is empty: when several tags have been queued during a deployment,
+only the most recent one is deployed. The worker never deploys a tag older than the
+last tag deployed: an older tag can only be deployed (rollback) by running this
+script directly. Errors of the worker are emailed (see notif_xxx options), a detached
+instance of this script (--send-notifications) sending them as a digest.
+
+With compile_server_client, ant is run in the long-lived JVM of a Nailgun server
+(compile server) instead of a new JVM, falling back to a new JVM if the server
+cannot be used.
+
+With shard_workers, each cluster is compiled by a separate ant process, shard_workers
+of them running concurrently. The compiled profiles are deployed and clients notified
+only if all the clusters compiled successfully.
+
+With publish, compiled profiles are copied to the deploy area by this script: only
+the profiles whose content changed are replaced and only the corresponding clients
+are notified.
+
+With --prefetch, a second working copy tracking trunk (prefetch_cache) is updated
+without deploying anything. When a tag is deployed, it replaces svn_cache so that
+most of the network transfer has already been done when the tag is created.
 """
 
 __version__ = "1.0.3"
@@ -13,6 +37,8 @@ import sys
 import os
 import re
 import shutil
+import time
+import tempfile
 from subprocess import *
 import StringIO
 import pysvn
@@ -20,6 +46,14 @@ import logging
 import logging.handlers
 import syslog
 import socket
+import fcntl
+import hashlib
+import threading
+import collections
+import json
+import shlex
+import deploy_metrics
+import deploy_notify
 from optparse import OptionParser
 import ConfigParser
 
@@ -28,7 +62,9 @@ import ConfigParser
 this_script = os.path.abspath(sys.argv[0])
 verbosity = 0
 lock_created = False
+lock_fd = None
 client = None
+metrics = None
 logger = None
 tag = None
 java_root = '/usr/java'
@@ -45,20 +81,149 @@ config_defaults = StringIO.StringIO("""
 ant_cmd: external/ant/bin/ant
 # ant options (passed through env variable ANT_OPTS)
 #ant_opts: -Xmx2048M
-# ant stdout: allow to redirect ant output to a file for debugging purposes (default is PIPE)
-# Default changed to a file because of problem in subprocess module if the 
-# output is very large (Python 2.4) leading to the parent/child communication
-# to hang.
+# ant stdout: file where ant output is written as it is produced. With PIPE, ant
+# output is not written to a file: only the excerpt below is kept.
 ant_stdout: /tmp/ant-deploy-notify.log
 #ant_stdout: PIPE
+# Size (in KB) of the end of ant output kept in memory and included in error reports
+ant_output_tail: 16
+# Lines of ant output matching this regexp (panc errors) are kept in memory and
+# included in error reports (the first ant_error_lines ones)
+ant_error_pattern: [Ee]rror|[Ee]xception|BUILD FAILED
+ant_error_lines: 100
 # ant target to do the deployment. Default should be appropriate.
 ant_target: deploy.and.notify
+# Number of clusters compiled concurrently, each by a separate ant process (in a new
+# JVM started with ant_opts: size the JVM heap accordingly). Output of each process
+# is written to ant_stdout suffixed by the cluster name. The compile server is not
+# used for these processes. 0 disables the sharded build: ant_target is used.
+shard_workers: 0
+# ant target compiling the cluster specified with -Dcluster.name (and -Dcluster.group)
+shard_compile_target: compile.clusters
+# ant target checking template syntax, run concurrently with cluster compilations.
+# Empty disables it.
+shard_check_target: check.syntax
+# ant target deploying the compiled profiles and notifying clients
+shard_notify_target: deploy.notify
+# Directory containing the clusters. If not starting with /, relative to svn_cache.
+# Keep consistent with quattor.build.properties (cfg.clusters).
+clusters_dir: cfg/clusters
+# Clusters are arranged in cluster groups (clusters_dir/group/cluster).
+# Keep consistent with quattor.build.properties (clusters.groups.enable).
+clusters_groups: no
+# Publish the compiled profiles in the deploy area: only the profiles whose content
+# changed (compared by hash) are replaced (atomic rename), the other ones keeping their
+# modification time so that clients don't download them again. Profiles previously
+# published by this script and no longer compiled are removed. Only the clients whose
+# profile changed are notified.
+publish: no
+# ant target compiling profiles without deploying them (not used with shard_workers)
+publish_compile_target: compile.profiles
+# ant target updating profiles-info.xml in the deploy area and notifying the clients
+# whose profile is listed in the file specified with -Dnotify.includesfile (unless
+# -Dnotify.skip is defined)
+publish_notify_target: notify.profiles
+# Deploy area where profiles are published. Empty means deploy.xml defined in
+# quattor.deploy.properties or quattor.build.properties (in svn_cache parent or svn_cache),
+# else ${deploy}/xml, deploy being defined in the same files (default: deploy relative
+# to svn_cache).
+#deploy_profiles: /www/htdocs/profiles
+deploy_profiles:
+# File listing the profiles (relative to the deploy area) changed by the last publication,
+# one per line after a pattern matching no profile (used as an ant includesfile). All the
+# profiles published are listed in the same file suffixed by .all: only these ones are
+# removed from the deploy area when they are no longer compiled.
+publish_manifest: /var/lib/quattor-deploy/published-profiles
+# Nailgun client used to run ant in the JVM of a long-lived compile server (Nailgun
+# server), avoiding JVM startup and warm-up on every deployment. ant is run in a new
+# JVM if the compile server cannot be used. Empty disables the compile server.
+#compile_server_client: /usr/bin/ng
+compile_server_client:
+# Address (host:port) of the compile server
+compile_server: 127.0.0.1:2113
+# Command (run in / with JAVA_HOME set to java_version) starting the compile server when
+# it is not running. Empty means the server is managed outside of this script. Adding
+# ant, panc and quattor ant tasks jars to the server classpath keeps them loaded between
+# deployments: the server must then be restarted when they are updated in SCDB.
+#compile_server_start: /usr/java/latest/bin/java -server -Xmx2048M -cp /usr/share/java/nailgun.jar:/var/quattor/svncache/external/ant/lib/ant.jar:/var/quattor/svncache/external/ant/lib/ant-launcher.jar:/var/quattor/svncache/external/panc/lib/panc.jar com.martiansoftware.nailgun.NGServer 127.0.0.1:2113
+compile_server_start:
+# Output of the compile server started by this script
+compile_server_log: /tmp/quattor-compile-server.log
+# Maximum time (in seconds) to wait for the compile server to accept connections after starting it
+compile_server_timeout: 30
 # If not starting with /, relative to /usr/java.
 java_version: latest
 # If not starting with /, relative to parent of this directory script
 svn_cache: svncache
 # Number of retries for SVN switch to new tag in case of error
 switch_retry_count: 1
+# Depth of svn_cache checkout: infinity, immediates, files or empty
+checkout_depth: infinity
+# Space-separated list of path[:depth] (relative to the SCDB root) to check out in svn_cache
+# with a specific depth (default: infinity). Depth exclude removes the path from svn_cache.
+# A path must be listed after its parent if both are listed.
+#sparse_paths: external:empty external/ant external/panc external/scdb-ant-utils external/svnkit
+sparse_paths:
+# Keep svn_cache on trunk_branch and update only the paths changed since the previous
+# deployment to the trunk revision the tag was created from, instead of switching the
+# whole svn_cache to the tag.
+delta_update: no
+# File recording the URL, revision and sparse paths of svn_cache
+svn_cache_state: /var/lib/quattor-deploy/svncache-state
+# Working copy of trunk_branch updated by --prefetch (e.g. by post-commit.py on every
+# trunk commit or by cron). It replaces svn_cache when a tag is deployed, the previous
+# svn_cache becoming the prefetched working copy. Must be on the same file system
+# as svn_cache. If not starting with /, relative to parent of this directory script.
+# Empty disables prefetching.
+#prefetch_cache: svncache.prefetch
+prefetch_cache:
+# Directories (relative to svn_cache) not managed by SVN moved to the prefetched
+# working copy when it replaces svn_cache
+prefetch_keep: build deploy
+# Directory where tags are queued by --queue until a worker deploys them
+queue_dir: /var/spool/quattor-deploy
+# Output of the worker started by --queue
+worker_log: /tmp/quattor-deploy-worker.log
+# notify_xxx are used to configure email notification of deployment errors in the
+# worker (a direct run reports errors to its caller). notif_mailer may be host:port.
+# If notif_from or notif_to is undefined, email notification is disabled
+notif_mailer: localhost
+#notif_from: Quattor Deployment <noreply@lal.in2p3.fr>
+#notif_to: jouvin@lal.in2p3.fr
+notif_subject: Failed to deploy tag %s of SCDB configuration
+# Minimum interval (in seconds) between emails: errors logged in between are sent
+# as one digest email
+notif_min_interval: 300
+# File where errors are spooled until they are sent
+notif_spool: /tmp/quattor-build-tag-notif.spool
+# Maximum number of errors included in a digest email
+notif_digest_max: 100
+# Compile only the profiles affected by the changes since the last tag deployed, using
+# the dependency files written by panc (pan.formats must include dep). A full build is
+# done when the affected profiles cannot be determined.
+incremental_build: no
+# File where the last tag successfully deployed is recorded. A tag older than this one
+# is never deployed by the worker.
+last_tag_file: /var/lib/quattor-deploy/last-tag
+# Directory where panc writes profiles and dependency files. If not starting with /,
+# relative to svn_cache. Keep consistent with quattor.build.properties (build.xml).
+build_profiles: build/profiles
+# Templates not listed in dependency files (pan.dep.ignore): a full build is done if one
+# of them is modified. Keep consistent with quattor.build.properties.
+dep_ignore_pattern: repository/[\w\.\-]+$
+# File where the duration of each phase of a deployment (svn operations, ant and ant
+# targets) is appended as one JSON line per deployment. Empty disables it.
+#metrics_log: /var/log/quattor-deploy-metrics.log
+metrics_log:
+# StatsD server (host:port) where phase durations are sent as timers. Empty disables it.
+#metrics_statsd: localhost:8125
+metrics_statsd:
+# File (node_exporter textfile collector, *.prom) where the metrics of the last deployment
+# are written in Prometheus format. Empty disables it.
+#metrics_textfile: /var/lib/node_exporter/textfile/quattor_deploy_build_tag.prom
+metrics_textfile:
+# Prefix of StatsD and Prometheus metric names
+metrics_prefix: quattor_deploy
 # Verbosity level
 verbose: 0
 
@@ -76,11 +241,7 @@ trunk_branch: /trunk
 def abort(msg):
     logger.error("build-tag.py script failed:\n%s" % (msg))
     if lock_created:
-      try:
-        os.remove(lock_file)
-      except OSError, detail:
-        if detail.errno != 2:
-          warning('Failed to delete lock file (%s): %s' % (lock_file,detail))
+      release_lock()
     sys.exit(2)
 
 def warning(msg):
@@ -93,6 +254,9 @@ def debug(level,msg):
     else:
       logger.debug(msg)
 
+class DeployError(Exception):
+    pass
+
 def check_pid(pid):        
     """ Check for the existence of a unix pid (signal 0 does nothing). """
     try:
@@ -102,6 +266,59 @@ def check_pid(pid):
     else:
         return True
 
+# The lock file is never deleted: the lock is a flock on it, released by the kernel when
+# the instance holding it exits, even if it doesn't exit cleanly. The file contains the pid
+# of this instance for information.
+
+def lock_owner():
+  """ Return the pid of the running instance holding the lock ('unknown' if not yet
+      recorded), else None. """
+  try:
+    owner_fd = open(lock_file,'r')
+  except IOError, detail:
+    if detail.errno == 2:
+      return None
+    abort('Failed to open lock file (%s): %s' % (lock_file,detail))
+  try:
+    try:
+      fcntl.flock(owner_fd,fcntl.LOCK_SH|fcntl.LOCK_NB)
+    except IOError:
+      pidstr = owner_fd.readline().rstrip()
+      if re.match('[0-9]+$',pidstr):
+        return int(pidstr)
+      return 'unknown'
+    return None
+  finally:
+    owner_fd.close()
+
+def acquire_lock():
+  """ Lock the lock file. Returns False if another instance is already running. """
+  global lock_created, lock_fd
+  try:
+    lock_fd = os.open(lock_file,os.O_RDWR|os.O_CREAT,0644)
+  except OSError, detail:
+    abort('Failed to open lock file (%s): %s' % (lock_file,detail))
+  try:
+    fcntl.flock(lock_fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+  except IOError:
+    os.close(lock_fd)
+    lock_fd = None
+    return False
+  os.ftruncate(lock_fd,0)
+  os.write(lock_fd,str(os.getpid()))
+  lock_created = True
+  return True
+
+def release_lock():
+  global lock_created, lock_fd
+  try:
+    os.ftruncate(lock_fd,0)
+  except OSError, detail:
+    warning('Failed to clear lock file (%s): %s' % (lock_file,detail))
+  os.close(lock_fd)
+  lock_fd = None
+  lock_created = False
+
 # Configure loggers and handlers
 
 logging_source = 'build-tag'
@@ -126,6 +343,11 @@ parser = OptionParser()
 parser.add_option('--config', dest='config_file', action='store', default=config_file_default, help='Name of the configuration file to use')
 parser.add_option('-v', '--debug', '--verbose', dest='verbosity', action='count', default=0, help='Increase verbosity level for debugging (on stderr)')
 parser.add_option('--version', dest='version', action='store_true', default=False, help='Display various information about this script')
+parser.add_option('--queue', dest='queue', action='store_true', default=False, help='Queue the tag for deployment by a worker and return immediately')
+parser.add_option('--worker', dest='worker', action='store_true', default=False, help='Deploy queued tags (only the most recent one if several are pending)')
+parser.add_option('--prefetch', dest='prefetch', action='store_true', default=False, help='Update the prefetched working copy of trunk and return')
+parser.add_option('--revision', dest='revision', action='store', default=None, help='SVN revision of the tag, recorded with the last tag deployed (used with --queue)', metavar='REV')
+parser.add_option('--send-notifications', dest='send_notifications', action='store_true', default=False, help='Send pending email notifications (used internally)')
 options, args = parser.parse_args()
 
 if options.version:
@@ -133,13 +355,20 @@ if options.version:
   debug (0,__doc__)
   sys.exit(0)
 
-if len(args) < 1:
+if options.worker or options.prefetch or options.send_notifications:
+  if len(args) > 0:
+    abort("no tag must be specified with --worker, --prefetch or --send-notifications")
+elif len(args) < 1:
   abort("tag to deploy must be specified")  
   
 if options.verbosity:
   verbosity = options.verbosity
 
-tag = args[0]
+if options.revision and not re.match('^[0-9]+$',options.revision):
+  abort("Invalid revision specified with --revision (%s)" % (options.revision))
+
+if not options.worker and not options.prefetch and not options.send_notifications:
+  tag = args[0]
 
 
 # Read configuration file.
@@ -186,6 +415,8 @@ try:
   section = config_sections['scdb']
   option_name = 'tags_branch'
   tags_branch = config.get(section,option_name)
+  option_name = 'trunk_branch'
+  trunk_branch = config.get(section,option_name)
   
   # Section [build-tag]
   section = config_sections['build-tag']
@@ -193,6 +424,29 @@ try:
   ant_cmd = config.get(section,option_name)
   option_name = 'ant_target'
   ant_target = config.get(section,option_name)
+  option_name = 'shard_workers'
+  shard_workers = config.getint(section,option_name)
+  option_name = 'shard_compile_target'
+  shard_compile_target = config.get(section,option_name)
+  option_name = 'shard_check_target'
+  shard_check_target = config.get(section,option_name)
+  option_name = 'shard_notify_target'
+  shard_notify_target = config.get(section,option_name)
+  option_name = 'clusters_dir'
+  clusters_dir = config.get(section,option_name)
+  option_name = 'clusters_groups'
+  clusters_groups = config.getboolean(section,option_name)
+  option_name = 'publish'
+  publish = config.getboolean(section,option_name)
+  option_name = 'publish_compile_target'
+  publish_compile_target = config.get(section,option_name)
+  option_name = 'publish_notify_target'
+  publish_notify_target = config.get(section,option_name)
+  option_name = 'deploy_profiles'
+  deploy_profiles = config.get(section,option_name)
+  option_name = 'publish_manifest'
+  publish_manifest = config.get(section,option_name)
+  published_list = publish_manifest + '.all'
   option_name = 'java_version'
   java_version = config.get(section,option_name)
   option_name = 'svn_cache'
@@ -201,6 +455,64 @@ try:
   switch_retry_count = config.getint(section,option_name)
   option_name = 'ant_stdout'
   ant_stdout_file = config.get(section,option_name)
+  option_name = 'ant_output_tail'
+  ant_output_tail = config.getint(section,option_name) * 1024
+  option_name = 'ant_error_pattern'
+  ant_error_pattern = config.get(section,option_name)
+  option_name = 'ant_error_lines'
+  ant_error_lines = config.getint(section,option_name)
+  option_name = 'compile_server_client'
+  compile_server_client = config.get(section,option_name)
+  option_name = 'compile_server'
+  compile_server = config.get(section,option_name)
+  option_name = 'compile_server_start'
+  compile_server_start = config.get(section,option_name)
+  option_name = 'compile_server_log'
+  compile_server_log = config.get(section,option_name)
+  option_name = 'compile_server_timeout'
+  compile_server_timeout = config.getint(section,option_name)
+  option_name = 'metrics_log'
+  metrics_log = config.get(section,option_name)
+  option_name = 'metrics_statsd'
+  metrics_statsd = config.get(section,option_name)
+  option_name = 'metrics_textfile'
+  metrics_textfile = config.get(section,option_name)
+  option_name = 'metrics_prefix'
+  metrics_prefix = config.get(section,option_name)
+  option_name = 'queue_dir'
+  queue_dir = config.get(section,option_name)
+  option_name = 'worker_log'
+  worker_log = config.get(section,option_name)
+  option_name = 'notif_mailer'
+  notif_mailer = config.get(section,option_name)
+  option_name = 'notif_subject'
+  notif_subject = config.get(section,option_name)
+  option_name = 'notif_spool'
+  notif_spool = config.get(section,option_name)
+  option_name = 'notif_min_interval'
+  notif_min_interval = config.getint(section,option_name)
+  option_name = 'notif_digest_max'
+  notif_digest_max = config.getint(section,option_name)
+  option_name = 'incremental_build'
+  incremental_build = config.getboolean(section,option_name)
+  option_name = 'last_tag_file'
+  last_tag_file = config.get(section,option_name)
+  option_name = 'build_profiles'
+  build_profiles = config.get(section,option_name)
+  option_name = 'dep_ignore_pattern'
+  dep_ignore_pattern = config.get(section,option_name)
+  option_name = 'checkout_depth'
+  checkout_depth = config.get(section,option_name)
+  option_name = 'sparse_paths'
+  sparse_paths = config.get(section,option_name)
+  option_name = 'delta_update'
+  delta_update = config.getboolean(section,option_name)
+  option_name = 'svn_cache_state'
+  svn_cache_state = config.get(section,option_name)
+  option_name = 'prefetch_cache'
+  prefetch_cache = config.get(section,option_name)
+  option_name = 'prefetch_keep'
+  prefetch_keep = config.get(section,option_name).split()
 except ValueError:
   abort("Option % (section %s) not defined: internal error (default value should exist)." % (option_name,section))
 
@@ -212,6 +524,12 @@ if not re.match('/',tags_branch):
 if re.search('/$',tags_branch):
   tags_branch = tags_branch.rstrip('/')
   debug(1,"Trailing / stripped from 'tags_branch'. New value: %s" % (tags_branch))
+if not re.match('/',trunk_branch):
+  trunk_branch = '/' + trunk_branch
+  debug(1,"Leading / added to 'trunk_branch'. New value: %s" % (trunk_branch))
+if re.search('/$',trunk_branch):
+  trunk_branch = trunk_branch.rstrip('/')
+  debug(1,"Trailing / stripped from 'trunk_branch'. New value: %s" % (trunk_branch))
 
 # Optional ant_opts
 section = config_sections['build-tag']
@@ -226,6 +544,78 @@ if not re.match('^/',java_version):
   
 if not re.match('^/',svn_cache):
   svn_cache = script_parent_dir + '/' + svn_cache
+
+if not re.match('^/',build_profiles):
+  build_profiles = svn_cache + '/' + build_profiles
+
+if not re.match('^/',clusters_dir):
+  clusters_dir = svn_cache + '/' + clusters_dir
+
+if shard_workers < 0:
+  abort("Invalid value specified for 'shard_workers' (%d): must be 0 or greater" % (shard_workers))
+
+if prefetch_cache:
+  if not re.match('^/',prefetch_cache):
+    prefetch_cache = script_parent_dir + '/' + prefetch_cache
+  prefetch_cache = prefetch_cache.rstrip('/')
+  prefetch_lock = prefetch_cache + '.lock'
+  prefetch_state = svn_cache_state + '.prefetch'
+elif options.prefetch:
+  abort("--prefetch requires option 'prefetch_cache' to be defined")
+
+if compile_server_client:
+  try:
+    (compile_server_host,compile_server_port) = compile_server.rsplit(':',1)
+    compile_server_port = int(compile_server_port)
+  except ValueError:
+    abort("Invalid value specified for 'compile_server' (%s): must be host:port" % (compile_server))
+
+if ant_output_tail <= 0:
+  abort("Invalid value specified for 'ant_output_tail' (%d): must be greater than 0" % (ant_output_tail/1024))
+
+if checkout_depth not in [ 'empty', 'files', 'immediates', 'infinity' ]:
+  abort("Invalid value specified for 'checkout_depth' (%s): must be empty, files, immediates or infinity" % (checkout_depth))
+sparse_rules = []
+for sparse_rule in sparse_paths.split():
+  if ':' in sparse_rule:
+    (sparse_path,sparse_depth) = sparse_rule.rsplit(':',1)
+  else:
+    (sparse_path,sparse_depth) = (sparse_rule,'infinity')
+  if sparse_depth not in [ 'empty', 'files', 'immediates', 'infinity', 'exclude' ]:
+    abort("Invalid depth specified for %s in 'sparse_paths' (%s)" % (sparse_path,sparse_depth))
+  sparse_rules.append((sparse_path.strip('/'),sparse_depth))
+
+# Email notification of the worker errors
+init_mail_handler = True
+try:
+  section = config_sections['build-tag']
+  notif_from = config.get(section,'notif_from')
+  notif_to = config.get(section,'notif_to')
+except ConfigParser.NoOptionError:
+  init_mail_handler = False
+
+if init_mail_handler:
+  if re.search(':[0-9]+$',notif_mailer):
+    (notif_host,notif_port) = notif_mailer.rsplit(':',1)
+    notif_mailer = (notif_host,int(notif_port))
+  sender_cmd = [ sys.executable, this_script, '--config', os.path.abspath(options.config_file), '--send-notifications' ]
+  # Subject is updated with the tag name before each deployment
+  mail_handler = deploy_notify.DigestMailHandler(notif_mailer,notif_from,notif_to,notif_subject % ('(queued)'),
+                                                 notif_spool,notif_min_interval,notif_digest_max,sender_cmd)
+  mail_handler.setLevel(logging.ERROR)
+  mail_handler.setFormatter(fmt)
+
+# Detached instance sending the spooled emails: errors are only logged to syslog
+if options.send_notifications:
+  if init_mail_handler:
+    try:
+      mail_handler.send_spool()
+    except Exception, detail:
+      warning('Failed to send email notifications: %s' % (detail))
+  sys.exit(0)
+
+if options.worker and init_mail_handler:
+  logger.addHandler(mail_handler)
   
 
 # Checks availability of required applications
@@ -235,138 +625,1063 @@ if not os.path.exists(java_version):
   abort("Specified Java version (%s) does not exist. Use 'java_version' to specify another version" % (java_version))
   
 
-# Ensure there is not another instance of the script already running.
-# Unfortunatly, as there is no way to open a new lock file without cloberring, this is
-# a 2-step operation with a very small race condition if another script instance is doing the
-# same test between both steps. But this is probably not a real issue as svncache will be locked
-# by one of the instance and the other one will fail.
+# Incremental build.
+# The templates changed between the last tag deployed and the new one are mapped to the
+# profiles depending on them, using the dependency files (.dep) written by panc for each
+# profile. Each line of a dependency file starts with the name of a template used by the
+# profile. As a template name is its path relative to a load path directory, a changed
+# template is matched against the template names which are a suffix of its path.
 
-already_running = True
-try:
-  lock_fd = open(lock_file,'r')
-except IOError, detail:
-  if detail.errno == 2:
-    already_running = False
-  else:
-    abort('Failed to open lock file (%s): %s' % (lock_file,detail))
-if already_running:
-  pidstr = lock_fd.readline().rstrip()
-  lock_fd.close()
-  try:
-    pid=int(pidstr)
-  except ValueError, detail:
-    abort("Lock file (%s) found but doesn't contain a valid pid (%s)" % (lock_file,pidstr))
-  if check_pid(pid):
-    abort("%s already running (pid=%d). Retry later..." % (this_script,pid))
-try:
-  lock_fd = open(lock_file,'w')
-  lock_fd.write(str(os.getpid()))
-  lock_fd.close()
-except IOError, detail:
-  abort('Failed to open lock file (%s): %s' % (lock_file,detail))
+# last_tag_file contains the last tag deployed and, if it was queued with --revision,
+# its SVN revision ('revision: REV' on the second line).
 
-# Switch SVN cache to new tag
+def read_last_deployed():
+  """ Return a tuple (last tag deployed,its revision), both None if unknown """
+  try:
+    last_tag_fd = open(last_tag_file,'r')
+  except IOError, detail:
+    if detail.errno != 2:
+      warning('Failed to read last tag deployed (%s): %s' % (last_tag_file,detail))
+    return (None,None)
+  last_tag = last_tag_fd.readline().rstrip()
+  matcher = re.match('^revision: ([0-9]+)$',last_tag_fd.readline().rstrip())
+  last_tag_fd.close()
+  if matcher:
+    return (last_tag,matcher.group(1))
+  return (last_tag,None)
 
-tag_url = repository_url + tags_branch + '/' + tag
+def read_last_tag():
+  return read_last_deployed()[0]
 
-debug(0, "Processing tag %s..." % (tag_url))
-debug(0, "SVN cache: %s" % (svn_cache))
+def write_last_tag(tag,revision=None):
+  try:
+    if not os.path.isdir(os.path.dirname(last_tag_file)):
+      os.makedirs(os.path.dirname(last_tag_file),0755)
+    last_tag_fd, last_tag_tmp = tempfile.mkstemp(dir=os.path.dirname(last_tag_file),prefix='.')
+    os.write(last_tag_fd,tag + '\n')
+    if revision:
+      os.write(last_tag_fd,'revision: %s\n' % (revision))
+    os.close(last_tag_fd)
+    os.chmod(last_tag_tmp,0644)
+    os.rename(last_tag_tmp,last_tag_file)
+  except (IOError,OSError), detail:
+    warning('Failed to record last tag deployed (%s): %s' % (last_tag_file,detail))
 
-client = pysvn.Client()
-client.exception_style = 0
+def read_dependencies():
+  """ Return a dict giving the list of profiles depending on each template name """
+  dependencies = {}
+  for (dirpath,dirnames,filenames) in os.walk(build_profiles):
+    for filename in filenames:
+      if not filename.endswith('.dep'):
+        continue
+      profile = filename[:-4]
+      dep_fd = open(os.path.join(dirpath,filename),'r')
+      for line in dep_fd:
+        fields = line.split()
+        if len(fields) > 0:
+          dependencies.setdefault(fields[0],set()).add(profile)
+      dep_fd.close()
+  return dependencies
 
-# If svn_cache exists, check it is valid, else delete it.
-if os.path.isdir(svn_cache) and os.access(svn_cache,os.W_OK):
+def affected_profiles(last_tag,tag):
+  """ Return the list of profiles affected by changes between last_tag and tag, or None if a full build is required """
   try:
-    debug(1,'Checking %s is a valid SVN working copy' % (svn_cache))
-    wc_info = client.info(svn_cache)
+    changes = client.diff_summarize(url_or_path1=repository_url + tags_branch + '/' + last_tag,
+                                    revision1=pysvn.Revision(pysvn.opt_revision_kind.head),
+                                    url_or_path2=repository_url + tags_branch + '/' + tag,
+                                    revision2=pysvn.Revision(pysvn.opt_revision_kind.head),
+                                    recurse=True)
   except pysvn.ClientError, e:
-    warning("%s is not a valid SVN working copy. Deleting and checking out again..." % (svn_cache))
-    shutil.rmtree(svn_cache)
+    warning('Failed to get changes between tags %s and %s: %s' % (last_tag,tag,e))
+    return None
+  try:
+    dependencies = read_dependencies()
+  except (IOError,OSError), detail:
+    warning('Failed to read dependency files in %s: %s' % (build_profiles,detail))
+    return None
+  if len(dependencies) == 0:
+    debug(1,'No dependency file found in %s' % (build_profiles))
+    return None
+
+  profiles = set()
+  for change in changes:
+    path = change['path']
+    if change['node_kind'] == pysvn.node_kind.dir:
+      # Templates in a deleted directory are not listed
+      if change['summarize_kind'] == pysvn.diff_summarize_kind.delete:
+        debug(1,'Directory %s deleted' % (path))
+        return None
+      continue
+    matcher = re.match('^(?P<name>.*)\.(?:pan|tpl)$',path)
+    if not matcher:
+      debug(1,'%s is not a template' % (path))
+      return None
+    template = matcher.group('name')
+    if re.search(dep_ignore_pattern,template):
+      debug(1,'Template %s not listed in dependency files' % (path))
+      return None
+    profile_matcher = re.match('^(?:.*/)?profiles/(?:.*/)?(?P<profile>[^/]+)$',template)
+    if profile_matcher:
+      if change['summarize_kind'] == pysvn.diff_summarize_kind.delete:
+        debug(1,'Profile %s deleted' % (path))
+        return None
+      profiles.add(profile_matcher.group('profile'))
+    components = template.split('/')
+    for i in range(len(components)):
+      name = '/'.join(components[i:])
+      if dependencies.has_key(name):
+        profiles.update(dependencies[name])
+  debug(0,'Incremental build: %d templates changed since tag %s, %d profiles to compile' % (len(changes),last_tag,len(profiles)))
+  return sorted(profiles)
+
+# svn_cache update.
+# svn_cache is checked out with depth checkout_depth and the depth of the paths listed in
+# sparse_paths is then set explicitly (sticky depth, preserved by further switches and updates).
+# With delta_update, svn_cache tracks trunk_branch: as a tag is a copy of trunk, svn_cache is
+# updated to the trunk revision the tag was created from. Only the paths changed since
+# the revision recorded in svn_cache_state are updated (avoiding a crawl of the whole
+# working copy), leaving a mixed-revision working copy matching the tag contents.
+
+def read_svn_cache_state(state_file):
+  """ Return a tuple (url,revision,sparse_paths) recorded in state_file, or (None,None,None) """
+  try:
+    state_fd = open(state_file,'r')
+  except IOError, detail:
+    if detail.errno != 2:
+      warning('Failed to read working copy state (%s): %s' % (state_file,detail))
+    return (None,None,None)
+  state = [ line.rstrip('\n') for line in state_fd.readlines() ]
+  state_fd.close()
+  try:
+    return (state[0],int(state[1]),state[2])
+  except (IndexError,ValueError):
+    warning('Invalid working copy state (%s) ignored' % (state_file))
+    return (None,None,None)
 
-# If svn_cache doesn't exist, do a checkout
-if not os.path.isdir(svn_cache):
+def write_svn_cache_state(state_file,url,revision):
   try:
-    debug(0,"Checking out %s into %s" % (tag_url,svn_cache))
-    client.checkout(path=svn_cache,url=tag_url)
+    if not os.path.isdir(os.path.dirname(state_file)):
+      os.makedirs(os.path.dirname(state_file),0755)
+    state_fd, state_tmp = tempfile.mkstemp(dir=os.path.dirname(state_file),prefix='.')
+    os.write(state_fd,'%s\n%d\n%s\n' % (url,revision,sparse_paths))
+    os.close(state_fd)
+    os.chmod(state_tmp,0644)
+    os.rename(state_tmp,state_file)
+  except (IOError,OSError), detail:
+    warning('Failed to record working copy state (%s): %s' % (state_file,detail))
+
+def tag_revision(tag):
+  """ Return the trunk revision tag was created from, or None if tag is not a copy of trunk_branch """
+  tag_path = tags_branch + '/' + tag
+  try:
+    log_msgs = client.log(repository_url + tag_path, discover_changed_paths=True, strict_node_history=True, limit=1)
   except pysvn.ClientError, e:
-    debug(1,'Error during checkout of %s. Trying to continue' % tag_url)
-
-# Switch to new tag.
-# Do also after an initial checkout as it may allow to complete a failed check out.
-# Retry switch in case of errors as specified by switch_retry_count
-switch_failed = True
-i = 1
-while switch_failed and i <= switch_retry_count:
-  if i > 1 and switch_failed:
-    debug(1,'Switch to tag %s failed. Retrying (%d/%d)...' % (tag,i,switch_retry_count))
+    warning('Failed to retrieve log message for tag %s: %s' % (tag,e))
+    return None
+  for log in log_msgs:
+    for changed_path in log['changed_paths']:
+      if changed_path['path'] == tag_path and changed_path['copyfrom_path'] == trunk_branch:
+        return changed_path['copyfrom_revision'].number
+  return None
+
+def apply_sparse_paths(wc_path,revision):
+  for (path,depth) in sparse_rules:
+    # Parents missing in the working copy are added without their contents
+    components = path.split('/')
+    for i in range(1,len(components)):
+      parent = wc_path + '/' + '/'.join(components[:i])
+      if not os.path.exists(parent):
+        client.update(parent, revision=revision, depth=pysvn.depth.empty, depth_is_sticky=True)
+    debug(1,'Setting depth of %s to %s' % (path,depth))
+    client.update(wc_path + '/' + path, revision=revision, depth=getattr(pysvn.depth,depth), depth_is_sticky=True)
+
+def excluded_path(path):
+  for (sparse_path,depth) in sparse_rules:
+    if depth == 'exclude' and (path == sparse_path or path.startswith(sparse_path + '/')):
+      return True
+  return False
+
+def update_changed_paths(url,last_revision,revision):
+  """ Update the paths of svn_cache changed in url between last_revision and revision. Returns the number of paths updated. """
+  changes = client.diff_summarize(url_or_path1=url,
+                                  revision1=pysvn.Revision(pysvn.opt_revision_kind.number,last_revision),
+                                  url_or_path2=url,
+                                  revision2=pysvn.Revision(pysvn.opt_revision_kind.number,revision),
+                                  recurse=True)
+  targets = []
+  parent_depths = {}
+  for path in sorted(set([ change['path'].strip('/') for change in changes ])):
+    # The root directory (property changes) and paths below a path already selected are
+    # updated with it.
+    if path == '' or len([ target for target in targets if path.startswith(target + '/') ]) > 0:
+      continue
+    if excluded_path(path):
+      continue
+    wc_path = svn_cache + '/' + path
+    if not os.path.lexists(wc_path):
+      # A new path is not added if its parent is not checked out with depth infinity (sparse svn_cache)
+      parent = os.path.dirname(wc_path)
+      if not os.path.isdir(parent):
+        continue
+      if not parent_depths.has_key(parent):
+        parent_depths[parent] = client.info2(parent, recurse=False)[0][1]['wc_info']['depth']
+      if parent_depths[parent] != pysvn.depth.infinity:
+        continue
+    targets.append(path)
+  if len(targets) > 0:
+    client.update([ svn_cache + '/' + target for target in targets ], revision=pysvn.Revision(pysvn.opt_revision_kind.number,revision))
+  return len(targets)
+
+# Prefetched working copy.
+# prefetch_cache is updated to the head of trunk_branch by --prefetch, with the same
+# depth and sparse paths as svn_cache, holding prefetch_lock (flock) while updating.
+# When a tag is deployed, prefetch_cache and svn_cache are exchanged (with their state
+# files) if prefetch_cache is not being updated: switching to the tag (or updating
+# to the trunk revision it was created from) is then mostly a local operation.
+
+def prefetch():
+  """ Check out or update prefetch_cache to the head of trunk_branch """
+  trunk_url = repository_url + trunk_branch
+  try:
+    lock_fd = open(prefetch_lock,'w')
+  except IOError, detail:
+    abort('Failed to open prefetch lock file (%s): %s' % (prefetch_lock,detail))
+  try:
+    # Wait for the completion of another prefetch: it may have started before the
+    # last commit.
+    fcntl.flock(lock_fd,fcntl.LOCK_EX)
+    (state_url,state_revision,state_sparse_paths) = read_svn_cache_state(prefetch_state)
+    new_checkout = False
+    if os.path.isdir(prefetch_cache):
+      try:
+        client.info(prefetch_cache)
+      except pysvn.ClientError, e:
+        warning("%s is not a valid SVN working copy. Deleting and checking out again..." % (prefetch_cache))
+        shutil.rmtree(prefetch_cache)
+    try:
+      if not os.path.isdir(prefetch_cache):
+        new_checkout = True
+        debug(0,"Checking out %s into %s (depth=%s)" % (trunk_url,prefetch_cache,checkout_depth))
+        client.checkout(path=prefetch_cache,url=trunk_url,depth=getattr(pysvn.depth,checkout_depth))
+      else:
+        # prefetch_cache may be on a tag if it was svn_cache before
+        debug(0,"Updating %s to head of %s" % (prefetch_cache,trunk_url))
+        client.switch(path=prefetch_cache,url=trunk_url)
+      revision = client.info(prefetch_cache)['revision'].number
+      if new_checkout or state_sparse_paths != sparse_paths:
+        apply_sparse_paths(prefetch_cache,pysvn.Revision(pysvn.opt_revision_kind.number,revision))
+    except pysvn.ClientError, e:
+      # Ensure a partially updated working copy is not used
+      if os.path.exists(prefetch_state):
+        os.remove(prefetch_state)
+      abort('Failed to update prefetched working copy %s: %s' % (prefetch_cache,e))
+    write_svn_cache_state(prefetch_state,trunk_url,revision)
+    debug(0,'%s updated to revision %d of %s' % (prefetch_cache,revision,trunk_url))
+  finally:
+    lock_fd.close()
+
+def move_path(source,destination):
+  if os.path.isdir(destination) and not os.path.islink(destination):
+    shutil.rmtree(destination)
+  elif os.path.lexists(destination):
+    os.remove(destination)
+  if not os.path.isdir(os.path.dirname(destination)):
+    os.makedirs(os.path.dirname(destination))
+  os.rename(source,destination)
+
+def swap_prefetch_cache():
+  """ Replace svn_cache by prefetch_cache, if available. The previous svn_cache becomes prefetch_cache. """
+  if not os.path.isdir(prefetch_cache):
+    debug(1,'No prefetched working copy (%s)' % (prefetch_cache))
+    return
+  try:
+    lock_fd = open(prefetch_lock,'w')
+  except IOError, detail:
+    warning('Failed to open prefetch lock file (%s): %s' % (prefetch_lock,detail))
+    return
+  try:
+    try:
+      fcntl.flock(lock_fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError:
+      debug(0,'Prefetched working copy %s is being updated: not used' % (prefetch_cache))
+      return
+    # No state means the last prefetch failed
+    (prefetch_url,prefetch_revision,prefetch_sparse_paths) = read_svn_cache_state(prefetch_state)
+    if not prefetch_url:
+      debug(0,'Prefetched working copy %s is incomplete: not used' % (prefetch_cache))
+      return
+    (state_url,state_revision,state_sparse_paths) = read_svn_cache_state(svn_cache_state)
+    if state_url == prefetch_url and state_revision >= prefetch_revision:
+      debug(1,'%s is not older than prefetched working copy: not replaced' % (svn_cache))
+      return
+    debug(0,'Replacing %s by prefetched working copy (revision %d of %s)' % (svn_cache,prefetch_revision,prefetch_url))
+    swap_tmp = svn_cache + '.swap'
+    try:
+      # svn_cache state is removed first so that an interrupted exchange cannot leave
+      # a working copy with the state of the other one
+      if os.path.exists(svn_cache_state):
+        move_path(svn_cache_state,swap_tmp + '.state')
+      if os.path.isdir(svn_cache):
+        # Build products are kept in svn_cache
+        for path in prefetch_keep:
+          if os.path.lexists(svn_cache + '/' + path):
+            move_path(svn_cache + '/' + path,prefetch_cache + '/' + path)
+        move_path(svn_cache,swap_tmp)
+      os.rename(prefetch_cache,svn_cache)
+      move_path(prefetch_state,svn_cache_state)
+      if os.path.isdir(swap_tmp):
+        os.rename(swap_tmp,prefetch_cache)
+        if os.path.exists(swap_tmp + '.state'):
+          os.rename(swap_tmp + '.state',prefetch_state)
+    except OSError, detail:
+      warning('Failed to replace %s by prefetched working copy: %s' % (svn_cache,detail))
+  finally:
+    lock_fd.close()
+
+# Deployment metrics.
+# The duration (in seconds) of each phase of a deployment is added to metrics['phases']
+# the duration of each ant target to metrics['ant_targets'] and the duration of the
+# compilation of each cluster to metrics['shards'] (sharded build). They are written at the
+# end of the deployment as one JSON line in metrics_log and optionally sent to a StatsD
+# server and written to a Prometheus textfile (see deploy_metrics.py).
+
+def start_metrics(tag,queued_time=None):
+  global metrics
+  metrics = { 'script':'build-tag', 'host':socket.getfqdn(), 'tag':tag, 'start':time.time(), 'phases':{}, 'ant_targets':{}, 'shards':{} }
+  if queued_time:
+    metrics['phases']['queue_wait'] = metrics['start'] - queued_time
+
+def record_phase(phase,start_time):
+  deploy_metrics.record_phase(metrics,phase,start_time)
+
+def write_metrics(status):
+  global metrics
+  if metrics:
+    deploy_metrics.write_metrics(metrics,status,[ ('phase','phases'), ('ant_target','ant_targets'), ('shard','shards') ],
+                                 metrics_log,metrics_statsd,metrics_textfile,metrics_prefix,logger)
+  metrics = None
+
+
+# ant execution.
+# ant output is read line by line as it is produced (reading it only after the end of
+# the command may block ant when the pipe is full) and written to ant_stdout. Only a
+# bounded excerpt is kept in memory: the last ant_output_tail bytes and the first
+# ant_error_lines lines matching ant_error_pattern.
+# The time until the first line of output (JVM and ant startup) and the duration of
+# each ant target (between 'target:' lines) are added to metrics, except for concurrent
+# ant processes (timings=False).
+
+def run_ant(cmd,env,stdout_file=None,timings=True):
+  """ Run ant command cmd in svn_cache. Returns a tuple (retcode,excerpt of the output). """
+  if not stdout_file:
+    stdout_file = ant_stdout_file
+  if stdout_file == 'PIPE':
+    log_fd = None
   else:
-    debug(0,'Switching to tag %s (url=%s)' % (tag,tag_url))
-  switch_failed = False
+    try:
+      log_fd = open(stdout_file,'w')
+    except IOError, detail:
+      warning('Failed to open ant output file (%s): %s' % (stdout_file,detail))
+      log_fd = None
+  error_matcher = re.compile(ant_error_pattern)
+  tail = collections.deque()
+  tail_size = 0
+  error_lines = []
+  error_count = 0
+  target_matcher = re.compile('^([\w\.\-]+):$')
+  target = None
+  start_time = time.time()
+  target_start = None
   try:
-    client.switch(path=svn_cache,url=tag_url)
-  except pysvn.ClientError, e:
-    switch_failed = True
-    last_errror = e
-  i += 1
-if switch_failed:
-  abort('Failed to switch SVN cache to new tag: %s' % (e))
+    proc = Popen(cmd, shell=False, cwd=svn_cache, env=env, stdout=PIPE, stderr=STDOUT)
+    # A very long line is processed as several lines
+    for line in iter(lambda: proc.stdout.readline(ant_output_tail),''):
+      if target_start is None:
+        if timings:
+          record_phase('ant_startup',start_time)
+        target_start = time.time()
+      target_match = target_matcher.match(line.rstrip())
+      if target_match:
+        if target and metrics and timings:
+          metrics['ant_targets'][target] = metrics['ant_targets'].get(target,0) + time.time() - target_start
+        target = target_match.group(1)
+        target_start = time.time()
+      if log_fd:
+        try:
+          log_fd.write(line)
+          log_fd.flush()
+        except IOError, detail:
+          warning('Failed to write ant output file (%s): %s' % (stdout_file,detail))
+          log_fd.close()
+          log_fd = None
+      tail.append(line)
+      tail_size += len(line)
+      while tail_size > ant_output_tail:
+        tail_size -= len(tail.popleft())
+      if error_matcher.search(line):
+        error_count += 1
+        if error_count <= ant_error_lines:
+          error_lines.append(line)
+    retcode = proc.wait()
+    if target and metrics and timings:
+      metrics['ant_targets'][target] = metrics['ant_targets'].get(target,0) + time.time() - target_start
+  finally:
+    if log_fd:
+      log_fd.close()
 
+  excerpt = ''
+  if error_count > 0:
+    excerpt += 'Errors (%d matching lines' % (error_count)
+    if error_count > ant_error_lines:
+      excerpt += ', first %d shown' % (ant_error_lines)
+    excerpt += '):\n%s\n' % (''.join(error_lines))
+  excerpt += 'Last lines of output:\n%s' % (''.join(tail))
+  if stdout_file != 'PIPE':
+    excerpt += '\nSee %s on %s for the complete output' % (stdout_file,socket.getfqdn())
+  return (retcode,excerpt)
 
-# Compile and deploy
+# Sharded build.
+# Each cluster is compiled by a separate ant process (shard_compile_target with -Dcluster.name),
+# shard_workers at most at the same time, the template syntax check being another one. The
+# largest clusters (number of profiles) are started first. All the processes write profiles
+# in the same build directory (one file per profile): when they all succeeded, shard_notify_target
+# copies them to the deploy area and notifies clients. After a failure, no new process is
+# started and the deploy area is not modified. The result of each process is recorded in
+# shard_results as a tuple (retcode,excerpt), retcode being None if it was not started.
 
-if not re.match(ant_cmd,'^/'):
-  ant_cmd = svn_cache + '/' + ant_cmd
+def list_clusters():
+  """ Return the list of (group,cluster) in clusters_dir, group being None without cluster groups """
+  def subdirs(path):
+    return sorted([entry for entry in os.listdir(path) if not entry.startswith('.') and os.path.isdir(os.path.join(path,entry))])
+  if clusters_groups:
+    return [ (group,cluster) for group in subdirs(clusters_dir) for cluster in subdirs(os.path.join(clusters_dir,group)) ]
+  else:
+    return [ (None,cluster) for cluster in subdirs(clusters_dir) ]
 
-if not os.path.exists(ant_cmd) or not os.access(ant_cmd,os.X_OK):
-  abort("ant (%s) not found. Use option 'ant_cmd' to specify another location." % (ant_cmd))
-  
-deploy_cmd = [ ant_cmd ]
-deploy_cmd.append(ant_target)
+def cluster_profiles(group,cluster):
+  """ Return the set of profile names in a cluster """
+  profiles = set()
+  cluster_path = os.path.join(clusters_dir,group or '',cluster)
+  for (dirpath,dirnames,filenames) in os.walk(os.path.join(cluster_path,'profiles')):
+    dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+    for filename in filenames:
+      matcher = re.match('^(?P<name>.*)\.(?:pan|tpl)$',filename)
+      if matcher:
+        profiles.add(matcher.group('name'))
+  return profiles
+
+def run_shard(name,cmd,env):
+  shard_slots.acquire()
+  try:
+    if shard_failed.isSet():
+      shard_results[name] = (None,'')
+      return
+    if ant_stdout_file == 'PIPE':
+      stdout_file = 'PIPE'
+    else:
+      stdout_file = '%s.%s' % (ant_stdout_file,re.sub('[^\w\.\-]','_',name))
+    debug(1,"Executing command: '%s'" % (' '.join(cmd)))
+    start_time = time.time()
+    try:
+      (retcode,output) = run_ant(cmd,env,stdout_file,False)
+    except OSError, detail:
+      (retcode,output) = (1,'Failed to execute ant command: %s' % (detail))
+    if metrics:
+      metrics['shards'][name] = time.time() - start_time
+    shard_results[name] = (retcode,output)
+    if retcode != 0:
+      shard_failed.set()
+    debug(1,'%s completed in %.1fs (status=%d)' % (name,time.time() - start_time,retcode))
+  finally:
+    shard_slots.release()
 
-ant_env = {}
-ant_env['JAVA_HOME'] = java_version
-if ant_opts:
-  debug(1,'Defining ANT_OPTS as "%s"' % (ant_opts))
-  ant_env['ANT_OPTS'] = ant_opts
+def run_shards(ant_cmd_args,env,profiles):
+  """ Compile each cluster with a separate ant process. profiles is the list of profiles
+      to compile or None to compile all of them. Raises DeployError if one failed. """
+  global shard_slots, shard_failed, shard_results
+  try:
+    clusters = list_clusters()
+  except OSError, detail:
+    raise DeployError('Failed to list clusters in %s: %s' % (clusters_dir,detail))
+  shards = []
+  for (group,cluster) in clusters:
+    name = '/'.join([component for component in [group,cluster] if component])
+    try:
+      cluster_profile_names = cluster_profiles(group,cluster)
+    except OSError, detail:
+      raise DeployError('Failed to list profiles of cluster %s: %s' % (name,detail))
+    if profiles is not None and cluster_profile_names.isdisjoint(profiles):
+      debug(1,'Cluster %s has no profile to compile' % (name))
+      continue
+    shard_cmd = [ ant_cmd_args[0], shard_compile_target, '-Dcluster.name=%s' % (cluster), '-Dclusters.groups.build.info=false' ]
+    if group:
+      shard_cmd.append('-Dcluster.group=%s' % (group))
+    shard_cmd.extend(ant_cmd_args[1:])
+    shards.append((len(cluster_profile_names),name,shard_cmd))
+  shards.sort(reverse=True)
+  debug(0,'Compiling %d clusters with %d concurrent ant processes' % (len(shards),shard_workers))
+  if shard_check_target:
+    shards.insert(0,(0,shard_check_target,[ ant_cmd_args[0], shard_check_target ]))
 
-if ant_stdout_file == 'PIPE':
-  ant_stdout = PIPE
-else:
-  # Unfortunatly flag 'r+' doesn't create the file if it doesn't exist. It is then
-  # necessary to reopen the file for reading.
-  ant_stdout = file(ant_stdout_file, 'w')
+  shard_slots = threading.Semaphore(shard_workers)
+  shard_failed = threading.Event()
+  shard_results = {}
+  shard_threads = []
+  for (profile_count,name,shard_cmd) in shards:
+    shard_thread = threading.Thread(target=run_shard,args=(name,shard_cmd,env))
+    shard_thread.start()
+    shard_threads.append(shard_thread)
+  for shard_thread in shard_threads:
+    shard_thread.join()
 
-debug(0,"Executing command: '%s'" % (' '.join(deploy_cmd)))
-try:
-  proc = Popen(deploy_cmd, shell=False, cwd=svn_cache, env=ant_env, stdout=ant_stdout, stderr=STDOUT)
-  retcode = proc.wait()
-  output = proc.communicate()[0]
-  if not ant_stdout == PIPE:
-    # Do not send back ant output if redirected to a file as it can be very large and tends to  cause
-    # problems with Python subprocess module.
+  failures = []
+  skipped_count = 0
+  for (profile_count,name,shard_cmd) in shards:
+    (retcode,output) = shard_results[name]
+    if retcode is None:
+      skipped_count += 1
+    elif retcode < 0:
+      failures.append('%s: ant command aborted by signal %d. Command output:\n%s' % (name,-retcode,output))
+    elif retcode > 0:
+      failures.append('%s: error during ant command (status=%d). Command output:\n%s' % (name,retcode,output))
+  if failures:
+    message = 'Compilation failed (%d ant processes), profiles not deployed' % (len(failures))
+    if skipped_count > 0:
+      message += ' (%d not started after the failure)' % (skipped_count)
+    raise DeployError('%s:\n%s' % (message,'\n'.join(failures)))
+
+# Profile publication.
+# Profiles (*.xml, *.json, optionally compressed) compiled in build_profiles are compared
+# with the ones in the deploy area: a profile is replaced only if its size or its SHA-1
+# hash differs, using a temporary file in the same directory renamed to the profile name
+# so that clients never see a partially written profile. profiles-info.xml is updated by
+# publish_notify_target. A profile is removed from the deploy area only if it was published
+# by a previous deployment (listed in published_list): profiles put there by other means
+# are left untouched.
+
+profile_file_matcher = re.compile('\.(?:xml|json)(?:\.gz)?$')
+
+def build_property(name,default):
+  """ Return the value of an ant property from the properties files read by quattor.build.xml, or default """
+  # The first file defining the property wins, as in ant
+  for properties_file in [ svn_cache + '/../quattor.deploy.properties', svn_cache + '/../quattor.build.properties',
+                           svn_cache + '/quattor.build.properties' ]:
+    try:
+      properties_fd = open(properties_file,'r')
+    except IOError:
+      continue
+    try:
+      for line in properties_fd:
+        matcher = re.match('^\s*%s\s*[=:]\s*(.*?)\s*$' % (re.escape(name)),line)
+        if matcher:
+          debug(1,'Property %s defined in %s' % (name,properties_file))
+          return matcher.group(1)
+    finally:
+      properties_fd.close()
+  return default
+
+def profiles_deploy_dir():
+  if deploy_profiles:
+    return deploy_profiles
+  # Same defaults as quattor.build.xml
+  deploy_base = build_property('deploy','deploy').replace('${basedir}',svn_cache)
+  if not re.match('^/',deploy_base):
+    deploy_base = svn_cache + '/' + deploy_base
+  deploy_dir = build_property('deploy.xml','${deploy}/xml').replace('${basedir}',svn_cache).replace('${deploy}',deploy_base)
+  if '${' in deploy_dir:
+    raise DeployError("Cannot determine the deploy area from deploy.xml property (%s): use option 'deploy_profiles'" % (deploy_dir))
+  if not re.match('^/',deploy_dir):
+    deploy_dir = svn_cache + '/' + deploy_dir
+  return deploy_dir
+
+def profile_files(profiles_dir):
+  """ Return the list of profiles in profiles_dir (path relative to profiles_dir) """
+  profiles = []
+  for (dirpath,dirnames,filenames) in os.walk(profiles_dir):
+    for filename in filenames:
+      if profile_file_matcher.search(filename) and filename != 'profiles-info.xml' and not filename.startswith('.'):
+        profiles.append(os.path.relpath(os.path.join(dirpath,filename),profiles_dir))
+  return profiles
+
+def file_hash(path):
+  file_sha1 = hashlib.sha1()
+  file_fd = open(path,'rb')
+  try:
+    for block in iter(lambda: file_fd.read(1024*1024),''):
+      file_sha1.update(block)
+  finally:
+    file_fd.close()
+  return file_sha1.hexdigest()
+
+def read_published_list():
+  """ Return the list of profiles published by the last deployment (empty if unknown) """
+  try:
+    list_fd = open(published_list,'r')
+  except IOError, detail:
+    if detail.errno == 2:
+      return []
+    raise
+  try:
+    return [ profile.rstrip('\n') for profile in list_fd if profile.strip() ]
+  finally:
+    list_fd.close()
+
+def write_profile_list(list_file,profiles):
+  if not os.path.isdir(os.path.dirname(list_file)):
+    os.makedirs(os.path.dirname(list_file),0755)
+  list_fd, list_tmp = tempfile.mkstemp(dir=os.path.dirname(list_file),prefix='.')
+  os.write(list_fd,''.join([profile + '\n' for profile in profiles]))
+  os.close(list_fd)
+  os.chmod(list_tmp,0644)
+  os.rename(list_tmp,list_file)
+
+def publish_profiles(deploy_dir):
+  """ Replace the profiles in deploy_dir whose content changed and remove the ones previously
+      published and no longer compiled. Returns a tuple (changed profiles,removed profiles). """
+  new_profiles = profile_files(build_profiles)
+  if len(new_profiles) == 0:
+    raise DeployError('No compiled profile found in %s: check option build_profiles' % (build_profiles))
+  changed = []
+  for profile in sorted(new_profiles):
+    source = os.path.join(build_profiles,profile)
+    destination = os.path.join(deploy_dir,profile)
+    if os.path.exists(destination) and os.path.getsize(source) == os.path.getsize(destination) and \
+       file_hash(source) == file_hash(destination):
+      continue
+    if not os.path.isdir(os.path.dirname(destination)):
+      os.makedirs(os.path.dirname(destination),0755)
+    profile_fd, profile_tmp = tempfile.mkstemp(dir=os.path.dirname(destination),prefix='.')
+    os.close(profile_fd)
+    try:
+      shutil.copyfile(source,profile_tmp)
+      os.chmod(profile_tmp,0644)
+      os.rename(profile_tmp,destination)
+    except (IOError,OSError):
+      os.remove(profile_tmp)
+      raise
+    changed.append(profile)
+  removed = sorted(set(read_published_list()) - set(new_profiles))
+  for profile in removed:
     try:
-      ant_stdout.close()
-      #ant_stdout = file(ant_stdout_file, 'r')
-      #output = ant_stdout.read()
-      output = "See %s on %s" % (ant_stdout_file,socket.getfqdn())
-    except:
-      debug(1,'Error reading ant output file(%s)' % (ant_stdout_file))
+      os.remove(os.path.join(deploy_dir,profile))
+    except OSError, detail:
+      if detail.errno != 2:
+        raise
+  write_profile_list(published_list,sorted(new_profiles))
+  return (changed,removed)
+
+def write_publish_manifest(profiles):
+  # An empty includesfile would select all the profiles: start with a pattern matching none
+  write_profile_list(publish_manifest,['**/.no-profile-affected'] + profiles)
+
+# Compile server.
+# ant main class is run by the Nailgun client in the compile server JVM. The client exit
+# status is the ant one, except for the following values reporting a Nailgun failure
+# after which ant is run in a new JVM:
+#  - 227 to 231: client errors (connection failed or broken, unexpected server answer)
+#  - 130 and 131: exit status 898 (class not found in the server) and 899 (exception
+#    in the server) sent by the server, truncated to 8 bits
+
+nailgun_errors = [ 130, 131, 227, 228, 229, 230, 231 ]
+
+def compile_server_running():
+  try:
+    server_socket = socket.create_connection((compile_server_host,compile_server_port),5)
+    server_socket.close()
+    return True
+  except socket.error:
+    return False
+
+def compile_server_available():
+  """ Return True if the compile server accepts connections, starting it if needed """
+  if compile_server_running():
+    return True
+  if not compile_server_start:
+    warning('Compile server (%s) is not running' % (compile_server))
+    return False
+  debug(0,"Starting compile server: '%s'" % (compile_server_start))
+  server_env = { 'JAVA_HOME':java_version, 'PATH':java_version + '/bin:/usr/bin:/bin' }
+  try:
+    server_stdout = open(compile_server_log,'a')
+    Popen(shlex.split(compile_server_start), shell=False, cwd='/', env=server_env, stdin=open(os.devnull,'r'),
+          stdout=server_stdout, stderr=STDOUT, close_fds=True, preexec_fn=os.setsid)
+    server_stdout.close()
+  except (IOError,OSError), detail:
+    warning('Failed to start compile server: %s' % (detail))
+    return False
+  start_time = time.time()
+  while time.time() - start_time < compile_server_timeout:
+    time.sleep(0.5)
+    if compile_server_running():
+      return True
+  warning('Compile server (%s) not accepting connections %d seconds after being started (see %s)' % (compile_server,compile_server_timeout,compile_server_log))
+  return False
+
+def launch_ant(cmd,env):
+  """ Run ant command cmd, in the compile server if possible. Returns an excerpt of the output. Raises DeployError in case of failure. """
+  retcode = None
+  if compile_server_client:
+    phase_start = time.time()
+    server_available = compile_server_available()
+    record_phase('compile_server',phase_start)
+    if server_available:
+      # ant launcher script is not used: ant.home must be defined explicitly
+      ant_home = os.path.dirname(os.path.dirname(cmd[0]))
+      server_cmd = [ compile_server_client, '--nailgun-server', compile_server_host, '--nailgun-port', str(compile_server_port),
+                     'org.apache.tools.ant.Main', '-Dant.home=%s' % (ant_home), '-buildfile', svn_cache + '/build.xml' ]
+      server_cmd.extend(cmd[1:])
+      debug(0,"Executing command: '%s'" % (' '.join(server_cmd)))
+      phase_start = time.time()
+      try:
+        (retcode,output) = run_ant(server_cmd,env)
+      except OSError, detail:
+        warning('Failed to execute compile server client: %s. Running ant in a new JVM...' % (detail))
+      record_phase('ant',phase_start)
+      if retcode in nailgun_errors:
+        warning('Compile server failure (status=%d). Running ant in a new JVM...' % (retcode))
+        retcode = None
+      elif retcode is not None and metrics:
+        metrics['compile_mode'] = 'server'
+
+  if retcode is None:
+    debug(0,"Executing command: '%s'" % (' '.join(cmd)))
+    phase_start = time.time()
+    try:
+      (retcode,output) = run_ant(cmd,env)
+    except OSError, detail:
+      raise DeployError('Failed to execute ant command: %s' % (detail))
+    finally:
+      record_phase('ant',phase_start)
+    if metrics:
+      metrics['compile_mode'] = 'jvm'
   if retcode < 0:
-      abort('ant command aborted by signal %d. Command output:\n%s' % (-retcode, output))
+    raise DeployError('ant command aborted by signal %d. Command output:\n%s' % (-retcode, output))
   elif retcode > 0:
-      abort('Error during ant command (status=%d). Script output:\n%s' % (retcode,output))
+    raise DeployError('Error during ant command (status=%d). Script output:\n%s' % (retcode,output))
+  return output
+
+def deploy_tag(tag,revision=None):
+  """ Switch SVN cache to tag and run ant to compile and deploy it. Raises DeployError in case of failure. """
+  global client
+
+  # Switch SVN cache to new tag
+
+  tag_url = repository_url + tags_branch + '/' + tag
+
+  debug(0, "Processing tag %s..." % (tag_url))
+  debug(0, "SVN cache: %s" % (svn_cache))
+
+  if not client:
+    client = pysvn.Client()
+    client.exception_style = 0
+
+  if prefetch_cache:
+    phase_start = time.time()
+    swap_prefetch_cache()
+    record_phase('prefetch_swap',phase_start)
+
+  # With delta_update, svn_cache tracks trunk at the revision the tag was created from
+  wc_url = tag_url
+  wc_revision = pysvn.Revision(pysvn.opt_revision_kind.head)
+  revision_number = 0
+  if delta_update:
+    phase_start = time.time()
+    revision_number = tag_revision(tag)
+    record_phase('svn_log',phase_start)
+    if revision_number:
+      wc_url = repository_url + trunk_branch
+      wc_revision = pysvn.Revision(pysvn.opt_revision_kind.number,revision_number)
+      debug(0,'Tag %s created from revision %d of %s' % (tag,revision_number,wc_url))
+    else:
+      warning('Tag %s is not a copy of %s: switching svn_cache to the tag' % (tag,trunk_branch))
+      revision_number = 0
+  (state_url,state_revision,state_sparse_paths) = read_svn_cache_state(svn_cache_state)
+
+  # If svn_cache exists, check it is valid, else delete it.
+  wc_info = None
+  if os.path.isdir(svn_cache) and os.access(svn_cache,os.W_OK):
+    phase_start = time.time()
+    try:
+      debug(1,'Checking %s is a valid SVN working copy' % (svn_cache))
+      wc_info = client.info(svn_cache)
+    except pysvn.ClientError, e:
+      warning("%s is not a valid SVN working copy. Deleting and checking out again..." % (svn_cache))
+      shutil.rmtree(svn_cache)
+    record_phase('svn_info',phase_start)
+
+  # If svn_cache doesn't exist, do a checkout
+  new_checkout = False
+  if not os.path.isdir(svn_cache):
+    new_checkout = True
+    phase_start = time.time()
+    try:
+      debug(0,"Checking out %s into %s (depth=%s)" % (wc_url,svn_cache,checkout_depth))
+      client.checkout(path=svn_cache,url=wc_url,revision=wc_revision,depth=getattr(pysvn.depth,checkout_depth))
+      apply_sparse_paths(svn_cache,wc_revision)
+    except pysvn.ClientError, e:
+      debug(1,'Error during checkout of %s. Trying to continue' % wc_url)
+    record_phase('svn_checkout',phase_start)
+
+  # Fast path: update only the paths changed since the previous deployment
+  updated = False
+  if revision_number and not new_checkout and wc_info and wc_info['url'] == wc_url and \
+     state_url == wc_url and state_revision and state_sparse_paths == sparse_paths:
+    phase_start = time.time()
+    try:
+      debug(0,'Updating svn_cache from revision %d to revision %d' % (state_revision,revision_number))
+      updated_count = update_changed_paths(wc_url,state_revision,revision_number)
+      debug(0,'%d paths updated in svn_cache' % (updated_count))
+      updated = True
+    except pysvn.ClientError, e:
+      warning('Failed to update svn_cache to revision %d: %s. Switching to tag...' % (revision_number,e))
+    record_phase('svn_update',phase_start)
+
+  # Switch to new tag (or trunk revision the tag was created from).
+  # Do also after an initial checkout as it may allow to complete a failed check out.
+  # Retry switch in case of errors as specified by switch_retry_count
+  switch_failed = not updated
+  phase_start = time.time()
+  i = 1
+  while switch_failed and i <= switch_retry_count:
+    if i > 1 and switch_failed:
+      debug(1,'Switch to tag %s failed. Retrying (%d/%d)...' % (tag,i,switch_retry_count))
+    else:
+      debug(0,'Switching to tag %s (url=%s)' % (tag,wc_url))
+    switch_failed = False
+    try:
+      client.switch(path=svn_cache,url=wc_url,revision=wc_revision)
+      if not new_checkout and state_sparse_paths != sparse_paths:
+        apply_sparse_paths(svn_cache,wc_revision)
+    except pysvn.ClientError, e:
+      switch_failed = True
+      last_error = e
+    i += 1
+  if not updated:
+    record_phase('svn_switch',phase_start)
+  if switch_failed:
+    raise DeployError('Failed to switch SVN cache to new tag: %s' % (last_error))
+  write_svn_cache_state(svn_cache_state,wc_url,revision_number)
+
+
+  # Compile and deploy
+
+  if not re.match(ant_cmd,'^/'):
+    tag_ant_cmd = svn_cache + '/' + ant_cmd
   else:
-      debug(1,'Tag %s deployed successfully. Script output:\n%s' % (tag,output))
-except OSError, detail:
-  abort('Failed to execute ant command: %s' % (detail))  
+    tag_ant_cmd = ant_cmd
 
+  if not os.path.exists(tag_ant_cmd) or not os.access(tag_ant_cmd,os.X_OK):
+    raise DeployError("ant (%s) not found. Use option 'ant_cmd' to specify another location." % (tag_ant_cmd))
+  
+  deploy_cmd = [ tag_ant_cmd ]
+  deploy_cmd.append(ant_target)
 
-# Remove lock file
+  profiles = None
+  if incremental_build:
+    last_tag = read_last_tag()
+    if last_tag:
+      phase_start = time.time()
+      profiles = affected_profiles(last_tag,tag)
+      record_phase('svn_diff',phase_start)
+    else:
+      debug(1,'Last tag deployed unknown')
+      profiles = None
+    if profiles is None:
+      debug(0,'Incremental build not possible: compiling all profiles')
+    else:
+      # An empty pattern list would select all the profiles
+      profile_patterns = ['**/.no-profile-affected']
+      for profile in profiles:
+        profile_patterns.append('**/%s.pan' % (profile))
+        profile_patterns.append('**/%s.tpl' % (profile))
+      deploy_cmd.append('-Dpan.profiles.includes=%s' % (','.join(profile_patterns)))
 
-try:
-  os.remove(lock_file)
-except OSError, detail:
-  if detail.errno != 2:
-    warning('Failed to delete lock file (%s): %s' % (lock_file,detail))
+  ant_env = {}
+  ant_env['JAVA_HOME'] = java_version
+  if ant_opts:
+    debug(1,'Defining ANT_OPTS as "%s"' % (ant_opts))
+    ant_env['ANT_OPTS'] = ant_opts
+
+  # Sharded build: compile clusters concurrently, then only deploy and notify.
+  # With publish, profiles are compiled first, then published and only changed ones notified.
+  if shard_workers > 0:
+    phase_start = time.time()
+    try:
+      run_shards(deploy_cmd[:1] + deploy_cmd[2:],ant_env,profiles)
+    finally:
+      record_phase('ant_shards',phase_start)
+    deploy_cmd = [ tag_ant_cmd, shard_notify_target ]
+
+  if publish:
+    deploy_dir = profiles_deploy_dir()
+    if shard_workers == 0:
+      launch_ant([ tag_ant_cmd, publish_compile_target ] + deploy_cmd[2:],ant_env)
+    debug(0,'Publishing profiles in %s' % (deploy_dir))
+    phase_start = time.time()
+    try:
+      (changed,removed) = publish_profiles(deploy_dir)
+      write_publish_manifest(changed)
+    except (IOError,OSError), detail:
+      raise DeployError('Failed to publish profiles in %s: %s' % (deploy_dir,detail))
+    finally:
+      record_phase('publish',phase_start)
+    debug(0,'%d profiles changed, %d profiles removed (manifest: %s)' % (len(changed),len(removed),publish_manifest))
+    if metrics:
+      metrics['profiles_changed'] = len(changed)
+      metrics['profiles_removed'] = len(removed)
+    deploy_cmd = [ tag_ant_cmd, publish_notify_target, '-Ddeploy.xml=%s' % (deploy_dir), '-Dnotify.includesfile=%s' % (publish_manifest) ]
+    # Clients whose profile was removed are no longer managed: nothing to notify.
+    # profiles-info.xml must be updated anyway (profiles removed).
+    if len(changed) == 0:
+      debug(0,'No profile changed: updating profiles-info.xml without notifying clients')
+      deploy_cmd.append('-Dnotify.skip=true')
+
+  output = launch_ant(deploy_cmd,ant_env)
+  debug(1,'Tag %s deployed successfully. Script output:\n%s' % (tag,output))
+  write_last_tag(tag,revision)
 
+
+# Deployment queue.
+# Each queued tag is a file in queue_dir containing the tag name and, on a second line,
+# its revision if specified with --revision. File names are based
+# on the time the tag was queued. Temporary files used to create entries atomically
+# start with a '.'. As post-commit hooks may queue tags in a different order than they
+# were created, the most recent tag is the one with the highest name (tags are named
+# after their creation time, see svn.tag.format in quattor.build.xml), not the last one
+# queued. A tag older than the last tag deployed is never deployed by the worker: it is
+# a tag queued late, not a rollback (done by running this script directly).
+
+def tag_sort_key(tag):
+  """ Return a key ordering tags by creation time (numbers in the tag name) """
+  return ([int(number) for number in re.findall('[0-9]+',tag)],tag)
+
+def superseded_tag(tag):
+  """ Return the last tag deployed if it is more recent than tag, else None """
+  last_tag = read_last_tag()
+  if last_tag and tag_sort_key(tag) < tag_sort_key(last_tag):
+    return last_tag
+  return None
+
+def queue_entries():
+  try:
+    entries = [entry for entry in os.listdir(queue_dir) if not entry.startswith('.')]
+  except OSError, detail:
+    if detail.errno == 2:
+      return []
+    raise
+  entries.sort()
+  return entries
+
+def enqueue_tag(tag,revision=None):
+  if not os.path.isdir(queue_dir):
+    os.makedirs(queue_dir,0755)
+  entry_fd, entry_tmp = tempfile.mkstemp(dir=queue_dir,prefix='.')
+  os.write(entry_fd,tag + '\n')
+  if revision:
+    os.write(entry_fd,revision + '\n')
+  os.close(entry_fd)
+  os.rename(entry_tmp,os.path.join(queue_dir,'%017.6f-%d' % (time.time(),os.getpid())))
+
+def dequeue_tag():
+  """ Return a tuple (tag,revision,time queued) for the most recent queued tag and remove
+      all the queued tags from the queue, or (None,None,None) if the queue is empty. """
+  entries = queue_entries()
+  if len(entries) == 0:
+    return (None,None,None)
+  tags = []
+  for entry in entries:
+    entry_path = os.path.join(queue_dir,entry)
+    entry_fd = open(entry_path,'r')
+    tags.append((entry_fd.readline().rstrip(),entry_fd.readline().rstrip() or None,float(entry.split('-')[0])))
+    entry_fd.close()
+    os.remove(entry_path)
+  tags.sort(key=lambda (tag,revision,queued_time): tag_sort_key(tag))
+  for (skipped_tag,skipped_revision,queued_time) in tags[:-1]:
+    debug(0,'Skipping tag %s superseded by tag %s' % (skipped_tag,tags[-1][0]))
+  return tags[-1]
+
+def start_worker():
+  worker_cmd = [ sys.executable, this_script, '--config', options.config_file, '--worker' ]
+  if options.verbosity:
+    worker_cmd.append('-' + 'v' * options.verbosity)
+  debug(1,"Starting deployment worker: '%s'" % (' '.join(worker_cmd)))
+  # The worker must not inherit stdin/stdout/stderr else the caller (e.g. ssh)
+  # would wait for its completion.
+  worker_stdout = open(worker_log,'a')
+  Popen(worker_cmd, shell=False, stdin=open(os.devnull,'r'), stdout=worker_stdout, stderr=STDOUT,
+        close_fds=True, preexec_fn=os.setsid)
+  worker_stdout.close()
+
+
+if options.prefetch:
+  client = pysvn.Client()
+  client.exception_style = 0
+  prefetch()
+
+elif options.queue:
+  try:
+    enqueue_tag(tag,options.revision)
+  except (IOError,OSError), detail:
+    abort('Failed to queue tag %s in %s: %s' % (tag,queue_dir,detail))
+  debug(0,'Tag %s queued for deployment' % (tag))
+  # Lets the caller (post-commit.py) know which of the tags it queued have been deployed
+  (last_tag,last_revision) = read_last_deployed()
+  if last_revision:
+    debug(0,'Last tag deployed: %s (revision %s)' % (last_tag,last_revision))
+  elif last_tag:
+    debug(0,'Last tag deployed: %s' % (last_tag))
+  # If a worker is running, it will process the new entry when the current deployment
+  # completes (it checks the queue again after releasing the lock).
+  worker_pid = lock_owner()
+  if worker_pid:
+    debug(1,'Deployment worker already running (pid=%s)' % (worker_pid))
+  else:
+    try:
+      start_worker()
+    except (IOError,OSError), detail:
+      abort('Failed to start deployment worker: %s' % (detail))
+
+elif options.worker:
+  while True:
+    if not acquire_lock():
+      debug(1,'Deployment worker already running. Exiting.')
+      break
+    while True:
+      try:
+        (tag,revision,queued_time) = dequeue_tag()
+      except (IOError,OSError), detail:
+        abort('Failed to read deployment queue (%s): %s' % (queue_dir,detail))
+      if not tag:
+        break
+      last_tag = superseded_tag(tag)
+      if last_tag:
+        warning('Skipping tag %s: more recent tag %s already deployed' % (tag,last_tag))
+        continue
+      if init_mail_handler:
+        mail_handler.subject = notif_subject % (tag)
+      start_metrics(tag,queued_time)
+      try:
+        deploy_tag(tag,revision)
+      except DeployError, detail:
+        write_metrics('failure')
+        logger.error("Failed to deploy tag %s:\n%s" % (tag,detail))
+      else:
+        write_metrics('success')
+    release_lock()
+    # A tag queued after the queue was found empty, but before the lock was released,
+    # didn't start a new worker: process it.
+    if len(queue_entries()) == 0:
+      break
+
+else:
+  # Ensure there is not another instance of the script already running.
+  if not acquire_lock():
+    abort("%s already running (pid=%s). Retry later..." % (this_script,lock_owner()))
+  start_metrics(tag)
+  try:
+    deploy_tag(tag)
+  except DeployError, detail:
+    write_metrics('failure')
+    abort(str(detail))
+  write_metrics('success')
+  release_lock()
@@ -0,0 +1,449 @@
+#!/usr/bin/python
+
+"""
+Daemon used to run SCDB deployments asynchronously.
+
+The SVN post-commit hook (post-commit.py with option async_deploy) sends the
+revision of each SCDB tag to this daemon through a Unix socket and returns
+immediately. The daemon then runs 'post-commit.py --sync' for the revision, which
+does the deployment and the email notification in case of errors. When several
+tags are received during a deployment, only the most recent one is deployed.
+
+Deployment progress and results can be displayed with --status.
+
+Requests are lines of text sent to the socket:
+  deploy REPOS-PATH REV TAG   Queue the deployment of tag TAG created by revision REV
+  status [REV]                Return the deployment history (or the output of the
+                              deployment of revision REV)
+
+Requests are accepted only from the users listed in allowed_users (and root or the
+user running the daemon), identified by the credentials of the socket peer. Only the
+repository specified in the configuration (option repository) is deployed: requests
+for another REPOS-PATH are rejected.
+"""
+
+__version__ = "1.0.3"
+__author__  = "Michel Jouvin <jouvin@lal.in2p3.fr>"
+
+
+import sys
+import os
+import re
+import time
+import socket
+import SocketServer
+import threading
+import signal
+import struct
+import pwd
+import grp
+from subprocess import *
+import StringIO
+import logging
+import logging.handlers
+import syslog
+from optparse import OptionParser
+import ConfigParser
+
+
+# Initializations
+this_script = os.path.abspath(sys.argv[0])
+verbosity = 0
+logger = None
+socket_created = False
+
+config_file_default = '/etc/quattor-deploy.conf'
+config_sections = { 'daemon':'deploy-daemon' }
+config_defaults = StringIO.StringIO("""
+# Options commented out are configuration options available for which no
+# sensible default value can be defined.
+[deploy-daemon]
+# Unix socket used by post-commit.py to send deployment requests.
+# post-commit.py reads this option too.
+socket: /var/run/quattor-deploy.sock
+# Permissions and group of the socket. It must be writable by the user running the
+# SVN hooks, e.g. through the group. Empty group means the group of the daemon user.
+socket_mode: 0660
+socket_group:
+# Space-separated list of users allowed to send requests (in addition to root and the
+# user running the daemon), typically the user running the SVN hooks.
+#allowed_users: apache
+allowed_users:
+# Local path of the SCDB SVN repository (as passed to the SVN post-commit hook).
+# Requests for another repository are rejected. Required parameter without default value.
+#repository: /var/svn/scdb
+# Script used to run the deployment. If not starting with /, relative to this script directory.
+post_commit_script: post-commit.py
+# Number of deployments kept in the history returned by --status
+history_size: 50
+# Log operations in this file
+log_file: /tmp/quattor-deploy-daemon.log
+# Verbosity level
+verbose: 0
+""")
+
+def abort(msg):
+    logger.error("deploy-daemon.py script failed:\n%s" % (msg))
+    if socket_created:
+      try:
+        os.remove(socket_path)
+      except OSError, detail:
+        if detail.errno != 2:
+          logger.warning('Failed to delete socket (%s): %s' % (socket_path,detail))
+    sys.exit(2)
+
+def debug(level,msg):
+  if level <= verbosity:
+    if level == 0:
+      logger.info(msg)
+    else:
+      logger.debug(msg)
+
+def format_time(timestamp):
+  if timestamp:
+    return time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(timestamp))
+  else:
+    return '-'
+
+
+# Deployment requests received, with their state (queued, running, succeeded,
+# failed or superseded). Requests are kept in history until history_size more
+# recent requests have been received.
+
+class Deployment:
+  def __init__(self,repos_path,revision,tag):
+    self.repos_path = repos_path
+    self.revision = revision
+    self.tag = tag
+    self.state = 'queued'
+    self.queued = time.time()
+    self.started = None
+    self.ended = None
+    self.status = None
+    self.output = ''
+
+  def summary(self):
+    if self.status is None:
+      status = '-'
+    else:
+      status = str(self.status)
+    return "%8d  %-20s  %-10s  %-19s  %-19s  %-19s  %s" % (self.revision,self.tag,self.state,format_time(self.queued),
+                                                         format_time(self.started),format_time(self.ended),status)
+
+class DeploymentQueue:
+  def __init__(self,history_size):
+    self.condition = threading.Condition()
+    self.history_size = history_size
+    self.history = []
+    self.pending = []
+    self.last_revision = 0
+
+  def add(self,deployment):
+    self.condition.acquire()
+    try:
+      self.history.append(deployment)
+      if len(self.history) > self.history_size:
+        self.history = self.history[-self.history_size:]
+      self.pending.append(deployment)
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def next(self):
+    """ Wait for a pending deployment and return the most recent one. Older pending ones are superseded. """
+    self.condition.acquire()
+    try:
+      while len(self.pending) == 0:
+        # A timeout is needed for the wait to be interruptible
+        self.condition.wait(60)
+      self.pending.sort(key=lambda deployment: deployment.revision)
+      deployment = self.pending.pop()
+      for superseded in self.pending:
+        superseded.state = 'superseded'
+        debug(0,'Tag %s (revision %d) superseded by tag %s (revision %d)' % (superseded.tag,superseded.revision,deployment.tag,deployment.revision))
+      self.pending = []
+      if deployment.revision < self.last_revision:
+        deployment.state = 'superseded'
+        debug(0,'Tag %s (revision %d) superseded by revision %d already deployed' % (deployment.tag,deployment.revision,self.last_revision))
+        return None
+      self.last_revision = deployment.revision
+      deployment.state = 'running'
+      deployment.started = time.time()
+      return deployment
+    finally:
+      self.condition.release()
+
+  def status(self,revision=None):
+    self.condition.acquire()
+    try:
+      if revision is None:
+        lines = ["%8s  %-20s  %-10s  %-19s  %-19s  %-19s  %s" % ('revision','tag','state','queued','started','ended','status')]
+        for deployment in self.history:
+          lines.append(deployment.summary())
+        return '\n'.join(lines) + '\n'
+      for deployment in reversed(self.history):
+        if deployment.revision == revision:
+          return deployment.summary() + '\n' + deployment.output
+      return 'Revision %d not found in deployment history\n' % (revision)
+    finally:
+      self.condition.release()
+
+
+def deployment_worker(queue):
+  while True:
+    deployment = queue.next()
+    if not deployment:
+      continue
+    deploy_cmd = [ post_commit_script, '--config', options.config_file, '--sync', deployment.repos_path, str(deployment.revision) ]
+    debug(0,"Deploying tag %s (revision %d): '%s'" % (deployment.tag,deployment.revision,' '.join(deploy_cmd)))
+    try:
+      proc = Popen(deploy_cmd, shell=False, stdin=open(os.devnull,'r'), stdout=PIPE, stderr=STDOUT, close_fds=True)
+      output = proc.communicate()[0]
+      retcode = proc.returncode
+    except OSError, detail:
+      output = 'Failed to execute %s: %s\n' % (post_commit_script,detail)
+      retcode = -1
+    queue.condition.acquire()
+    try:
+      deployment.ended = time.time()
+      deployment.status = retcode
+      deployment.output = output
+      if retcode == 0:
+        deployment.state = 'succeeded'
+      else:
+        deployment.state = 'failed'
+    finally:
+      queue.condition.release()
+    if retcode == 0:
+      debug(0,'Tag %s (revision %d) deployed successfully' % (deployment.tag,deployment.revision))
+    else:
+      # Email notification of the error is done by post-commit.py
+      logger.error('Failed to deploy tag %s (revision %d), status=%d. Output:\n%s' % (deployment.tag,deployment.revision,retcode,output))
+
+
+# Linux socket option returning the credentials (pid, uid, gid) of a Unix socket peer
+SO_PEERCRED = getattr(socket,'SO_PEERCRED',17)
+
+def repository_dir(repos_path):
+  """ Return the normalized local path of a repository path or file:// URL """
+  return os.path.realpath(re.sub('^file://','',repos_path))
+
+class DeployRequestHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    request_line = self.rfile.readline(1024)
+    credentials = self.request.getsockopt(socket.SOL_SOCKET,SO_PEERCRED,struct.calcsize('3i'))
+    (peer_pid,peer_uid,peer_gid) = struct.unpack('3i',credentials)
+    if peer_uid not in allowed_uids:
+      logger.warning('Request from unauthorized user (uid=%d, pid=%d) rejected' % (peer_uid,peer_pid))
+      self.wfile.write('error permission denied\n')
+      return
+    # A line without newline was truncated: the request must not be processed partially
+    if not request_line.endswith('\n'):
+      self.wfile.write('error invalid request\n')
+      return
+    request = request_line.split()
+    if len(request) == 4 and request[0] == 'deploy':
+      (repos_path,revision,tag) = request[1:]
+      if not re.match('^[0-9]+$',revision) or not re.match('^[0-9\.\-]+(?:/[0-9\.\-]+)*$',tag):
+        self.wfile.write('error invalid deploy request\n')
+        return
+      if repository_dir(repos_path) != repository:
+        logger.warning('Deployment request for repository %s rejected (uid=%d): only %s is deployed' % (repos_path,peer_uid,repository))
+        self.wfile.write('error invalid repository\n')
+        return
+      debug(0,'Deployment of tag %s (revision %s) queued' % (tag,revision))
+      self.server.queue.add(Deployment(repository,int(revision),tag))
+      self.wfile.write('queued %s %s\n' % (revision,tag))
+    elif len(request) in (1,2) and request[0] == 'status':
+      revision = None
+      if len(request) == 2:
+        if not re.match('^[0-9]+$',request[1]):
+          self.wfile.write('error invalid revision\n')
+          return
+        revision = int(request[1])
+      self.wfile.write(self.server.queue.status(revision))
+    else:
+      self.wfile.write('error unknown request\n')
+
+class DeployServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+
+def send_request(socket_path,request):
+  """ Send a request to the daemon and return its answer """
+  client_socket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+  try:
+    client_socket.connect(socket_path)
+    client_socket.sendall(request + '\n')
+    client_socket.shutdown(socket.SHUT_WR)
+    answer = ''
+    while True:
+      data = client_socket.recv(65536)
+      if not data:
+        break
+      answer += data
+  finally:
+    client_socket.close()
+  return answer
+
+def terminate(signum,frame):
+  sys.exit(0)
+
+
+# Configure loggers and handlers
+
+logging_source = 'quattor-deploy-daemon'
+logger = logging.getLogger(logging_source)
+logger.setLevel(logging.DEBUG)
+
+fmt=logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+terminal_handler = logging.StreamHandler()
+terminal_handler.setLevel(logging.DEBUG)
+terminal_handler.setFormatter(fmt)
+logger.addHandler(terminal_handler)
+
+
+parser = OptionParser()
+parser.add_option('--config', dest='config_file', action='store', default=config_file_default, help='Name of the configuration file to use')
+parser.add_option('-v', '--debug', '--verbose', dest='verbosity', action='count', default=0, help='Increase verbosity level for debugging (on stderr)')
+parser.add_option('--version', dest='version', action='store_true', default=False, help='Display various information about this script')
+parser.add_option('--status', dest='status', action='store_true', default=False, help='Display deployment history (or output of the deployment of REV if specified)')
+parser.add_option('--detach', dest='detach', action='store_true', default=False, help='Run in the background')
+options, args = parser.parse_args()
+
+if options.version:
+  debug (0,"Version %s written by %s" % (__version__,__author__))
+  debug (0,__doc__)
+  sys.exit(0)
+
+if options.verbosity:
+  verbosity = options.verbosity
+
+# The configuration file is passed to post_commit_script, run from / with --detach
+options.config_file = os.path.abspath(options.config_file)
+
+
+# Read configuration file.
+
+config = ConfigParser.ConfigParser()
+config.readfp(config_defaults)
+try:
+  config.readfp(open(options.config_file))
+except IOError, (errno,errmsg):
+  if errno == 2:
+    debug(1,'Configuration file (%s) is missing. Using default values.' % (options.config_file))
+  else:
+    abort('Error opening configuration file (%s): %s (errno=%s)' % (options.config_file,errmsg,errno))
+
+try:
+  section = config_sections['daemon']
+  option_name = 'verbose'
+  config_verbose = config.getint(section,option_name)
+  option_name = 'history_size'
+  history_size = config.getint(section,option_name)
+  option_name = 'socket_mode'
+  socket_mode = int(config.get(section,option_name),8)
+except ValueError:
+  abort("Invalid value specified for '%s' (section %s)" % (option_name,section))
+if config_verbose > verbosity:
+  verbosity = config_verbose
+
+socket_path = config.get(section,'socket')
+socket_group = config.get(section,'socket_group')
+post_commit_script = config.get(section,'post_commit_script')
+log_file = config.get(section,'log_file')
+if not re.match('^/',post_commit_script):
+  post_commit_script = os.path.dirname(this_script) + '/' + post_commit_script
+
+
+if options.status:
+  if len(args) > 0:
+    request = 'status %s' % (args[0])
+  else:
+    request = 'status'
+  try:
+    sys.stdout.write(send_request(socket_path,request))
+  except socket.error, detail:
+    abort('Failed to contact deployment daemon (socket %s): %s' % (socket_path,detail))
+  sys.exit(0)
+
+
+try:
+  repository = repository_dir(config.get(section,'repository'))
+except ConfigParser.NoOptionError:
+  abort("Required option 'repository' (section %s) missing in configuration file (%s)" % (section,options.config_file))
+
+allowed_uids = set([ 0, os.getuid() ])
+for allowed_user in config.get(section,'allowed_users').split():
+  try:
+    allowed_uids.add(pwd.getpwnam(allowed_user).pw_uid)
+  except KeyError:
+    abort("Invalid user in 'allowed_users' (section %s): %s" % (section,allowed_user))
+
+if socket_group:
+  try:
+    socket_gid = grp.getgrnam(socket_group).gr_gid
+  except KeyError:
+    abort("Invalid group specified for 'socket_group' (section %s): %s" % (section,socket_group))
+else:
+  socket_gid = -1
+
+syslog_handler = logging.handlers.SysLogHandler('/dev/log')
+syslog_handler.setLevel(logging.WARNING)
+logger.addHandler(syslog_handler)
+
+logfile_handler = logging.handlers.RotatingFileHandler(log_file,'a',100000,10)
+logfile_handler.setLevel(logging.DEBUG)
+logfile_handler.setFormatter(fmt)
+logger.addHandler(logfile_handler)
+
+# Remove the socket left by a previous instance, unless it is still running.
+if os.path.exists(socket_path):
+  try:
+    send_request(socket_path,'status')
+    abort('Deployment daemon already running (socket %s)' % (socket_path))
+  except socket.error:
+    debug(1,'Removing stale socket %s' % (socket_path))
+    os.remove(socket_path)
+
+try:
+  # The socket must not be accessible before its permissions are set
+  umask = os.umask(0177)
+  try:
+    server = DeployServer(socket_path,DeployRequestHandler)
+  finally:
+    os.umask(umask)
+  socket_created = True
+  os.chown(socket_path,-1,socket_gid)
+  os.chmod(socket_path,socket_mode)
+except (socket.error,OSError), detail:
+  abort('Failed to create socket %s: %s' % (socket_path,detail))
+server.queue = DeploymentQueue(history_size)
+
+if options.detach:
+  if os.fork() > 0:
+    os._exit(0)
+  os.setsid()
+  if os.fork() > 0:
+    os._exit(0)
+  os.chdir('/')
+  devnull_fd = os.open(os.devnull,os.O_RDWR)
+  for fd in range(3):
+    os.dup2(devnull_fd,fd)
+  logger.removeHandler(terminal_handler)
+
+signal.signal(signal.SIGTERM,terminate)
+
+worker = threading.Thread(target=deployment_worker,args=(server.queue,))
+worker.setDaemon(True)
+worker.start()
+
+debug(0,'Deployment daemon listening on %s' % (socket_path))
+try:
+  server.serve_forever()
+finally:
+  try:
+    os.remove(socket_path)
+  except OSError:
+    pass
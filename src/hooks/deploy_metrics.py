@@ -0,0 +1,82 @@
+"""
+Deployment metrics shared by build-tag.py and post-commit.py.
+
+A deployment is described by a dict (metrics) with at least 'script' and 'start' (time
+of the start of the deployment) keys and one dict of timings (durations in seconds)
+per kind of timer, e.g. 'phases'. At the end of the deployment, it is written as one
+JSON line in a log file and optionally sent to a StatsD server and written to a
+Prometheus textfile (node_exporter textfile collector). Failures to write metrics
+are only reported as warnings.
+"""
+
+import os
+import re
+import time
+import json
+import socket
+import tempfile
+
+def record_phase(metrics,phase,start_time):
+  """ Add the time elapsed since start_time to the duration of phase """
+  if metrics:
+    metrics['phases'][phase] = metrics['phases'].get(phase,0) + time.time() - start_time
+
+def prometheus_label(value):
+  return value.replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def write_metrics(metrics,status,timer_kinds,metrics_log,metrics_statsd,metrics_textfile,metrics_prefix,logger):
+  """ Write metrics of a deployment whose result is status. timer_kinds is a list of
+      tuples (kind,key) where key is the entry of metrics with the timings of kind. """
+  end_time = time.time()
+  metrics['status'] = status
+  metrics['duration'] = round(end_time - metrics['start'],3)
+  metrics['start'] = time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(metrics['start']))
+  timers = []
+  for (kind,key) in timer_kinds:
+    timings = metrics[key]
+    for name in sorted(timings.keys()):
+      timings[name] = round(timings[name],3)
+      timers.append((kind,name,timings[name]))
+
+  if metrics_log:
+    try:
+      metrics_fd = open(metrics_log,'a')
+      metrics_fd.write(json.dumps(metrics,sort_keys=True) + '\n')
+      metrics_fd.close()
+    except IOError, detail:
+      logger.warning('Failed to write metrics to %s: %s' % (metrics_log,detail))
+
+  if metrics_statsd:
+    statsd_lines = [ '%s.%s.%s:%d|ms' % (metrics_prefix,kind,re.sub('[^\w\-]','_',name),duration*1000) for (kind,name,duration) in timers ]
+    statsd_lines.append('%s.deployment.duration:%d|ms' % (metrics_prefix,metrics['duration']*1000))
+    statsd_lines.append('%s.deployment.%s:1|c' % (metrics_prefix,status))
+    try:
+      (statsd_host,statsd_port) = metrics_statsd.rsplit(':',1)
+      statsd_socket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+      statsd_socket.sendto('\n'.join(statsd_lines),(statsd_host,int(statsd_port)))
+      statsd_socket.close()
+    except (socket.error,ValueError), detail:
+      logger.warning('Failed to send metrics to StatsD server %s: %s' % (metrics_statsd,detail))
+
+  if metrics_textfile:
+    script_label = 'script="%s"' % (metrics['script'])
+    prom_lines = []
+    for (kind,name,duration) in timers:
+      if len(prom_lines) == 0 or not prom_lines[-1].startswith('%s_%s_seconds' % (metrics_prefix,kind)):
+        prom_lines.append('# TYPE %s_%s_seconds gauge' % (metrics_prefix,kind))
+      prom_lines.append('%s_%s_seconds{%s,%s="%s"} %.3f' % (metrics_prefix,kind,script_label,kind,prometheus_label(name),duration))
+    prom_lines.append('# TYPE %s_duration_seconds gauge' % (metrics_prefix))
+    prom_lines.append('%s_duration_seconds{%s} %.3f' % (metrics_prefix,script_label,metrics['duration']))
+    prom_lines.append('# TYPE %s_last_success gauge' % (metrics_prefix))
+    prom_lines.append('%s_last_success{%s} %d' % (metrics_prefix,script_label,status == 'success'))
+    prom_lines.append('# TYPE %s_last_timestamp_seconds gauge' % (metrics_prefix))
+    prom_lines.append('%s_last_timestamp_seconds{%s} %d' % (metrics_prefix,script_label,end_time))
+    try:
+      # node_exporter must not read a partially written file
+      prom_fd, prom_tmp = tempfile.mkstemp(dir=os.path.dirname(metrics_textfile),prefix='.')
+      os.write(prom_fd,'\n'.join(prom_lines) + '\n')
+      os.close(prom_fd)
+      os.chmod(prom_tmp,0644)
+      os.rename(prom_tmp,metrics_textfile)
+    except (IOError,OSError), detail:
+      logger.warning('Failed to write metrics to %s: %s' % (metrics_textfile,detail))
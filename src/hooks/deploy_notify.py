@@ -0,0 +1,127 @@
+"""
+Email notifications shared by post-commit.py and build-tag.py.
+"""
+
+import os
+import time
+import json
+import fcntl
+import tempfile
+import logging
+import logging.handlers
+from subprocess import Popen, STDOUT
+
+# The following handler doesn't send emails itself: messages are added to the spool
+# file and a detached process (sender_cmd, normally the calling script run with an
+# option calling send_spool()) sends them, waiting for min_interval seconds after the
+# last email sent. All the messages
+# added in the meantime are sent in one digest email. The spool file is protected by
+# a lock (spool.lock). A sender holds a second lock (spool.sender) while it is running
+# and exits only after finding the spool empty, releasing it before the spool lock: a
+# sender is started when this lock is free after a message has been added to the spool.
+class DigestMailHandler(logging.handlers.SMTPHandler):
+  def __init__(self,mailhost,fromaddr,toaddrs,subject,spool,min_interval,digest_max,sender_cmd):
+    logging.handlers.SMTPHandler.__init__(self,mailhost,fromaddr,toaddrs,subject)
+    self.sender_cmd = sender_cmd
+    self.spool = spool
+    self.min_interval = min_interval
+    self.digest_max = digest_max
+
+  def read_spool(self):
+    try:
+      spool_fd = open(self.spool,'r')
+      try:
+        return json.load(spool_fd)
+      finally:
+        spool_fd.close()
+    except IOError, detail:
+      if detail.errno != 2:
+        raise
+    except ValueError:
+      pass
+    return { 'last_sent':0, 'messages':[], 'dropped':0 }
+
+  def write_spool(self,spool_state):
+    spool_fd, spool_tmp = tempfile.mkstemp(dir=os.path.dirname(self.spool),prefix='.')
+    os.write(spool_fd,json.dumps(spool_state))
+    os.close(spool_fd)
+    os.rename(spool_tmp,self.spool)
+
+  def lock_file(self,suffix,blocking=True):
+    lock_fd = open(self.spool + suffix,'w')
+    try:
+      if blocking:
+        fcntl.flock(lock_fd,fcntl.LOCK_EX)
+      else:
+        fcntl.flock(lock_fd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+    except IOError:
+      lock_fd.close()
+      return None
+    return lock_fd
+
+  def emit(self,record):
+    try:
+      lock_fd = self.lock_file('.lock')
+      try:
+        spool_state = self.read_spool()
+        if len(spool_state['messages']) < self.digest_max:
+          spool_state['messages'].append({ 'subject':self.getSubject(record), 'message':self.format(record) })
+        else:
+          spool_state['dropped'] += 1
+        self.write_spool(spool_state)
+        sender_fd = self.lock_file('.sender',False)
+        if sender_fd:
+          sender_fd.close()
+          Popen(self.sender_cmd, shell=False, stdin=open(os.devnull,'r'), stdout=open(os.devnull,'w'), stderr=STDOUT,
+                close_fds=True, preexec_fn=os.setsid)
+      finally:
+        lock_fd.close()
+    except (IOError,OSError):
+      # Spool not usable: send the email directly
+      logging.handlers.SMTPHandler.emit(self,record)
+
+  def send_spool(self):
+    """ Send the spooled messages, waiting for min_interval after the last email sent, until the spool is empty """
+    sender_fd = self.lock_file('.sender',False)
+    if not sender_fd:
+      return
+    try:
+      while True:
+        lock_fd = self.lock_file('.lock')
+        try:
+          spool_state = self.read_spool()
+          if len(spool_state['messages']) == 0:
+            # The sender lock must be released before the spool lock, else a message
+            # added in between would not start a new sender
+            sender_fd.close()
+            sender_fd = None
+            return
+          wait_time = spool_state['last_sent'] + self.min_interval - time.time()
+          if wait_time <= 0:
+            self.send(spool_state['messages'],spool_state['dropped'])
+            self.write_spool({ 'last_sent':time.time(), 'messages':[], 'dropped':0 })
+        finally:
+          lock_fd.close()
+        if wait_time > 0:
+          time.sleep(wait_time)
+    finally:
+      if sender_fd:
+        sender_fd.close()
+
+  def send(self,messages,dropped):
+    import smtplib
+    from email.utils import formatdate
+    if len(messages) == 1 and dropped == 0:
+      subject = messages[0]['subject']
+      body = messages[0]['message']
+    else:
+      subject = '%s (%d notifications)' % (messages[-1]['subject'],len(messages)+dropped)
+      body = '\n\n'.join([ '%s\n%s' % (message['subject'],message['message']) for message in messages ])
+      if dropped > 0:
+        body += '\n\n%d other notifications not included' % (dropped)
+    smtp = smtplib.SMTP(self.mailhost,self.mailport or smtplib.SMTP_PORT,timeout=self._timeout)
+    try:
+      msg = "From: %s\r\nTo: %s\r\nSubject: %s\r\nDate: %s\r\n\r\n%s" % (self.fromaddr,','.join(self.toaddrs),subject,formatdate(),body)
+      smtp.sendmail(self.fromaddr,self.toaddrs,msg)
+    finally:
+      smtp.quit()
@@ -7,7 +7,31 @@ Arguments:
   [1] REPOS-PATH   (the path to this repository)
   [2] REV          (the number of the revision just committed)
 
+With --since REV or --range REV1:REV2, only REPOS-PATH is required: the revisions
+in the range (from REV to HEAD with --since) are processed in one pass, for example
+after an outage of the hook host, and only the most recent SCDB tag in the range is
+deployed. --since last starts after the last revision successfully processed
+(option last_revision_file), or at the oldest SCDB tag whose deployment failed
+or did not complete.
+
 This script uses pysvn API to SVN to access the SVN repository.
+
+When option async_deploy is enabled, the deployment of a SCDB tag is delegated
+to deploy-daemon.py through a Unix socket and this script returns immediately.
+The daemon runs this script with --sync to do the actual deployment. If the
+daemon cannot be contacted, the deployment is done synchronously.
+
+Commits which are not SCDB tags are rejected as early as possible: the log message
+of the revision is checked with svnlook before loading pysvn and configuring
+logging (see option fast_reject).
+
+Log messages are written to syslog, log file and email by a background thread so
+that a slow mailer doesn't delay the SVN client. Emails are sent by a detached
+instance of this script (--send-notifications), at most one every
+notif_min_interval seconds: messages logged in between are sent as a digest.
+
+When option prefetch is enabled, a commit to trunk starts deploy_script --prefetch
+in the background to update the working copy of trunk kept by deploy_script.
 """
 
 __version__ = "1.0.3"
@@ -15,14 +39,12 @@ __author__  = "Michel Jouvin <jouvin@lal.in2p3.fr>"
 
 
 import sys
+import os
 import re
 from subprocess import *
-import shlex
 import StringIO
-import pysvn
-import logging
-import logging.handlers
-import syslog
+import fcntl
+import tempfile
 from optparse import OptionParser
 import ConfigParser
 
@@ -30,9 +52,10 @@ import ConfigParser
 verbosity = 0
 logger = None
 revision = None
+metrics = None
 
 config_file_default = '/etc/quattor-deploy.conf'
-config_sections = { 'hook':'post-commit', 'scdb':'scdb', 'ssh':'ssh', 'sudo':'sudo' }
+config_sections = { 'hook':'post-commit', 'scdb':'scdb', 'ssh':'ssh', 'sudo':'sudo', 'daemon':'deploy-daemon' }
 config_defaults = StringIO.StringIO("""
 # Options commented out are configuration options available for which no 
 # sensible default value can be defined.
@@ -40,10 +63,33 @@ config_defaults = StringIO.StringIO("""
 # Script launched by the script to actually do the deployment
 deploy_script : /root/quattor/scripts/build-tag.py
 # Name of the deployment server where to run the deploy_script. Used only with ssh.
-# This can be a space-separated list (not yet implemented, see https://trac.lal.in2p3.fr/LCGQWG/ticket/46).
+# This can be a space-separated list: the deployment is then done concurrently on all servers.
 #deploy_server : quattorsrv.example.org
+# Maximum number of deployment servers where deploy_script is run at the same time
+deploy_concurrency : 4
+# Maximum duration (in seconds) of deploy_script on one server. 0 means no limit.
+deploy_timeout : 0
 # Userid to use to run deploy_script
 deploy_user : root
+# When true, deploy_script only queues the tag (--queue) and returns immediately.
+# Tags queued during a deployment are coalesced: only the most recent one is deployed.
+# Deployment errors are then reported by deploy_script (syslog) instead of this script.
+# The tag revision stays pending (see last_revision_file) until deploy_script reports,
+# when a later tag is queued, that it was deployed on every server.
+deploy_queue : no
+# When true, the deployment is done asynchronously by deploy-daemon.py (see [deploy-daemon]).
+# Errors are then reported by email only.
+async_deploy : no
+# When true, commits whose log message (read with svnlook) is not the one of a SCDB tag
+# are ignored before loading pysvn and configuring logging. Commits to trunk_branch are
+# not ignored if prefetch is enabled. Disabled when verbose is greater than 0.
+fast_reject : yes
+# svnlook command used by fast_reject
+svnlook : /usr/bin/svnlook
+# When true, deploy_script is run with --prefetch in the background after each commit
+# to trunk_branch (output ignored), so that the deployment server has most of the next
+# tag contents when it is created. Requires prefetch_cache in deploy_script configuration.
+prefetch : no
 # notify_xxx are used to configure email notification in case of errors.
 # If notif_from or notif_to is undefined, email notification is disabled
 notif_mailer : localhost
@@ -51,22 +97,65 @@ notif_mailer : localhost
 #notif_to=jouvin@lal.in2p3.fr
 notif_subject_prefix : [Quattor-Deploy]
 notif_subject : Failed to deploy revision %s of SCDB configuration
+# Mail server may be specified as host:port
+# Minimum interval (in seconds) between 2 emails. Messages logged in between are sent
+# as one digest email when this interval has elapsed. 0 sends an email per error.
+notif_min_interval : 300
+# File where messages are kept until they are sent and the time of the last email is recorded
+notif_spool : /tmp/quattor-post-commit-notif.spool
+# Maximum number of messages in a digest email (the others are only counted)
+notif_digest_max : 100
+# Maximum number of log messages waiting to be written by the background thread
+# (messages are dropped when the queue is full)
+log_queue_size : 1000
+# Maximum time (in seconds) to wait at exit for the log messages to be written
+log_flush_timeout : 5
 # Default should be appropriate. Set to false if your client doesn't handle properly returned output.
 # When set to false, no message is printed on stdout, except if verbose is > 0.
 report_error_to_svn: yes
 # When false, ssh is used instead. This requires deploy_server to be defined too.
 use_sudo : yes
+# File where the duration of each phase of a tag deployment (svn log, deployment on
+# each server) is appended as one JSON line per deployment. Empty disables it.
+#metrics_log: /var/log/quattor-deploy-metrics.log
+metrics_log:
+# StatsD server (host:port) where phase durations are sent as timers. Empty disables it.
+#metrics_statsd: localhost:8125
+metrics_statsd:
+# File (node_exporter textfile collector, *.prom) where the metrics of the last deployment
+# are written in Prometheus format. Empty disables it.
+#metrics_textfile: /var/lib/node_exporter/textfile/quattor_deploy_post_commit.prom
+metrics_textfile:
+# Prefix of StatsD and Prometheus metric names
+metrics_prefix: quattor_deploy
+# File where the last revision successfully processed is recorded (used by --since last),
+# with the revisions of the SCDB tags whose deployment failed or is not complete.
+# Empty disables it.
+#last_revision_file: /var/lib/quattor-deploy/post-commit-last-revision
+last_revision_file:
 # Log operations in /tmp/quattor-post-commit.log
 verbose: 0
 
 [ssh]
 cmd: /usr/bin/ssh
 options: -o PasswordAuthentication=no
+# Time (in seconds) a master connection to a deployment server is kept open after its
+# last use, to be reused by the next deployments (ssh ControlMaster/ControlPersist).
+# 0 disables connection sharing.
+control_persist: 600
+# Directory where the sockets of master connections are created ('~' is the home
+# directory of the user running this script). It must be owned by this user with
+# mode 0700, else master connections are not used.
+control_dir: ~/.quattor-deploy-ssh
 
 [sudo]
 cmd: /usr/bin/sudo
 options: -H
 
+[deploy-daemon]
+# Unix socket used to send deployment requests to deploy-daemon.py
+socket: /var/run/quattor-deploy.sock
+
 [scdb]
 # URL associated with the repository root
 #repository_url: http://svn.example.com/scdb
@@ -78,6 +167,148 @@ tags_branch: /tags
 trunk_branch: /trunk
 """)
 
+
+parser = OptionParser()
+parser.add_option('--config', dest='config_file', action='store', default=config_file_default, help='Name of the configuration file to use')
+parser.add_option('-v', '--debug', '--verbose', dest='verbosity', action='count', default=0, help='Increase verbosity level for debugging (on stderr)')
+parser.add_option('--version', dest='version', action='store_true', default=False, help='Display various information about this script')
+parser.add_option('--sync', dest='sync', action='store_true', default=False, help='Do the deployment synchronously, even if async_deploy is enabled')
+parser.add_option('--since', dest='since', action='store', default=None, help='Process revisions from REV (or after the last revision processed if REV is last) to HEAD', metavar='REV')
+parser.add_option('--send-notifications', dest='send_notifications', action='store_true', default=False, help='Send pending email notifications (used internally)')
+parser.add_option('--range', dest='range', action='store', default=None, help='Process revisions REV1 to REV2 (number or HEAD)', metavar='REV1:REV2')
+options, args = parser.parse_args()
+
+
+# Last revision successfully processed (first line) and revisions of the SCDB tags
+# whose deployment failed or is not complete (second line, 'pending: REV...').
+# A tag revision is added to the pending ones before its deployment starts and removed
+# (with the older ones, superseded) once it is deployed: --since last restarts at the
+# oldest one, even if more recent revisions were processed since.
+# Several instances of this script may run concurrently: the file is updated under
+# a lock and the last revision only if it is greater than the one recorded.
+
+def read_last_revision(revision_file):
+  """ Return the last revision recorded in revision_file (or None) and the sorted
+      list of pending tag revisions """
+  try:
+    revision_fd = open(revision_file,'r')
+  except IOError, detail:
+    if detail.errno == 2:
+      return (None,[])
+    raise
+  try:
+    try:
+      last_revision = int(revision_fd.readline())
+    except ValueError:
+      last_revision = None
+    matcher = re.match('^pending:((?:\s+[0-9]+)*)\s*$',revision_fd.readline())
+    if matcher:
+      pending_revisions = sorted([ int(pending_revision) for pending_revision in matcher.group(1).split() ])
+    else:
+      pending_revisions = []
+    return (last_revision,pending_revisions)
+  finally:
+    revision_fd.close()
+
+def record_last_revision(revision_file,revision=None,pending=None,deployed=None):
+  """ Record revision as the last revision processed, add pending to the pending tag
+      revisions and remove deployed and the older ones from them """
+  lock_fd = open(revision_file + '.lock','w')
+  try:
+    fcntl.flock(lock_fd,fcntl.LOCK_EX)
+    (last_revision,pending_revisions) = read_last_revision(revision_file)
+    new_last_revision = last_revision
+    if revision is not None and (last_revision is None or revision > last_revision):
+      new_last_revision = revision
+    new_pending_revisions = set(pending_revisions)
+    if pending is not None:
+      new_pending_revisions.add(pending)
+    if deployed is not None:
+      new_pending_revisions = set([ pending_revision for pending_revision in new_pending_revisions if pending_revision > deployed ])
+    new_pending_revisions = sorted(new_pending_revisions)
+    if new_last_revision != last_revision or new_pending_revisions != pending_revisions:
+      revision_fd, revision_tmp = tempfile.mkstemp(dir=os.path.dirname(revision_file),prefix='.')
+      if new_last_revision is None:
+        os.write(revision_fd,'\n')
+      else:
+        os.write(revision_fd,'%d\n' % (new_last_revision))
+      if new_pending_revisions:
+        os.write(revision_fd,'pending: %s\n' % (' '.join([ str(pending_revision) for pending_revision in new_pending_revisions ])))
+      os.close(revision_fd)
+      os.chmod(revision_tmp,0644)
+      os.rename(revision_tmp,revision_file)
+  finally:
+    lock_fd.close()
+
+
+# Fast path for commits which are not SCDB tags (nearly all of them).
+# The log message of the revision is read with svnlook, which requires the repository
+# path (the argument passed to a post-commit hook). The script exits if the message
+# is not 'ant tag', unless prefetch is enabled and the commit modified trunk_branch
+# (svnlook dirs-changed). In any other case (svnlook failure, repository URL, verbose
+# mode...), the full processing is done.
+
+def fast_reject():
+  """ Return True if the commit is certainly not a SCDB tag requiring a deployment """
+  if options.version or options.verbosity or options.since or options.range or len(args) < 2 or re.match('^[a-z]+://',args[0]):
+    return False
+  config = ConfigParser.ConfigParser()
+  try:
+    config.readfp(StringIO.StringIO(config_defaults.getvalue()))
+    config.readfp(open(options.config_file))
+    section = config_sections['hook']
+    if not config.getboolean(section,'fast_reject') or config.getint(section,'verbose') > 0:
+      return False
+    svnlook_cmd = config.get(section,'svnlook')
+    prefetch = config.getboolean(section,'prefetch')
+    last_revision_file = config.get(section,'last_revision_file')
+    trunk_branch = config.get(config_sections['scdb'],'trunk_branch').strip('/')
+  except (IOError,ConfigParser.Error,ValueError):
+    return False
+  try:
+    proc = Popen([ svnlook_cmd, 'log', '-r', args[1], args[0] ], shell=False, stdout=PIPE, stderr=PIPE)
+    log_message = proc.communicate()[0]
+    if proc.returncode != 0 or log_message.rstrip('\n') == 'ant tag':
+      return False
+    if prefetch:
+      proc = Popen([ svnlook_cmd, 'dirs-changed', '-r', args[1], args[0] ], shell=False, stdout=PIPE, stderr=PIPE)
+      dirs_changed = proc.communicate()[0]
+      if proc.returncode != 0:
+        return False
+      for changed_dir in dirs_changed.splitlines():
+        if changed_dir == trunk_branch + '/' or changed_dir.startswith(trunk_branch + '/'):
+          return False
+  except OSError:
+    return False
+  if last_revision_file:
+    try:
+      record_last_revision(last_revision_file,int(args[1]))
+    except (IOError,OSError,ValueError):
+      return False
+  return True
+
+if fast_reject():
+  sys.exit(0)
+
+
+# Modules needed only when the commit may require a deployment
+
+import socket
+import signal
+import stat
+import threading
+import time
+import json
+import shlex
+import deploy_metrics
+import deploy_notify
+import atexit
+import Queue
+import pysvn
+import logging
+import logging.handlers
+import syslog
+
 # The following handler optionally adds before the first message a set of XML tags and
 # ensures the matching closing tags when the handler is closed (or when the
 # application exits). It also takes care of removing < and >.
@@ -117,6 +348,78 @@ class MyXMLStreamHandler(logging.StreamHandler):
     # Note than StreamHandler.close() is inherited from Handlers and does nothing
     logging.StreamHandler.flush(self)
 
+# The following handler passes the records to other handlers (syslog, log file, email)
+# in a background thread. The queue is bounded: when it is full, records are dropped
+# and counted. At exit, the queued records are processed for at most flush_timeout
+# seconds (the thread is a daemon thread).
+class AsyncHandler(logging.Handler):
+  def __init__(self,queue_size,flush_timeout):
+    logging.Handler.__init__(self)
+    self.handlers = []
+    self.queue = Queue.Queue(queue_size)
+    self.flush_timeout = flush_timeout
+    self.dropped = 0
+    self.closed = False
+    self.thread = threading.Thread(target=self.process)
+    self.thread.setDaemon(True)
+    self.thread.start()
+    # Registered after the logging module one: called before logging shutdown
+    atexit.register(self.close)
+
+  def configure(self,queue_size,flush_timeout):
+    self.queue.maxsize = queue_size
+    self.flush_timeout = flush_timeout
+
+  def addHandler(self,handler):
+    self.handlers.append(handler)
+
+  def emit(self,record):
+    # Record is copied with its message formatted as other handlers may modify it
+    # (see MyXMLStreamHandler) and its arguments may change before it is processed.
+    if record.exc_info:
+      logging.Formatter().format(record)
+    record = logging.makeLogRecord(record.__dict__)
+    record.msg = record.getMessage()
+    record.args = None
+    record.exc_info = None
+    try:
+      self.queue.put_nowait(record)
+    except Queue.Full:
+      self.dropped += 1
+
+  def process(self):
+    while True:
+      record = self.queue.get()
+      if record is None:
+        break
+      if self.dropped > 0:
+        dropped = self.dropped
+        self.dropped = 0
+        warning_record = logging.makeLogRecord({ 'name':record.name, 'levelno':logging.WARNING, 'levelname':'WARNING',
+                                                 'msg':'%d log messages dropped (log queue full)' % (dropped) })
+        self.dispatch(warning_record)
+      self.dispatch(record)
+    for handler in self.handlers:
+      handler.close()
+
+  def dispatch(self,record):
+    for handler in self.handlers:
+      if record.levelno >= handler.level:
+        try:
+          handler.handle(record)
+        except Exception:
+          handler.handleError(record)
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      try:
+        self.queue.put(None,True,self.flush_timeout)
+      except Queue.Full:
+        pass
+      self.thread.join(self.flush_timeout)
+    logging.Handler.close(self)
+
 def abort(msg):
     logger.error("SVN post-commit script failed:\n%s" % (msg))
     sys.exit(2)
@@ -140,14 +443,20 @@ fmt=logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 # Handler used to report to SVN must display only the message to allow proper XML formatting
 svn_fmt=logging.Formatter("%(message)s")
 
+# syslog, log file and email handlers are called by a background thread.
+# Queue size and flush timeout are updated when the configuration has been read.
+async_handler = AsyncHandler(1000,5)
+async_handler.setLevel(logging.DEBUG)
+logger.addHandler(async_handler)
+
 syslog_handler = logging.handlers.SysLogHandler('/dev/log')
 syslog_handler.setLevel(logging.WARNING)
-logger.addHandler(syslog_handler)
+async_handler.addHandler(syslog_handler)
 
 logfile_handler = logging.handlers.RotatingFileHandler('/tmp/quattor-post-commit.log','a',100000,10)
 logfile_handler.setLevel(logging.DEBUG)
 logfile_handler.setFormatter(fmt)
-logger.addHandler(logfile_handler)
+async_handler.addHandler(logfile_handler)
 
 # SVN requires the response to be valid XML.
 svn_handler = MyXMLStreamHandler()
@@ -156,24 +465,29 @@ svn_handler.setFormatter(svn_fmt)
 logger.addHandler(svn_handler)
 
 
-parser = OptionParser()
-parser.add_option('--config', dest='config_file', action='store', default=config_file_default, help='Name of the configuration file to use')
-parser.add_option('-v', '--debug', '--verbose', dest='verbosity', action='count', default=0, help='Increase verbosity level for debugging (on stderr)')
-parser.add_option('--version', dest='version', action='store_true', default=False, help='Display various information about this script')
-options, args = parser.parse_args()
-
 if options.version:
   debug (0,"Version %s written by %s" % (__version__,__author__))
   debug (0,__doc__)
   sys.exit(0)
 
-if len(args) < 2:
+catch_up = options.since or options.range
+if options.send_notifications:
+  pass
+elif catch_up:
+  if options.since and options.range:
+    abort("--since and --range are mutually exclusive")
+  if len(args) < 1:
+    abort("Insufficient argument provided (repository path required)")
+elif len(args) < 2:
   abort("Insufficient argument provided (2 required)")  
   
 if options.verbosity:
   verbosity = options.verbosity
 
-revision = args[1]
+if catch_up:
+  revision = options.range or '%s:HEAD' % (options.since)
+elif not options.send_notifications:
+  revision = args[1]
 
 
 # Read configuration file.
@@ -212,6 +526,21 @@ except ValueError:
 if config_verbose > verbosity:
   verbosity = config_verbose
 
+try:
+  section = config_sections['hook']
+  option_name = 'log_queue_size'
+  log_queue_size = config.getint(section,option_name)
+  option_name = 'log_flush_timeout'
+  log_flush_timeout = config.getint(section,option_name)
+  option_name = 'notif_min_interval'
+  notif_min_interval = config.getint(section,option_name)
+  option_name = 'notif_digest_max'
+  notif_digest_max = config.getint(section,option_name)
+except ValueError:
+  abort("Invalid value specified for '%s' (section %s): must be an integer" % (option_name,section))
+notif_spool = config.get(section,'notif_spool')
+async_handler.configure(log_queue_size,log_flush_timeout)
+
 init_mail_handler = True
 try:
   section = config_sections['hook']
@@ -224,10 +553,25 @@ except (ConfigParser.NoSectionError,ConfigParser.NoOptionError):
   init_mail_handler = False
 
 if init_mail_handler:
-  mail_handler = logging.handlers.SMTPHandler(notif_mailer,notif_from,notif_to,notif_subject)
+  if re.search(':[0-9]+$',notif_mailer):
+    (notif_host,notif_port) = notif_mailer.rsplit(':',1)
+    notif_mailer = (notif_host,int(notif_port))
+  sender_cmd = [ sys.executable, os.path.abspath(sys.argv[0]), '--config', os.path.abspath(options.config_file), '--send-notifications' ]
+  mail_handler = deploy_notify.DigestMailHandler(notif_mailer,notif_from,notif_to,notif_subject,notif_spool,notif_min_interval,notif_digest_max,sender_cmd)
   mail_handler.setLevel(logging.ERROR)
   mail_handler.setFormatter(fmt)
-  logger.addHandler(mail_handler)
+
+# Detached instance sending the spooled emails: errors are only logged to syslog and log file
+if options.send_notifications:
+  if init_mail_handler:
+    try:
+      mail_handler.send_spool()
+    except Exception, detail:
+      logger.warning('Failed to send email notifications: %s' % (detail))
+  sys.exit(0)
+
+if init_mail_handler:
+  async_handler.addHandler(mail_handler)
 
 # Get options with default values
 try:
@@ -237,6 +581,16 @@ try:
   deploy_script = config.get(section,option_name)
   option_name = 'deploy_user'
   deploy_user = config.get(section,option_name)
+  option_name = 'metrics_log'
+  metrics_log = config.get(section,option_name)
+  option_name = 'metrics_statsd'
+  metrics_statsd = config.get(section,option_name)
+  option_name = 'metrics_textfile'
+  metrics_textfile = config.get(section,option_name)
+  option_name = 'metrics_prefix'
+  metrics_prefix = config.get(section,option_name)
+  option_name = 'last_revision_file'
+  last_revision_file = config.get(section,option_name)
 
   # Section [scdb]
   section = config_sections['scdb']
@@ -261,6 +615,25 @@ try:
   use_sudo = config.getboolean(section,'use_sudo')
 except ValueError:
   abort("Invalid value specified for 'use_sudo' (section %s): must be yes or no" % (section))
+
+try:
+  section = config_sections['hook']
+  deploy_queue = config.getboolean(section,'deploy_queue')
+except ValueError:
+  abort("Invalid value specified for 'deploy_queue' (section %s): must be yes or no" % (section))
+
+try:
+  section = config_sections['hook']
+  async_deploy = config.getboolean(section,'async_deploy') and not options.sync
+except ValueError:
+  abort("Invalid value specified for 'async_deploy' (section %s): must be yes or no" % (section))
+deploy_socket = config.get(config_sections['daemon'],'socket')
+
+try:
+  section = config_sections['hook']
+  prefetch = config.getboolean(section,'prefetch')
+except ValueError:
+  abort("Invalid value specified for 'prefetch' (section %s): must be yes or no" % (section))
   
 if use_sudo:
   cnx_section = 'sudo'
@@ -268,9 +641,22 @@ else:
   cnx_section = 'ssh'
   try:
     section = config_sections['hook']
-    deploy_server = config.get(config_sections['hook'],'deploy_server')
+    deploy_servers = config.get(config_sections['hook'],'deploy_server').split()
   except ConfigParser.NoOptionError:
     abort("Required option 'deploy_server' (section %s) missing in configuration file (%s)" % (section,options.config_file))
+  if len(deploy_servers) == 0:
+    abort("Option 'deploy_server' (section %s) is empty in configuration file (%s)" % (section,options.config_file))
+
+try:
+  section = config_sections['hook']
+  option_name = 'deploy_concurrency'
+  deploy_concurrency = config.getint(section,option_name)
+  option_name = 'deploy_timeout'
+  deploy_timeout = config.getint(section,option_name)
+except ValueError:
+  abort("Invalid value specified for '%s' (section %s): must be an integer" % (option_name,section))
+if deploy_concurrency < 1:
+  abort("Invalid value specified for 'deploy_concurrency' (section %s): must be greater than 0" % (section))
 
 try:
   option_name = 'cmd'
@@ -280,6 +666,15 @@ try:
 except ValueError:
   abort("Option %s not defined (section %s): internal error (default value should exist)." % (option_name,config_sections[cnx_section]))
 
+control_persist = 0
+if not use_sudo:
+  try:
+    section = config_sections['ssh']
+    control_persist = config.getint(section,'control_persist')
+    control_dir = os.path.expanduser(config.get(section,'control_dir'))
+  except ValueError:
+    abort("Invalid value specified for 'control_persist' (section %s): must be an integer" % (section))
+
     
 # Ensure there is a protocol in repos_path. Else add file:.
 # The protocol is absent when the script is called as a post commit hook.
@@ -294,22 +689,159 @@ else:
 debug (1,'Executing post-commit script for repository %s revision %s' % (repos_path,revision))
 
 
+# Deployment metrics.
+# The duration (in seconds) of each phase of a tag deployment is added to metrics['phases']
+# and the duration of the deployment on each server to metrics['servers']. They are
+# written at the end of the deployment as one JSON line in metrics_log and optionally
+# sent to a StatsD server and written to a Prometheus textfile (see deploy_metrics.py).
+
+def record_phase(phase,start_time):
+  deploy_metrics.record_phase(metrics,phase,start_time)
+
+def write_metrics(status):
+  global metrics
+  if metrics:
+    deploy_metrics.write_metrics(metrics,status,[ ('phase','phases'), ('server','servers') ],
+                                 metrics_log,metrics_statsd,metrics_textfile,metrics_prefix,logger)
+  metrics = None
+
+metrics = { 'script':'post-commit', 'host':socket.getfqdn(), 'revision':revision, 'start':time.time(), 'phases':{}, 'servers':{} }
+
+
+# Build the command running deploy_script on a deployment server (or locally with sudo).
+# With ssh, a master connection to the server is used if control_persist is not 0.
+
+def ssh_master(cnx_dest):
+  """ Ensure a master connection to cnx_dest is running and return the ssh options to use it.
+      Returns an empty list if it cannot be started. """
+  control_path = os.path.join(control_dir,cnx_dest)
+  control_opts = [ '-o', 'ControlPath=%s' % (control_path) ]
+  devnull = open(os.devnull,'r+')
+  try:
+    if not os.path.lexists(control_dir):
+      os.makedirs(control_dir,0700)
+    # Another user must not be able to create or replace the sockets
+    control_dir_stat = os.lstat(control_dir)
+    if not stat.S_ISDIR(control_dir_stat.st_mode) or control_dir_stat.st_uid != os.getuid() or \
+       stat.S_IMODE(control_dir_stat.st_mode) != 0700:
+      logger.warning('%s is not a directory owned by uid %d with mode 0700: not used for master connections. Using a dedicated connection.' % (control_dir,os.getuid()))
+      return []
+    # Serialize master creation with other instances of this script
+    lock_fd = open(control_path + '.lock','w')
+    try:
+      fcntl.flock(lock_fd,fcntl.LOCK_EX)
+      check_cmd = [ cnx_cmd ] + control_opts + [ '-O', 'check', cnx_dest ]
+      if call(check_cmd, shell=False, stdin=devnull, stdout=devnull, stderr=devnull) == 0:
+        debug(1,'Reusing master connection to %s (%s)' % (cnx_dest,control_path))
+      else:
+        # Remove the socket left by a master connection which is no longer working
+        if os.path.exists(control_path):
+          debug(1,'Removing stale master connection socket %s' % (control_path))
+          os.remove(control_path)
+        # The master connection goes to background after authentication (-f). Its output
+        # must not be inherited else this script would wait for its completion.
+        master_cmd = [ cnx_cmd ] + control_opts + [ '-o', 'ControlMaster=yes', '-o', 'ControlPersist=%d' % (control_persist) ]
+        master_cmd.extend(cnx_cmd_opts)
+        master_cmd.extend([ '-N', '-f', cnx_dest ])
+        debug(1,"Starting master connection to %s: '%s'" % (cnx_dest,' '.join(master_cmd)))
+        retcode = call(master_cmd, shell=False, stdin=devnull, stdout=devnull, stderr=devnull)
+        if retcode != 0:
+          logger.warning('Failed to start master connection to %s (status=%d). Using a dedicated connection.' % (cnx_dest,retcode))
+          return []
+    finally:
+      lock_fd.close()
+  except (IOError,OSError), detail:
+    logger.warning('Failed to set up master connection to %s: %s. Using a dedicated connection.' % (cnx_dest,detail))
+    return []
+  finally:
+    devnull.close()
+  return control_opts + [ '-o', 'ControlMaster=no' ]
+
+def deploy_command(server,script_args):
+  cmd = [ cnx_cmd ]
+  if server:
+    cnx_dest = deploy_user + '@' + server
+    cmd.append(cnx_dest)
+    if control_persist > 0:
+      cmd.extend(ssh_master(cnx_dest))
+  cmd.extend(cnx_cmd_opts)
+  cmd.append(deploy_script)
+  cmd.extend(script_args)
+  return cmd
+
+if use_sudo:
+  deploy_servers = [ None ]
+
+
 # Initialize pysvn
 
 client = pysvn.Client()
 client.exception_style = 0
 
 
-# Get log information for the revision just commited
+def record_processed(processed_revision=None,pending=None,deployed=None):
+  if last_revision_file:
+    try:
+      record_last_revision(last_revision_file,processed_revision,pending=pending,deployed=deployed)
+    except (IOError,OSError), detail:
+      logger.warning('Failed to record last revision processed in %s: %s' % (last_revision_file,detail))
+
+# Revisions to process: the revision just committed or, in catch-up mode, all the
+# revisions in the range.
+if catch_up:
+  try:
+    if options.since:
+      if options.since == 'last':
+        if not last_revision_file:
+          abort("--since last requires option 'last_revision_file' to be defined")
+        try:
+          (last_revision,pending_revisions) = read_last_revision(last_revision_file)
+        except IOError, detail:
+          abort('Failed to read last revision processed (%s): %s' % (last_revision_file,detail))
+        if pending_revisions:
+          debug(0,'Deployment of revision(s) %s failed or did not complete: restarting at revision %d' % (' '.join([ str(pending_revision) for pending_revision in pending_revisions ]),pending_revisions[0]))
+          first_revision = pending_revisions[0]
+        elif last_revision is None:
+          abort('No revision recorded in %s' % (last_revision_file))
+        else:
+          first_revision = last_revision + 1
+      else:
+        first_revision = int(options.since)
+      last_revision = 'HEAD'
+    else:
+      (first_revision,last_revision) = options.range.split(':')
+      first_revision = int(first_revision)
+      if last_revision.upper() == 'HEAD':
+        last_revision = 'HEAD'
+      else:
+        last_revision = int(last_revision)
+  except ValueError:
+    abort('Invalid revision range specified (%s)' % (revision))
+  try:
+    head_revision = client.info2(repos_path,revision=pysvn.Revision(pysvn.opt_revision_kind.head),recurse=False)[0][1]['rev'].number
+  except pysvn.ClientError, e:
+    abort("Failed to retrieve HEAD revision of %s:\n%s" % (repos_path,str(e)))
+  if last_revision == 'HEAD':
+    last_revision = head_revision
+  if first_revision > last_revision or first_revision > head_revision:
+    debug(0,'No revision to process in %s (HEAD is %d)' % (revision,head_revision))
+    sys.exit(0)
+  last_revision = min(last_revision,head_revision)
+else:
+  first_revision = last_revision = int(revision)
+
+# Get log information for all the revisions processed
+phase_start = time.time()
 try:
   log_msgs = client.log(repos_path, \
                         discover_changed_paths=True, \
-                        revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, revision), \
-                        revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, revision) \
+                        revision_start=pysvn.Revision(pysvn.opt_revision_kind.number, first_revision), \
+                        revision_end=pysvn.Revision(pysvn.opt_revision_kind.number, last_revision) \
                        )
 except pysvn.ClientError, e:
   abort("Failed to retrieve log message for %s:%s\n%s" % (repos_path,revision,str(e)))
   sys.exit(3)
+record_phase('svn_log',phase_start)
 
 #for log in log_msgs:
 #  print "Log: '%s', changed paths (%d):" % (log['message'],len(log['changed_paths']))
@@ -318,58 +850,206 @@ except pysvn.ClientError, e:
 
 
 # Check if the commit is a SCDB tag. Else do nothing.
-# Note that there is only one log message as we asked for only one revision.
-# In case there is no log message, treat as something other than a tag
-# deployment and do nothing.
 
-if len(log_msgs) == 0:
-  debug(1,'No log message returned for path %s revision %s' % (repos_path,revision))
-  sys.exit(0)
-log = log_msgs[0]
-if log['message'] != 'ant tag':
-  debug(1,"Not a SCDB tag (log message=%s)" % (log['message']))
-  sys.exit(0)
-elif len(log['changed_paths']) != 1:
-  debug(1,"Not a SCDB tag (%d changed paths instead of 1)" % (len(log['changed_paths'])))
-  sys.exit(0)
-  
-changed_path = log['changed_paths'][0]
-matcher = re.match('^%s/(?P<tag>(?:[0-9\.\-]+/?)+)$' % (tags_branch),changed_path['path'])
-if changed_path['action'] != 'A':
-  debug(1,"Not a SCDB tag (action is %s instead of A)" % (changed_path['action']))
-  sys.exit(0)
-elif not changed_path['copyfrom_path'] or changed_path['copyfrom_path'] != trunk_branch:
-  debug(1,"Not a SCDB tag (copyfrom_path is %s instead of %s)" % (changed_path['copyfrom_path'],trunk_branch))
-  sys.exit(0)
-elif not matcher:
-  debug(1,"Not a SCDB tag (path %s is not a valid tag format)" % (changed_path['path']))
-  sys.exit(0)
+def scdb_tag(log):
+  """ Return the SCDB tag created by the commit described by log or None if it is not a tag """
+  log_revision = log['revision'].number
+  if log['message'] != 'ant tag':
+    debug(1,"Revision %d: not a SCDB tag (log message=%s)" % (log_revision,log['message']))
+    return None
+  elif len(log['changed_paths']) != 1:
+    debug(1,"Revision %d: not a SCDB tag (%d changed paths instead of 1)" % (log_revision,len(log['changed_paths'])))
+    return None
+  changed_path = log['changed_paths'][0]
+  matcher = re.match('^%s/(?P<tag>[0-9\.\-]+(?:/[0-9\.\-]+)*)$' % (tags_branch),changed_path['path'])
+  if changed_path['action'] != 'A':
+    debug(1,"Revision %d: not a SCDB tag (action is %s instead of A)" % (log_revision,changed_path['action']))
+    return None
+  elif not changed_path['copyfrom_path'] or changed_path['copyfrom_path'] != trunk_branch:
+    debug(1,"Revision %d: not a SCDB tag (copyfrom_path is %s instead of %s)" % (log_revision,changed_path['copyfrom_path'],trunk_branch))
+    return None
+  elif not matcher:
+    debug(1,"Revision %d: not a SCDB tag (path %s is not a valid tag format)" % (log_revision,changed_path['path']))
+    return None
+  return matcher.group('tag')
+
+# In catch-up mode, only the most recent tag is deployed (deploying older ones first
+# would be useless) and the prefetch is not triggered.
+if catch_up:
+  tags = []
+  for log in log_msgs:
+    log_tag = scdb_tag(log)
+    if log_tag:
+      tags.append((log['revision'].number,log_tag))
+  if len(tags) == 0:
+    debug(0,'No SCDB tag in revisions %d to %d' % (first_revision,last_revision))
+    record_processed(last_revision)
+    sys.exit(0)
+  tags.sort()
+  for (skipped_revision,skipped_tag) in tags[:-1]:
+    debug(0,'Skipping tag %s (revision %d) superseded by tag %s' % (skipped_tag,skipped_revision,tags[-1][1]))
+  (revision,tag) = tags[-1]
+  revision = str(revision)
+  metrics['revision'] = revision
+  metrics['range'] = '%d:%d' % (first_revision,last_revision)
+
+else:
+  # Note that there is only one log message as we asked for only one revision.
+  # In case there is no log message, treat as something other than a tag
+  # deployment and do nothing.
+  if len(log_msgs) == 0:
+    debug(1,'No log message returned for path %s revision %s' % (repos_path,revision))
+    sys.exit(0)
+  log = log_msgs[0]
+
+  # A commit to trunk is not a tag: update the prefetched working copy on each
+  # deployment server if enabled. deploy_script is left running in the background.
+  if prefetch:
+    trunk_changes = [ path for path in log['changed_paths'] if path['path'] == trunk_branch or path['path'].startswith(trunk_branch + '/') ]
+    if len(trunk_changes) > 0:
+      devnull = open(os.devnull,'r+')
+      for deploy_server in deploy_servers:
+        prefetch_cmd = deploy_command(deploy_server,[ '--prefetch' ])
+        debug(1,"Executing command: '%s'" % (' '.join(prefetch_cmd)))
+        try:
+          Popen(prefetch_cmd, shell=False, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+        except OSError, details:
+          logger.warning('Failed to execute deployment script (%s) for prefetch: %s' % (deploy_script,details))
+      devnull.close()
+      record_processed(last_revision)
+      sys.exit(0)
+
+  tag = scdb_tag(log)
+  if not tag:
+    record_processed(last_revision)
+    sys.exit(0)
 
-tag = matcher.group('tag')
 debug(1,"Deploying tag %s" % (tag))
+metrics['tag'] = tag
 
+# Until it is deployed successfully, the tag is replayed by --since last
+record_processed(pending=int(revision))
 
-if use_sudo:
-  cnx_dest = None
-else:
-  cnx_dest = deploy_user + '@' + deploy_server
-deploy_cmd = [ cnx_cmd ]
-if cnx_dest:
-  deploy_cmd.append(cnx_dest)
-deploy_cmd.extend(cnx_cmd_opts)
-deploy_cmd.append(deploy_script)
-deploy_cmd.append(tag)
-
-debug(1,"Executing command: '%s'" % (' '.join(deploy_cmd)))
-try:
-  proc = Popen(deploy_cmd, shell=False, stdout=PIPE, stderr=STDOUT)
-  retcode = proc.wait()
-  output = proc.communicate()[0]
-  if retcode < 0:
-      abort('Deployment script aborted by signal %d. Command output:\n%s' % (-retcode, output))
-  elif retcode > 0:
-      abort('Error during deployment script (status=%d). Script output:\n%s' % (retcode,output))
+
+# Hand over the deployment to the deployment daemon if async_deploy is enabled.
+# If it cannot be contacted, do the deployment synchronously.
+
+if async_deploy:
+  phase_start = time.time()
+  daemon_socket = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+  try:
+    try:
+      daemon_socket.connect(deploy_socket)
+      daemon_socket.sendall('deploy %s %s %s\n' % (repos_path,revision,tag))
+      daemon_socket.shutdown(socket.SHUT_WR)
+      answer = daemon_socket.makefile('r').readline().rstrip()
+    except socket.error, detail:
+      answer = str(detail)
+  finally:
+    daemon_socket.close()
+  record_phase('daemon',phase_start)
+  if re.match('^queued ',answer):
+    debug(1,"Tag %s queued for deployment by deployment daemon (socket %s)" % (tag,deploy_socket))
+    write_metrics('queued')
+    sys.exit(0)
+  logger.warning("Failed to queue tag %s with deployment daemon (socket %s): %s. Deploying synchronously." % (tag,deploy_socket,answer))
+
+
+# Run deploy_script on each deployment server (or locally with sudo).
+# Deployments are done concurrently, deploy_concurrency at most at the same time.
+# The result of each deployment is recorded in deploy_results as a tuple
+# (success,message,output).
+
+def deploy(server):
+  deploy_slots.acquire()
+  start_time = time.time()
+  try:
+    if deploy_queue:
+      deploy_cmd = deploy_command(server,[ '--queue', '--revision', revision, tag ])
+    else:
+      deploy_cmd = deploy_command(server,[ tag ])
+    debug(1,"Executing command: '%s'" % (' '.join(deploy_cmd)))
+    try:
+      # Run the command in its own process group so that it can be killed with its children on timeout
+      proc = Popen(deploy_cmd, shell=False, stdout=PIPE, stderr=STDOUT, preexec_fn=os.setsid)
+    except OSError, details:
+      deploy_results[server] = (False,'failed to execute deployment script (%s): %s' % (deploy_script,details),'')
+      return
+    # With ssh, killing the local command on timeout may not stop the remote script
+    timed_out = []
+    def kill():
+      timed_out.append(True)
+      try:
+        os.killpg(proc.pid,signal.SIGTERM)
+      except OSError:
+        pass
+    timer = None
+    if deploy_timeout > 0:
+      timer = threading.Timer(deploy_timeout,kill)
+      timer.start()
+    output = proc.communicate()[0]
+    if timer:
+      timer.cancel()
+    retcode = proc.returncode
+    if timed_out:
+      deploy_results[server] = (False,'deployment script timed out after %d seconds' % (deploy_timeout),output)
+    elif retcode < 0:
+      deploy_results[server] = (False,'deployment script aborted by signal %d' % (-retcode),output)
+    elif retcode > 0:
+      deploy_results[server] = (False,'error during deployment script (status=%d)' % (retcode),output)
+    elif deploy_queue:
+      deploy_results[server] = (True,'tag queued for deployment',output)
+    else:
+      deploy_results[server] = (True,'tag deployed successfully',output)
+  finally:
+    metrics['servers'][server or 'localhost'] = time.time() - start_time
+    deploy_slots.release()
+
+deploy_slots = threading.Semaphore(deploy_concurrency)
+deploy_results = {}
+deploy_threads = []
+phase_start = time.time()
+for deploy_server in deploy_servers:
+  deploy_thread = threading.Thread(target=deploy,args=(deploy_server,))
+  deploy_thread.start()
+  deploy_threads.append(deploy_thread)
+for deploy_thread in deploy_threads:
+  deploy_thread.join()
+record_phase('deploy',phase_start)
+
+# Report the result of each deployment
+failed_count = 0
+report = []
+outputs = []
+for deploy_server in deploy_servers:
+  (success,message,output) = deploy_results[deploy_server]
+  if not success:
+    failed_count += 1
+    metrics.setdefault('failed_servers',[]).append(deploy_server or 'localhost')
+  if deploy_server:
+    report.append('%s: %s' % (deploy_server,message))
+    outputs.append('%s output:\n%s' % (deploy_server,output))
   else:
-      debug(1,'Tag %s deployed successfully. %s output:\n%s' % (tag,deploy_script,output))
-except OSError, details:
-  abort('Failed to execute deployment script (%s): %s' % (deploy_script,details))  
+    report.append(message)
+    outputs.append('%s output:\n%s' % (deploy_script,output))
+if failed_count > 0:
+  write_metrics('failure')
+  abort('Deployment of tag %s failed on %d of %d server(s):\n%s\n\n%s' % (tag,failed_count,len(deploy_servers),'\n'.join(report),'\n'.join(outputs)))
+elif deploy_queue:
+  write_metrics('success')
+  # The tag is still pending: only the tags deployed by the workers of every server,
+  # as reported by deploy_script with the revision they were queued with, are done.
+  deployed_revisions = []
+  for deploy_server in deploy_servers:
+    matcher = re.search('Last tag deployed: \S+ \(revision ([0-9]+)\)',deploy_results[deploy_server][2])
+    if matcher:
+      deployed_revisions.append(int(matcher.group(1)))
+  if len(deployed_revisions) == len(deploy_servers):
+    record_processed(last_revision,deployed=min(deployed_revisions))
+  else:
+    record_processed(last_revision)
+  debug(1,'Tag %s queued on %d server(s):\n%s\n\n%s' % (tag,len(deploy_servers),'\n'.join(report),'\n'.join(outputs)))
+else:
+  write_metrics('success')
+  record_processed(last_revision,deployed=int(revision))
+  debug(1,'Tag %s deployed on %d server(s):\n%s\n\n%s' % (tag,len(deploy_servers),'\n'.join(report),'\n'.join(outputs)))
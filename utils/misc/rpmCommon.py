@@ -0,0 +1,255 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2006-2014 CNRS. All rights reserved.
+
+"""rpmCommon - Functions shared by rpmErrata and rpmUpdates
+
+RPM version comparison, RPM header cache, yum repository metadata reading
+and atomic file writing.
+"""
+
+import os
+import re
+import logging
+import sqlite3
+import tempfile
+import gzip
+import bz2
+import shutil
+import xml.etree.cElementTree as ElementTree
+
+# Default name of the RPM header cache, created in the RPM directory
+headerCacheDefault = '.rpmheaders.sqlite'
+
+# yum repository metadata XML namespaces
+repomdNamespace = 'http://linux.duke.edu/metadata/repo'
+primaryNamespace = 'http://linux.duke.edu/metadata/common'
+
+# Warnings are written through this logger: scripts configure it like their own
+logger = logging.getLogger('rpmCommon')
+
+# Segments of a version string compared by rpmvercmp()
+versionSegmentRegExp = re.compile('~|\\^|[0-9]+|[a-zA-Z]+')
+
+def rpmVersionSegments(version):
+    """Return the sort key of an RPM version or release string.
+
+    Comparing the keys of two strings gives the same result as rpmvercmp():
+    the string is split into numeric and alphabetic segments (other
+    characters are separators), numeric segments are compared as numbers
+    and sort after alphabetic ones, '~' sorts before anything (even the end
+    of the string) and '^' sorts after the end of the string but before
+    anything else.
+    """
+    segments = []
+    for segment in versionSegmentRegExp.findall(version):
+        if segment == '~':
+            segments.append((0,))
+        elif segment == '^':
+            segments.append((2,))
+        elif segment[0].isdigit():
+            segments.append((4,int(segment)))
+        else:
+            segments.append((3,segment))
+    # End of the string
+    segments.append((1,))
+    return tuple(segments)
+
+def rpmVersionKey(version):
+    """Return the sort key of an RPM version.
+
+    The argument is a list of three variables [epoch,version,release]. Keys
+    compare like the versions with rpm.labelCompare(): a missing epoch is 0
+    and a missing version or release sorts before any other value.
+    """
+    (epoch,ver,release) = version
+    if epoch is None:
+        epoch = '0'
+    key = []
+    for value in (epoch,ver,release):
+        if value is None:
+            key.append(())
+        else:
+            key.append(rpmVersionSegments(value))
+    return tuple(key)
+
+class RPMHeaderCache:
+    """On-disk cache of the RPM header information used to build templates.
+
+    The cache is a SQLite database with one entry per RPM file name. An entry
+    is valid only if the file size, modification time and inode recorded when
+    the header was read match the current ones (the file identity).
+    A cache created before the epoch was recorded is discarded.
+    """
+
+    def __init__(self,path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(headers)")]
+        if columns and 'epoch' not in columns:
+            self.db.execute("DROP TABLE headers")
+        self.db.execute("CREATE TABLE IF NOT EXISTS headers (filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, name TEXT, version TEXT, release TEXT, arch TEXT, buildtime TEXT, epoch TEXT)")
+        self.entries = {}
+        for row in self.db.execute("SELECT * FROM headers"):
+            self.entries[row[0]] = (tuple(row[1:4]),tuple(row[4:]))
+        self.updates = []
+
+    def get(self,filename,identity):
+        """Return the cached header of filename or None if missing or stale"""
+        if self.entries.has_key(filename) and self.entries[filename][0] == identity:
+            return self.entries[filename][1]
+        return None
+
+    def set(self,filename,identity,header):
+        self.updates.append((filename,) + identity + header)
+
+    def save(self,fileList):
+        """Write new entries and remove the ones for files not in fileList"""
+        currentFiles = set(fileList)
+        staleFiles = [(filename,) for filename in self.entries.keys() if filename not in currentFiles]
+        self.db.executemany("DELETE FROM headers WHERE filename=?", staleFiles)
+        self.db.executemany("INSERT OR REPLACE INTO headers VALUES (?,?,?,?,?,?,?,?,?,?)", self.updates)
+        self.db.commit()
+        self.db.close()
+
+def readRepodata(directory):
+    """Read RPM header information from the yum metadata of the RPMs in directory.
+
+    The metadata (repodata) is looked for in directory and, if not found, in
+    its parent: with the standard createrepo layout, RPMs are in a
+    subdirectory (e.g. Packages) of the repository. Only the RPMs located
+    in directory are returned.
+
+    The primary metadata is streamed with an iterative parser if available
+    as XML (primary.xml[.gz]), else the primary SQLite database is used.
+
+    Returns a tuple (headers,timestamp) where headers is a dictionary whose
+    key is the RPM file name in directory and value the tuple
+    (name,version,release,arch,buildtime,epoch), and timestamp the modification
+    time of repomd.xml. Returns (None,None) if there is no usable metadata.
+    """
+    repository = directory
+    repomdPath = os.path.join(repository,'repodata','repomd.xml')
+    if not os.path.exists(repomdPath):
+        parentRepository = os.path.dirname(os.path.abspath(directory))
+        if os.path.exists(os.path.join(parentRepository,'repodata','repomd.xml')):
+            repository = parentRepository
+            repomdPath = os.path.join(repository,'repodata','repomd.xml')
+    # Location of directory relative to the repository ('.' if it is the repository)
+    directoryLocation = os.path.relpath(os.path.abspath(directory),os.path.abspath(repository))
+
+    def rpmFilename(href):
+        """Return the RPM file name if href is located in directory, else None"""
+        (hrefDir,filename) = os.path.split(os.path.normpath(href))
+        if os.path.normpath(hrefDir or '.') == directoryLocation:
+            return filename
+        return None
+
+    try:
+        repomdTime = os.path.getmtime(repomdPath)
+        primaryFiles = {}
+        for (event,elem) in ElementTree.iterparse(repomdPath):
+            if elem.tag == '{%s}data' % (repomdNamespace):
+                location = elem.find('{%s}location' % (repomdNamespace))
+                if location is not None:
+                    primaryFiles[elem.get('type')] = os.path.join(repository,location.get('href'))
+    except (EnvironmentError, SyntaxError), detail:
+        logger.warning("Warning: failed to read %s (%s)" % (repomdPath,detail))
+        return (None,None)
+
+    headers = {}
+    try:
+        if primaryFiles.has_key('primary'):
+            primaryPath = primaryFiles['primary']
+            if primaryPath.endswith('.gz'):
+                primaryFile = gzip.open(primaryPath)
+            else:
+                primaryFile = open(primaryPath)
+            try:
+                packageTag = '{%s}package' % (primaryNamespace)
+                context = iter(ElementTree.iterparse(primaryFile, events=('start','end')))
+                (event,root) = context.next()
+                for (event,elem) in context:
+                    if event != 'end' or elem.tag != packageTag:
+                        continue
+                    filename = rpmFilename(elem.find('{%s}location' % (primaryNamespace)).get('href'))
+                    if filename:
+                        version = elem.find('{%s}version' % (primaryNamespace))
+                        headers[filename] = \
+                            (elem.findtext('{%s}name' % (primaryNamespace)),
+                             version.get('ver'),
+                             version.get('rel'),
+                             elem.findtext('{%s}arch' % (primaryNamespace)),
+                             elem.find('{%s}time' % (primaryNamespace)).get('build'),
+                             version.get('epoch'))
+                    # Do not keep the packages already processed in memory
+                    root.clear()
+            finally:
+                primaryFile.close()
+        elif primaryFiles.has_key('primary_db'):
+            primaryPath = primaryFiles['primary_db']
+            dbFile = None
+            if primaryPath.endswith('.bz2') or primaryPath.endswith('.gz'):
+                if primaryPath.endswith('.bz2'):
+                    compressedFile = bz2.BZ2File(primaryPath)
+                else:
+                    compressedFile = gzip.open(primaryPath)
+                (dbFd,dbFile) = tempfile.mkstemp(suffix='.sqlite')
+                dbFileObject = os.fdopen(dbFd,'wb')
+                shutil.copyfileobj(compressedFile,dbFileObject)
+                dbFileObject.close()
+                compressedFile.close()
+                primaryPath = dbFile
+            try:
+                db = sqlite3.connect(primaryPath)
+                db.text_factory = str
+                for row in db.execute("SELECT name,version,release,arch,time_build,location_href,epoch FROM packages"):
+                    filename = rpmFilename(row[5])
+                    if filename:
+                        headers[filename] = (row[0],row[1],row[2],row[3],str(row[4]),row[6])
+                db.close()
+            finally:
+                if dbFile:
+                    os.remove(dbFile)
+        else:
+            logger.warning("Warning: no primary metadata found in %s" % (repomdPath))
+            return (None,None)
+    except (EnvironmentError, SyntaxError, AttributeError, sqlite3.Error), detail:
+        logger.warning("Warning: failed to read primary metadata of %s (%s)" % (repository,detail))
+        return (None,None)
+
+    return (headers,repomdTime)
+
+def fileIdentity(path):
+    """Return the (size,mtime,inode) tuple used to validate cache entries"""
+    fileStat = os.stat(path)
+    return (fileStat.st_size,fileStat.st_mtime,fileStat.st_ino)
+
+def writeFileAtomically(path,content):
+    """Write content to path, replacing any existing file atomically.
+
+    content is written to a temporary file in the same directory, which is
+    then renamed to path: readers never see a partially written file.
+    If path exists and is not a regular file (e.g. /dev/null), content is
+    written to it directly.
+    """
+    if os.path.exists(path) and not os.path.isfile(path):
+        outputFile = open(path,'w')
+        outputFile.write(content)
+        outputFile.close()
+        return
+    (fd,tmpPath) = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        tmpFile = os.fdopen(fd,'w')
+        tmpFile.write(content)
+        tmpFile.close()
+        # mkstemp() creates the file readable only by its owner
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpPath,0666 & ~umask)
+        os.rename(tmpPath,path)
+    except:
+        os.unlink(tmpPath)
+        raise
@@ -17,126 +17,367 @@ import os
 import sys
 import rpm
 import optparse
+import logging
 import time
+import multiprocessing
+import sqlite3
 from operator import itemgetter
+from cStringIO import StringIO
+import rpmCommon
+from rpmCommon import headerCacheDefault, rpmVersionKey, RPMHeaderCache, readRepodata, fileIdentity, writeFileAtomically
 
 archList = ['noarch','i386','i586','i686','x86_64']
 
-def compareRPMVersion(x,y):
-    if cmp(x[0],y[0]) == 0:
-#        print x[3] + ":" + y[3]
-        return cmp(x[3],y[3])
-    return cmp(x[0],y[0])
+# Default name of the generated template
+templateNameDefault = 'rpms/errata'
+
+# RPM transaction set used to read headers. When several jobs are used, each
+# worker process has its own one (see initTransactionSet()).
+transactionSet = None
+
+# Messages are written to stderr through this logger. Per-package messages
+# use the DEBUG level, the summary of each template the INFO level.
+logger = logging.getLogger('rpmErrata')
+
+# Log level selected by the number of -q options
+quietLevels = [logging.DEBUG,logging.INFO,logging.WARNING]
 
 _version = "1.1"
 
 versionString = "rpmErrata -- A script for generating Quattor RPM Errata templates (v%s)\n" % (_version)
 
-def rpmCompareVersion(first_version,second_version):
-    """This function compares two RPM version numbers.
+def initTransactionSet():
+    """Create the RPM transaction set used by readRPMHeader() in this process."""
+    global transactionSet
+    transactionSet = rpm.TransactionSet()
+    transactionSet.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+
+def readRPMHeader(path):
+    """Read the header of an RPM file.
+
+    Returns a tuple (name,version,release,arch,buildtime,epoch), epoch being
+    None if the RPM has no epoch.
+    """
+    fileObject = os.open(path, os.O_RDONLY)
+    try:
+        rpmHeader = transactionSet.hdrFromFdno(fileObject)
+    finally:
+        os.close(fileObject)
+    rpmInfo = rpmHeader.sprintf('%{name},%{version},%{release},%{arch}').split(',')
+    rpmBuildTime = rpmHeader.sprintf('%{buildtime}')
+    rpmEpoch = rpmHeader.sprintf('%{epoch}')
+    if rpmEpoch == '(none)':
+        rpmEpoch = None
+    return (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3],rpmBuildTime,rpmEpoch)
+
+def scanRPMFiles(args):
+    """Select the most recent version of each RPM in a list of files.
+
+    args is a tuple (repository,fileList,notAfterTime,notAfterDate), so that
+    this function can be passed directly to multiprocessing.Pool.imap().
+    fileList is a list of (filename,header) where header is the tuple returned
+    by readRPMHeader() if already known (e.g. from the cache), else None.
+
+    Returns a tuple (rpmVersionDict,headerList). rpmVersionDict key is
+    "name-arch" and value is the tuple (name,version,release,arch index,epoch)
+    of the most recent version found. headerList is the list of (filename,header)
+    for the headers actually read from RPM files.
+    """
+    (repository,fileList,notAfterTime,notAfterDate) = args
+    rpmVersionDict = {}
+    # Version sort key of each RPM in rpmVersionDict
+    versionKeys = {}
+    headerList = []
+    for (filename,rpmHeader) in fileList:
+        # Messages are logged once per file to avoid interleaving them
+        # when several worker processes are writing to stderr.
+        message = "Processing %s... " % (filename)
+        if not rpmHeader:
+            rpmHeader = readRPMHeader(repository + os.path.sep + filename)
+            headerList.append((filename,rpmHeader))
+        (name,version,release,archName,rpmBuildTime,epoch) = rpmHeader
+        arch = archList.index(archName)
+        internalName = "%s-%s-%s.%s.rpm" % (name,version,release,archName)
+        rpmInfo = (name,version,release,arch,epoch)
+        rpmKey = "%s-%s" % (rpmInfo[0],rpmInfo[3])
+        if internalName != filename:
+            message += "RPM %s internal name (%s) doesn't match RPM file name. Skipped." % (filename,internalName)
+        elif notAfterTime and int(rpmBuildTime) > int(notAfterTime):
+            # Do not include the RPM if its build time is newer than the specified date.
+            message += "RPM %s is newer than the specified date (%s). Skipped." % (filename, notAfterDate)
+        else:
+            versionKey = rpmVersionKey((epoch,version,release))
+            if not rpmVersionDict.has_key(rpmKey) or versionKey > versionKeys[rpmKey]:
+                message += "added (replacing older versions)"
+                rpmVersionDict[rpmKey] = rpmInfo
+                versionKeys[rpmKey] = versionKey
+            else:
+                message += "skipped (newer version present)"
+        logger.debug(message)
+    return (rpmVersionDict,headerList)
+
+def rpmInfoVersionKey(rpmInfo):
+    """Return the version sort key of an entry of the dictionary returned by scanRPMFiles()"""
+    return rpmVersionKey((rpmInfo[4],rpmInfo[1],rpmInfo[2]))
 
-    Each argument is a list of three variables [epoch,version,release].
+def mergeRPMVersionDict(rpmVersionDict,newVersionDict):
+    """Merge the result of scanRPMFiles() for a list of files into rpmVersionDict.
 
-    The function returns:
-    * 1 if first_version is considered greater than second_version
-    * 0 if the both version are equal
-    * -1 if first_version is considered less than second_version
+    When both dictionaries contain the same version, the one already in
+    rpmVersionDict is kept, as when the files are scanned in one pass. Merging
+    the results in the file list order thus gives the same result as a serial scan.
     """
-    return rpm.labelCompare(first_version,second_version)
+    for (rpmKey,rpmInfo) in newVersionDict.items():
+        if not rpmVersionDict.has_key(rpmKey) or rpmInfoVersionKey(rpmInfo) > rpmInfoVersionKey(rpmVersionDict[rpmKey]):
+            rpmVersionDict[rpmKey] = rpmInfo
+
+def sortRPMEntries(rpmVersionDict):
+    """Return the list of RPMs in rpmVersionDict sorted by name and arch"""
+    return sorted(rpmVersionDict.values(),key = itemgetter(0,3))
+
+def writeTemplate(outputFile,templateName,rpmEntries):
+    """Write the errata template templateName for the RPMs in rpmEntries to outputFile.
+
+    rpmEntries is a list of (name,version,release,arch index), as returned by
+    sortRPMEntries().
+    """
+    outputFile.write("# Template to add errata RPMs to base configuration\n\n")
+    outputFile.write("template %s;\n\n" % (templateName))
+
+    # Add an entry for the most recent version of every RPM, except kernel.
+    # Kernel version is defined explicitly in node configuration and must
+    # not be based on the last one available.
+    # Kernel modules are added for all possible kernel versions. This is not
+    # a problem as their name contains the kernel version used and
+    # will not match an already installed RPM if the kernel version used is not
+    # matching.
+    for rpmInfo in rpmEntries:
+        if rpmInfo[0][0:6] == 'kernel' and rpmInfo[0][0:13] != 'kernel-module':
+            logger.debug("Adding commented-out entry for kernel %s version %s-%s arch %s" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
+            outputFile.write("#'/software/packages'=pkg_ronly('%s','%s-%s','%s','multi');\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
+        else:
+            logger.debug("Adding entry for %s version %s-%s arch %s" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
+            outputFile.write("'/software/packages'=pkg_ronly('%s','%s-%s','%s');\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
 
 def main():
     program = os.path.basename(sys.argv[0])
-    usage = "[-h] [-V] [-n DATE] rpm_directory\n\n" \
-           + "STDOUT must be redirected to produce the template. It is recommended to\n" \
-           + "redirect STDERR to another file as it can produce a lot of output.\n"
+    usage = "[-h] [-V] [-q] [-n DATE] [-j JOBS] [--cache [--cache-file FILE]] [--from-repodata]\n" \
+           + "       [-o OUTPUT_FILE | -d OUTPUT_DIR] rpm_directory[=template] [rpm_directory[=template]...]\n\n" \
+           + "Without -o or -d, STDOUT must be redirected to produce the template. It is recommended\n" \
+           + "to redirect STDERR to another file as it can produce a lot of output, or to use -q to\n" \
+           + "only print a summary (-qq to print only warnings and errors).\n" \
+           + "Several RPM directories can be processed in one pass. In this case, -d is required\n" \
+           + "and a different template name (default: %s) must be given for each directory.\n" % (templateNameDefault)
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-V', '--version',
                       help='show version',
                       action='store_true', dest='version', default=False)
+    parser.add_option('-q', '--quiet',
+                      help='Print only a summary of each template (twice: only warnings and errors)',
+                      action='count', dest='quiet', default=0)
     parser.add_option('-n', '--not-after',
                       help='Restrict the template to RPMs with a build time older than DATE',
                       dest='notAfterDate',
                       metavar="DATE")
+    parser.add_option('-j', '--jobs',
+                      help='Number of processes used to read RPM headers (default: 1)',
+                      dest='jobs', type='int', default=1,
+                      metavar="JOBS")
+    parser.add_option('--cache',
+                      help='Use a cache of RPM headers to read only new or modified RPMs',
+                      action='store_true', dest='cache', default=False)
+    parser.add_option('--no-cache',
+                      help='Read all RPM headers (default)',
+                      action='store_false', dest='cache')
+    parser.add_option('--cache-file',
+                      help='RPM header cache location (default: rpm_directory/%s)' % (headerCacheDefault),
+                      dest='cacheFile',
+                      metavar="FILE")
+    parser.add_option('--from-repodata',
+                      help='Use yum repository metadata (repodata) rather than RPM headers when available',
+                      action='store_true', dest='fromRepodata', default=False)
+    parser.add_option('-o', '--output',
+                      help='Write the template in OUTPUT_FILE instead of STDOUT',
+                      dest='outputFile',
+                      metavar="OUTPUT_FILE")
+    parser.add_option('-d', '--output-dir',
+                      help='Write each template in OUTPUT_DIR/template.tpl instead of STDOUT',
+                      dest='outputDir',
+                      metavar="OUTPUT_DIR")
     (options, args) = parser.parse_args(sys.argv)
 
+    logHandler = logging.StreamHandler(sys.stderr)
+    logHandler.setFormatter(logging.Formatter('%(message)s'))
+    for scriptLogger in (logger,rpmCommon.logger):
+        scriptLogger.addHandler(logHandler)
+        scriptLogger.setLevel(quietLevels[min(options.quiet,len(quietLevels) - 1)])
+
     if options.version:
         sys.stdout.write(versionString)
         sys.exit(0)
 
-    elif len(args) != 2:
+    elif len(args) < 2:
         sys.stderr.write("usage: %s %s\n" % (program, usage))
         sys.exit(1)
 
-    repository = args[1]
+    # Each argument is a directory optionally followed by =template_name
+    repositories = []
+    templateNames = {}
+    for repositorySpec in args[1:]:
+        if '=' in repositorySpec:
+            (repository,templateName) = repositorySpec.split('=',1)
+        else:
+            (repository,templateName) = (repositorySpec,templateNameDefault)
+        if not os.path.isdir(repository):
+            logger.error("Error: No such directory: %s" % (repository))
+            sys.exit(1)
+        if templateNames.has_key(templateName):
+            logger.error("Error: template %s specified for several directories" % (templateName))
+            sys.exit(1)
+        repositories.append((repository,templateName))
+        templateNames[templateName] = repository
+    if len(repositories) > 1:
+        if not options.outputDir:
+            logger.error("Error: an output directory (-d) is required to process several directories")
+            sys.exit(1)
+        if options.cacheFile:
+            logger.error("Error: --cache-file cannot be used to process several directories")
+            sys.exit(1)
+        if options.outputFile:
+            logger.error("Error: -o cannot be used to process several directories, use -d instead")
+            sys.exit(1)
+    if options.outputFile and options.outputDir:
+        logger.error("Error: -o and -d cannot be used together")
+        sys.exit(1)
+
+    if options.jobs < 1:
+        logger.error("Error: the number of jobs (%d) must be greater than 0." % (options.jobs))
+        sys.exit(1)
 
     # Check if the notAfterDate variable is valid
     if options.notAfterDate:
         notAfterDate = options.notAfterDate.split('-')
         if len(notAfterDate) != 3:
-            sys.stderr.write("Error: the date (%s) has not a valid format. Please use the following format: YYYY-MM-DD.\n" % (options.notAfterDate))
+            logger.error("Error: the date (%s) has not a valid format. Please use the following format: YYYY-MM-DD." % (options.notAfterDate))
             sys.exit(1)
         try:
             notAfterTime = time.mktime((int(notAfterDate[0]),int(notAfterDate[1]),int(notAfterDate[2]),0,0,0,0,0,0))
         except:
-            sys.stderr.write("Error: the date (%s) is not a valid date. Please use the following date format: YYYY-MM-DD.\n" % (options.notAfterDate))
+            logger.error("Error: the date (%s) is not a valid date. Please use the following date format: YYYY-MM-DD." % (options.notAfterDate))
             sys.exit(1)
     else:
         notAfterTime = None
 
-    if not os.path.isdir(repository):
-        sys.stderr.write("Error: No such directory: %s\n" % (repository))
-        sys.exit(1)
+    # Build the list of RPM files to scan in every directory, with the header
+    # already known from the repository metadata or the cache, if any.
+    scanLists = {}
+    headerCaches = {}
+    fileIdentities = {}
+    for (repository,templateName) in repositories:
+        fileList = [filename for filename in os.listdir(repository) if filename[-4:] == '.rpm']
 
-    fileList = os.listdir(repository)
- 
-    rpmVersionDict = {}
- 
-    transactionSet =  rpm.TransactionSet()
-    transactionSet.setVSFlags(rpm._RPMVSF_NOSIGNATURES) 
-    sys.stdout.write("# Template to add errata RPMs to base configuration\n\n")
-    sys.stdout.write("template rpms/errata;\n\n")
- 
-    # Process each rpm present in the repository
-    for filename in fileList:
-        if filename[-4:] == '.rpm':
-            sys.stderr.write("Processing %s... " % (filename))
-            fileObject = os.open(repository + os.path.sep + filename, os.O_RDONLY)
-            rpmHeader = transactionSet.hdrFromFdno(fileObject)
-            rpmInfo = rpmHeader.sprintf('%{name},%{version},%{release},%{arch}').split(',')
-            rpmBuildTime = rpmHeader.sprintf('%{buildtime}')
-            arch = archList.index(rpmInfo[3])
-            os.close(fileObject)
-            internalName = "%s-%s-%s.%s.rpm" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3])
-            rpmInfo = (rpmInfo[0],rpmInfo[1],rpmInfo[2],arch)
-            rpmKey = "%s-%s" % (rpmInfo[0],rpmInfo[3])
-            if internalName != filename:
-                sys.stderr.write("RPM %s internal name (%s) doesn't match RPM file name. Skipped.\n" % (filename,internalName))
+        # Look for RPM headers already known in the cache, if enabled
+        headerCache = None
+        if options.cache:
+            if options.cacheFile:
+                cacheFile = options.cacheFile
             else:
-                if notAfterTime:
-                    # Do not include the RPM if its build time is newer than the specified date.
-                    if int(rpmBuildTime) > int(notAfterTime):
-                        sys.stderr.write("RPM %s is newer than the specified date (%s). Skipped.\n" % (filename, options.notAfterDate))
-                        continue
-                if not rpmVersionDict.has_key(rpmKey) or (rpmCompareVersion(rpmInfo[0:3],rpmVersionDict[rpmKey][0:3]) > 0):
-                    sys.stderr.write("added (replacing older versions)\n")
-                    rpmVersionDict[rpmKey] = rpmInfo
-                else:
-                    sys.stderr.write("skipped (newer version present)\n")
+                cacheFile = repository + os.path.sep + headerCacheDefault
+            try:
+                headerCache = RPMHeaderCache(cacheFile)
+                headerCaches[repository] = (headerCache,fileList)
+            except sqlite3.Error, detail:
+                logger.warning("Warning: failed to open RPM header cache %s (%s). Cache disabled." % (cacheFile,detail))
+        # Use repository metadata, if requested and available, for RPMs not
+        # modified since the metadata was generated.
+        repodataHeaders = None
+        if options.fromRepodata:
+            (repodataHeaders,repodataTime) = readRepodata(repository)
+            if repodataHeaders is None:
+                logger.warning("Warning: no usable repository metadata in %s, reading RPM headers" % (repository))
+        fileIdentities[repository] = {}
+        scanList = []
+        for filename in fileList:
+            rpmHeader = None
+            rpmPath = repository + os.path.sep + filename
+            if repodataHeaders and repodataHeaders.has_key(filename) and os.path.getmtime(rpmPath) <= repodataTime:
+                rpmHeader = repodataHeaders[filename]
+            elif headerCache:
+                fileIdentities[repository][filename] = fileIdentity(rpmPath)
+                rpmHeader = headerCache.get(filename,fileIdentities[repository][filename])
+            scanList.append((filename,rpmHeader))
+        scanLists[repository] = scanList
 
-    # Add an entry for the most recent version of every RPM, except kernel.
-    # Kernel version is defined explicitly in node configuration and must
-    # not be based on the last one available.
-    # Kernel modules are added for all possible kernel versions. This is not
-    # a problem as their name contains the kernel version used and
-    # will not match an already installed RPM if the kernel version used is not
-    # matching.
-    for (key,rpmInfo) in sorted(rpmVersionDict.items(),key = itemgetter(1),cmp=compareRPMVersion):
-        if rpmInfo[0][0:6] == 'kernel' and rpmInfo[0][0:13] != 'kernel-module':
-            sys.stderr.write("Adding commented-out entry for kernel %s version %s-%s arch %s\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
-            sys.stdout.write("#'/software/packages'=pkg_ronly('%s','%s-%s','%s','multi');\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
+    # Process each rpm present in the repositories.
+    # With several jobs, the file list of every repository is split into
+    # contiguous chunks and all the chunks are processed in one pass by a
+    # pool of worker processes, each one with its own RPM transaction set.
+    # Results are merged in the file list order of each repository.
+    chunks = []
+    if options.jobs > 1:
+        totalFiles = 0
+        for scanList in scanLists.values():
+            totalFiles += len(scanList)
+        chunkCount = options.jobs * 4
+        chunkSize = max(1, (totalFiles + chunkCount - 1) / chunkCount)
+    for (repository,templateName) in repositories:
+        scanList = scanLists[repository]
+        if options.jobs == 1:
+            chunkSize = max(1, len(scanList))
+        for i in range(0,len(scanList),chunkSize):
+            chunks.append((repository,scanList[i:i+chunkSize],notAfterTime,options.notAfterDate))
+    if options.jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(options.jobs, initTransactionSet)
+        scanResults = pool.imap(scanRPMFiles, chunks)
+    else:
+        pool = None
+        initTransactionSet()
+        scanResults = map(scanRPMFiles, chunks)
+    rpmVersionDicts = {}
+    headersRead = {}
+    for (repository,templateName) in repositories:
+        rpmVersionDicts[repository] = {}
+        headersRead[repository] = 0
+    for (chunk,(chunkVersionDict,headerList)) in zip(chunks,scanResults):
+        repository = chunk[0]
+        mergeRPMVersionDict(rpmVersionDicts[repository],chunkVersionDict)
+        headersRead[repository] += len(headerList)
+        if headerCaches.has_key(repository):
+            for (filename,rpmHeader) in headerList:
+                headerCaches[repository][0].set(filename,fileIdentities[repository][filename],rpmHeader)
+    if pool:
+        pool.close()
+        pool.join()
+
+    for (headerCache,fileList) in headerCaches.values():
+        try:
+            headerCache.save(fileList)
+        except sqlite3.Error, detail:
+            logger.warning("Warning: failed to update RPM header cache %s (%s)." % (headerCache.path,detail))
+
+    # Write one template per repository. Each template is assembled in memory
+    # and written in one go, atomically when written to a file.
+    for (repository,templateName) in repositories:
+        rpmEntries = sortRPMEntries(rpmVersionDicts[repository])
+        outputBuffer = StringIO()
+        writeTemplate(outputBuffer,templateName,rpmEntries)
+        if options.outputDir:
+            templatePath = os.path.join(options.outputDir,templateName + '.tpl')
+            if not os.path.isdir(os.path.dirname(templatePath)):
+                os.makedirs(os.path.dirname(templatePath))
+        else:
+            templatePath = options.outputFile
+        if templatePath:
+            try:
+                writeFileAtomically(templatePath,outputBuffer.getvalue())
+            except (IOError,OSError), detail:
+                logger.error("Error: failed to write template %s (%s)" % (templatePath,detail))
+                sys.exit(1)
         else:
-            sys.stderr.write("Adding entry for %s version %s-%s arch %s\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
-            sys.stdout.write("'/software/packages'=pkg_ronly('%s','%s-%s','%s');\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],archList[rpmInfo[3]]))
+            sys.stdout.write(outputBuffer.getvalue())
+            sys.stdout.flush()
+        logger.info("Template %s: %d RPM files in %s (%d headers read), %d entries" % \
+                    (templateName,len(scanLists[repository]),repository,headersRead[repository],len(rpmEntries)))
 
 if __name__ == '__main__':
     main()
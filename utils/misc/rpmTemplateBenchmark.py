@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 CNRS. All rights reserved.
+
+"""rpmTemplateBenchmark - Benchmarks of the Quattor RPM template generation scripts
+
+This script measures the performance of rpmErrata.py and rpmUpdates.py on
+directories of RPMs. It provides three commands:
+
+ * generate: create a directory of synthetic RPMs. By default, RPMs are
+   made of a minimal lead and headers (no payload), written directly by this
+   script. With --rpmbuild, empty packages are built with rpmbuild instead.
+ * run: time separately the main phases of the template generation (header
+   reading, newest version selection, sorting and template emission), using
+   the functions of rpmErrata.py, and the complete execution of rpmErrata.py
+   and rpmUpdates.py. Results are written as JSON.
+ * compare: compare two JSON reports produced by 'run' and report
+   regressions above a threshold.
+"""
+
+import os
+import sys
+import optparse
+import random
+import struct
+import time
+import socket
+import tempfile
+import shutil
+import StringIO
+import subprocess
+import imp
+import platform
+import json
+import logging
+
+_version = "1.0"
+
+versionString = "rpmTemplateBenchmark -- Benchmarks of the Quattor RPM template generation scripts (v%s)\n" % (_version)
+
+# Directory containing rpmErrata.py and rpmUpdates.py
+scriptDir = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+archList = ['noarch','i386','i586','i686','x86_64']
+
+# RPM header tags and types used in synthetic RPMs
+RPMTAG_HEADERSIGNATURES = 62
+RPMTAG_HEADERIMMUTABLE = 63
+RPMSIGTAG_SIZE = 1000
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_BUILDTIME = 1006
+RPMTAG_OS = 1021
+RPMTAG_ARCH = 1022
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+RPM_BIN_TYPE = 7
+
+def rpmHeader(regionTag,entries):
+    """Build an RPM header structure with an immutable region.
+
+    entries is a list of (tag,type,value) sorted by tag, where value is a
+    string for RPM_STRING_TYPE and an integer for RPM_INT32_TYPE.
+    """
+    index = ''
+    data = ''
+    for (tag,tagType,value) in entries:
+        if tagType == RPM_INT32_TYPE:
+            # Integers must be aligned on 4 bytes
+            data += '\0' * ((4 - len(data) % 4) % 4)
+            index += struct.pack('>iiii',tag,tagType,len(data),1)
+            data += struct.pack('>i',value)
+        else:
+            index += struct.pack('>iiii',tag,tagType,len(data),1)
+            data += value + '\0'
+    indexCount = len(entries) + 1
+    regionEntry = struct.pack('>iiii',regionTag,RPM_BIN_TYPE,len(data),16)
+    data += struct.pack('>iiii',regionTag,RPM_BIN_TYPE,-indexCount*16,16)
+    return '\x8e\xad\xe8\x01\0\0\0\0' + struct.pack('>ii',indexCount,len(data)) + regionEntry + index + data
+
+def writeSyntheticRPM(path,name,version,release,arch,buildTime):
+    """Write a minimal RPM file (lead, signature and main headers, no payload)"""
+    header = rpmHeader(RPMTAG_HEADERIMMUTABLE,
+                       [(RPMTAG_NAME,RPM_STRING_TYPE,name),
+                        (RPMTAG_VERSION,RPM_STRING_TYPE,version),
+                        (RPMTAG_RELEASE,RPM_STRING_TYPE,release),
+                        (RPMTAG_BUILDTIME,RPM_INT32_TYPE,buildTime),
+                        (RPMTAG_OS,RPM_STRING_TYPE,'linux'),
+                        (RPMTAG_ARCH,RPM_STRING_TYPE,arch)])
+    signature = rpmHeader(RPMTAG_HEADERSIGNATURES,[(RPMSIGTAG_SIZE,RPM_INT32_TYPE,len(header))])
+    # Signature header is padded to a multiple of 8 bytes
+    signature += '\0' * ((8 - len(signature) % 8) % 8)
+    lead = struct.pack('>4sBBhh66shh16s','\xed\xab\xee\xdb',3,0,0,1,
+                       ("%s-%s-%s" % (name,version,release))[:65],1,5,'')
+    rpmFile = open(path,'wb')
+    rpmFile.write(lead + signature + header)
+    rpmFile.close()
+
+def writeRpmbuildRPM(path,name,version,release,arch,buildTime,topDir):
+    """Build an empty RPM with rpmbuild and move it to path"""
+    specPath = os.path.join(topDir,'SPECS','%s.spec' % (name))
+    specFile = open(specPath,'w')
+    specFile.write("Name: %s\nVersion: %s\nRelease: %s\nSummary: Benchmark package\nLicense: GPL\n" % (name,version,release))
+    if arch == 'noarch':
+        specFile.write("BuildArch: noarch\n")
+    specFile.write("\n%%description\nBenchmark package\n\n%%files\n")
+    specFile.close()
+    command = ['rpmbuild','-bb','--quiet','--define','_topdir %s' % (topDir),
+               '--define','_build_id_links none','--define','source_date_epoch_from_changelog 0',
+               '--define','clamp_mtime_to_source_date_epoch 0']
+    if arch != 'noarch':
+        command.extend(['--target',arch])
+    command.append(specPath)
+    environment = dict(os.environ)
+    environment['SOURCE_DATE_EPOCH'] = str(buildTime)
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=environment)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise OSError("rpmbuild failed for %s: %s" % (name,output))
+    builtPath = os.path.join(topDir,'RPMS',arch,os.path.basename(path))
+    shutil.move(builtPath,path)
+
+def parseCount(count):
+    """Parse a number of RPMs, accepting the suffixes k and M (e.g. 10k)"""
+    multipliers = {'k':1000, 'K':1000, 'M':1000000}
+    if count and multipliers.has_key(count[-1]):
+        return int(count[:-1]) * multipliers[count[-1]]
+    return int(count)
+
+def generate(directory,count,useRpmbuild,seed):
+    """Create count synthetic RPMs in directory.
+
+    The packages are a mix of packages with several versions (the newest
+    version selection has to discard some of them), several archs and kernel
+    packages, similar to an errata directory.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    generator = random.Random(seed)
+    topDir = None
+    if useRpmbuild:
+        topDir = tempfile.mkdtemp(prefix='rpmbench-')
+        for subDir in ('SPECS','RPMS','BUILD','BUILDROOT','SRPMS'):
+            os.mkdir(os.path.join(topDir,subDir))
+    # On average 4 versions per package name and arch
+    nameCount = max(1, count / 4)
+    try:
+        generated = set()
+        while len(generated) < count:
+            nameIndex = generator.randint(0,nameCount-1)
+            if nameIndex % 50 == 0:
+                name = 'kernel-%d' % (nameIndex)
+            else:
+                name = 'package%d' % (nameIndex)
+            version = '%d.%d.%d' % (generator.randint(0,3),generator.randint(0,20),generator.randint(0,9))
+            release = '%d.el6' % (generator.randint(1,30))
+            arch = archList[nameIndex % len(archList)]
+            filename = '%s-%s-%s.%s.rpm' % (name,version,release,arch)
+            if filename in generated:
+                continue
+            generated.add(filename)
+            buildTime = generator.randint(1200000000,1400000000)
+            path = os.path.join(directory,filename)
+            if useRpmbuild:
+                writeRpmbuildRPM(path,name,version,release,arch,buildTime,topDir)
+            else:
+                writeSyntheticRPM(path,name,version,release,arch,buildTime)
+    finally:
+        if topDir:
+            shutil.rmtree(topDir)
+    sys.stderr.write("%d RPMs generated in %s\n" % (count,directory))
+
+def timePhase(function,repeat):
+    """Run function repeat times and return the list of elapsed times and the last result"""
+    times = []
+    result = None
+    for i in range(repeat):
+        startTime = time.time()
+        result = function()
+        times.append(time.time() - startTime)
+    return (times,result)
+
+def phaseStatistics(times):
+    sortedTimes = sorted(times)
+    return {'min': sortedTimes[0],
+            'median': sortedTimes[len(sortedTimes)/2],
+            'runs': times}
+
+def timeScript(command,repeat):
+    """Time the complete execution of a script, discarding its output"""
+    devNull = open(os.devnull,'w')
+    def runScript():
+        if subprocess.call(command, stdout=devNull, stderr=devNull) != 0:
+            raise OSError("command failed: %s" % (' '.join(command)))
+    try:
+        return timePhase(runScript,repeat)[0]
+    finally:
+        devNull.close()
+
+def run(directory,repeat,jobs):
+    """Benchmark template generation on the RPMs in directory and return the report"""
+    rpmErrata = imp.load_source('rpmErrata',os.path.join(scriptDir,'rpmErrata.py'))
+    fileList = [filename for filename in os.listdir(directory) if filename[-4:] == '.rpm']
+    phases = {}
+
+    # Per package messages are logged at the DEBUG level: only log warnings
+    # and errors to measure only the processing itself.
+    for scriptLogger in (rpmErrata.logger,rpmErrata.rpmCommon.logger):
+        scriptLogger.addHandler(logging.StreamHandler(sys.stderr))
+        scriptLogger.setLevel(logging.WARNING)
+    rpmErrata.initTransactionSet()
+    def readHeaders():
+        headers = []
+        for filename in fileList:
+            headers.append((filename,rpmErrata.readRPMHeader(os.path.join(directory,filename))))
+        return headers
+    (times,scanList) = timePhase(readHeaders,repeat)
+    phases['read_headers'] = phaseStatistics(times)
+
+    # Headers are already known: only the newest version selection is done
+    (times,scanResult) = timePhase(lambda: rpmErrata.scanRPMFiles((directory,scanList,None,None)),repeat)
+    phases['select'] = phaseStatistics(times)
+    rpmVersionDict = scanResult[0]
+
+    (times,rpmEntries) = timePhase(lambda: rpmErrata.sortRPMEntries(rpmVersionDict),repeat)
+    phases['sort'] = phaseStatistics(times)
+
+    (times,result) = timePhase(lambda: rpmErrata.writeTemplate(StringIO.StringIO(),'rpms/errata',rpmEntries),repeat)
+    phases['emit'] = phaseStatistics(times)
+
+    phases['rpmErrata'] = phaseStatistics(timeScript([sys.executable,os.path.join(scriptDir,'rpmErrata.py'),directory],repeat))
+    if jobs > 1:
+        phases['rpmErrata_jobs'] = phaseStatistics(timeScript([sys.executable,os.path.join(scriptDir,'rpmErrata.py'),'-j',str(jobs),directory],repeat))
+    phases['rpmErrata_quiet'] = phaseStatistics(timeScript([sys.executable,os.path.join(scriptDir,'rpmErrata.py'),'-q',directory],repeat))
+    phases['rpmUpdates'] = phaseStatistics(timeScript([sys.executable,os.path.join(scriptDir,'rpmUpdates.py'),directory],repeat))
+
+    return {'version': _version,
+            'directory': os.path.abspath(directory),
+            'rpms': len(fileList),
+            'selected': len(rpmEntries),
+            'repeat': repeat,
+            'jobs': jobs,
+            'host': socket.getfqdn(),
+            'python': platform.python_version(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'phases': phases}
+
+def compare(oldReport,newReport,threshold):
+    """Print the phase timings of two reports. Returns the number of regressions above threshold (%)."""
+    regressions = 0
+    sys.stdout.write("%-16s %12s %12s %8s\n" % ('phase','old (s)','new (s)','change'))
+    for phase in sorted(newReport['phases'].keys()):
+        if not oldReport['phases'].has_key(phase):
+            continue
+        oldTime = oldReport['phases'][phase]['min']
+        newTime = newReport['phases'][phase]['min']
+        change = (newTime - oldTime) / max(oldTime,1e-9) * 100
+        flag = ''
+        if change > threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        sys.stdout.write("%-16s %12.4f %12.4f %+7.1f%%%s\n" % (phase,oldTime,newTime,change,flag))
+    if oldReport['rpms'] != newReport['rpms']:
+        sys.stdout.write("Warning: reports are for a different number of RPMs (%d and %d)\n" % (oldReport['rpms'],newReport['rpms']))
+    return regressions
+
+def main():
+    program = os.path.basename(sys.argv[0])
+    usage = "[-h] [-V] command [options] arguments\n\n" \
+           + "Commands:\n" \
+           + "  generate [-c COUNT] [--rpmbuild] [--seed SEED] rpm_directory\n" \
+           + "  run [-r REPEAT] [-j JOBS] [-o REPORT] rpm_directory\n" \
+           + "  compare [-t THRESHOLD] old_report new_report\n"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-V', '--version',
+                      help='show version',
+                      action='store_true', dest='version', default=False)
+    parser.add_option('-c', '--count',
+                      help='generate: number of RPMs to generate, e.g. 1k, 10k, 100k (default: 1k)',
+                      dest='count', default='1k',
+                      metavar="COUNT")
+    parser.add_option('--rpmbuild',
+                      help='generate: build RPMs with rpmbuild instead of writing headers directly',
+                      action='store_true', dest='rpmbuild', default=False)
+    parser.add_option('--seed',
+                      help='generate: random seed (default: 0)',
+                      dest='seed', type='int', default=0)
+    parser.add_option('-r', '--repeat',
+                      help='run: number of runs of each phase (default: 3)',
+                      dest='repeat', type='int', default=3,
+                      metavar="REPEAT")
+    parser.add_option('-j', '--jobs',
+                      help='run: also time rpmErrata.py with JOBS processes',
+                      dest='jobs', type='int', default=1,
+                      metavar="JOBS")
+    parser.add_option('-o', '--output',
+                      help='run: write the JSON report to REPORT instead of STDOUT',
+                      dest='output',
+                      metavar="REPORT")
+    parser.add_option('-t', '--threshold',
+                      help='compare: slowdown (in %) reported as a regression (default: 10)',
+                      dest='threshold', type='float', default=10.0,
+                      metavar="THRESHOLD")
+    (options, args) = parser.parse_args(sys.argv)
+
+    if options.version:
+        sys.stdout.write(versionString)
+        sys.exit(0)
+
+    if len(args) < 2 or args[1] not in ('generate','run','compare') or \
+       len(args) != {'generate':3, 'run':3, 'compare':4}[args[1]]:
+        sys.stderr.write("usage: %s %s\n" % (program, usage))
+        sys.exit(1)
+
+    command = args[1]
+    if command == 'generate':
+        try:
+            count = parseCount(options.count)
+        except ValueError:
+            sys.stderr.write("Error: invalid number of RPMs (%s)\n" % (options.count))
+            sys.exit(1)
+        generate(args[2],count,options.rpmbuild,options.seed)
+
+    elif command == 'run':
+        if not os.path.isdir(args[2]):
+            sys.stderr.write("Error: No such directory: %s\n" % (args[2]))
+            sys.exit(1)
+        if options.repeat < 1:
+            sys.stderr.write("Error: the number of runs (%d) must be greater than 0.\n" % (options.repeat))
+            sys.exit(1)
+        report = json.dumps(run(args[2],options.repeat,options.jobs), indent=2, sort_keys=True)
+        if options.output:
+            reportFile = open(options.output,'w')
+            reportFile.write(report + "\n")
+            reportFile.close()
+        else:
+            sys.stdout.write(report + "\n")
+
+    elif command == 'compare':
+        reports = []
+        for reportPath in args[2:4]:
+            try:
+                reportFile = open(reportPath)
+                reports.append(json.load(reportFile))
+                reportFile.close()
+            except (IOError, ValueError), detail:
+                sys.stderr.write("Error: failed to read report %s (%s)\n" % (reportPath,detail))
+                sys.exit(1)
+        if compare(reports[0],reports[1],options.threshold) > 0:
+            sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -22,60 +22,505 @@ import os
 import sys
 import rpm
 import optparse
+import logging
 import urllib
+import urlparse
+import httplib
+import socket
+import tempfile
+import threading
+import Queue
 import re
 import time
+import sqlite3
+import gzip
+import zlib
+import hashlib
+import xml.etree.cElementTree as ElementTree
+from cStringIO import StringIO
+import rpmCommon
+from rpmCommon import headerCacheDefault, repomdNamespace, primaryNamespace, rpmVersionKey, RPMHeaderCache, \
+    readRepodata, fileIdentity, writeFileAtomically
 
 _version = "1.0"
 
 versionString = "rpmUpdates -- A script for generating Quattor RPM Update templates (v%s)\n" % (_version)
 
-def rpmCompareVersion(first_version,second_version):
-    """This function compares two RPM version numbers.
+# Messages are written to stderr through this logger. Per-package messages
+# use the DEBUG level, summaries the INFO level.
+logger = logging.getLogger('rpmUpdates')
 
-    Each argument is a list of three variables [epoch,version,release].
+# Log level selected by the number of -q options
+quietLevels = [logging.DEBUG,logging.INFO,logging.WARNING]
 
-    The function returns:
-    * 1 if first_version is considered greater than second_version
-    * 0 if the both version are equal
-    * -1 if first_version is considered less than second_version
+# Number of times a download interrupted by a network timeout is retried
+downloadTimeoutRetries = 2
+
+def readRPMHeader(transactionSet,path):
+    """Read the header of an RPM file.
+
+    Returns a tuple (name,version,release,arch,buildtime,epoch), epoch being
+    None if the RPM has no epoch.
     """
-    return rpm.labelCompare(first_version,second_version)
+    fileObject = os.open(path, os.O_RDONLY)
+    try:
+        rpmHeader = transactionSet.hdrFromFdno(fileObject)
+    finally:
+        os.close(fileObject)
+    rpmInfo = rpmHeader.sprintf('%{name},%{version},%{release},%{arch}').split(',')
+    rpmBuildTime = rpmHeader.sprintf('%{buildtime}')
+    rpmEpoch = rpmHeader.sprintf('%{epoch}')
+    if rpmEpoch == '(none)':
+        rpmEpoch = None
+    return (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3],rpmBuildTime,rpmEpoch)
+
+class GzipStream:
+    """File-like object decompressing on the fly a gzip stream read from fileObject.
+
+    Unlike gzip.GzipFile, it doesn't require the underlying file to be seekable
+    and can thus be used on a network stream.
+    """
+
+    def __init__(self,fileObject):
+        self.fileObject = fileObject
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+
+    def read(self,size):
+        while len(self.buffer) < size:
+            data = self.fileObject.read(65536)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+def getRepodataRPMList(url):
+    """Get the list of RPMs from the yum metadata of the repository at url.
+
+    The primary metadata is streamed from the server and parsed
+    incrementally. Returns a list of tuples (location,size,checksumType,checksum)
+    or None if url is not a yum repository.
+    """
+    try:
+        repomdFile = urllib.urlopen(url + '/repodata/repomd.xml')
+    except IOError:
+        return None
+    try:
+        if repomdFile.getcode() not in (None,200):
+            return None
+        primaryLocation = None
+        try:
+            for (event,elem) in ElementTree.iterparse(repomdFile):
+                if elem.tag == '{%s}data' % (repomdNamespace) and elem.get('type') == 'primary':
+                    primaryLocation = elem.find('{%s}location' % (repomdNamespace)).get('href')
+        except SyntaxError:
+            return None
+    finally:
+        repomdFile.close()
+    if not primaryLocation:
+        return None
 
-def getRPMList(url):
     rpmList = []
+    primaryFile = urllib.urlopen(url + '/' + primaryLocation)
+    try:
+        if primaryLocation.endswith('.gz'):
+            primaryStream = GzipStream(primaryFile)
+        else:
+            primaryStream = primaryFile
+        packageTag = '{%s}package' % (primaryNamespace)
+        context = iter(ElementTree.iterparse(primaryStream, events=('start','end')))
+        (event,root) = context.next()
+        for (event,elem) in context:
+            if event != 'end' or elem.tag != packageTag:
+                continue
+            checksum = elem.find('{%s}checksum' % (primaryNamespace))
+            rpmList.append((elem.find('{%s}location' % (primaryNamespace)).get('href'),
+                            int(elem.find('{%s}size' % (primaryNamespace)).get('package')),
+                            checksum.get('type'),
+                            checksum.text))
+            # Do not keep the packages already processed in memory
+            root.clear()
+    finally:
+        primaryFile.close()
+    return rpmList
+
+def getIndexRPMList(url):
+    """Get the list of RPMs referenced by the HTML index page at url.
+
+    The page is read and parsed by chunks. Returns a list of tuples
+    (location,None,None,None) as sizes and checksums are unknown.
+    """
+    rpmList = []
+    rpmSet = set()
+    indexFile = urllib.urlopen(url)
     try:
-        indexFile = urllib.urlopen(url)
         rpmRegExp = re.compile('href="([^"]*.rpm)"')
-        data = indexFile.read()
-        for rpm in rpmRegExp.findall(data):
-            if not rpm in rpmList:
-                rpmList.append(rpm)
+        data = ''
+        while True:
+            chunk = indexFile.read(65536)
+            data += chunk
+            lastMatchEnd = 0
+            for match in rpmRegExp.finditer(data):
+                if not match.group(1) in rpmSet:
+                    rpmSet.add(match.group(1))
+                    rpmList.append((match.group(1),None,None,None))
+                lastMatchEnd = match.end()
+            if not chunk:
+                break
+            # Keep the end of the data, which may contain the beginning of a reference
+            data = data[lastMatchEnd:]
+            if len(data) > 4096:
+                data = data[-4096:]
+    finally:
+        indexFile.close()
+    return rpmList
+
+def getRPMList(url):
+    """Get the list of RPMs available at url.
+
+    If url is a yum repository, the list comes from its metadata and includes
+    RPM sizes and checksums. Else url must be an HTML index page referencing
+    the RPMs. Returns a list of tuples (location,size,checksumType,checksum).
+    """
+    try:
+        rpmList = getRepodataRPMList(url)
+        if rpmList is None:
+            rpmList = getIndexRPMList(url)
     except:
-        sys.stderr.write("Error: Unexpected error when retrieving the RPM list: %s\n" % (sys.exc_info()[0]))
+        logger.error("Error: Unexpected error when retrieving the RPM list: %s" % (sys.exc_info()[0]))
         sys.exit(1)
     return rpmList
 
+def fileChecksum(path,checksumType):
+    """Return the checksum of a file or None if checksumType is not supported"""
+    if checksumType == 'sha':
+        checksumType = 'sha1'
+    try:
+        checksum = hashlib.new(checksumType)
+    except ValueError:
+        return None
+    fileObject = open(path,'rb')
+    try:
+        while True:
+            data = fileObject.read(1048576)
+            if not data:
+                break
+            checksum.update(data)
+    finally:
+        fileObject.close()
+    return checksum.hexdigest()
+
+class RPMDownloader(threading.Thread):
+    """Thread downloading RPMs from a download queue.
+
+    Each downloader keeps a persistent connection to the HTTP server, reused
+    for all the RPMs it downloads. Other protocols (e.g. ftp) are handled with
+    urllib. Each RPM is written to a temporary file in the target directory
+    and renamed when complete, so that a partial download never appears
+    as a valid RPM.
+
+    In incremental mode, an RPM already present in the target directory is
+    downloaded again only if its size (or checksum, if known) differs from
+    the remote one.
+
+    Network operations time out after timeout seconds: a download that
+    timed out is retried with a new connection (downloadTimeoutRetries
+    times) before being reported as failed.
+    """
+
+    def __init__(self,url,repository,downloadQueue,progress,incremental=False,timeout=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.url = url
+        self.repository = repository
+        self.incremental = incremental
+        self.downloadQueue = downloadQueue
+        self.progress = progress
+        self.timeout = timeout
+        self.connection = None
+
+    def connect(self,location):
+        if self.connection:
+            self.connection.close()
+        if location.scheme == 'https':
+            self.connection = httplib.HTTPSConnection(location.netloc,timeout=self.timeout)
+        else:
+            self.connection = httplib.HTTPConnection(location.netloc,timeout=self.timeout)
+
+    def request(self,method,inputURL):
+        """Send a request for inputURL on the persistent connection and return the response"""
+        location = urlparse.urlsplit(inputURL)
+        path = location.path
+        if location.query:
+            path += '?' + location.query
+        # A persistent connection may have been closed by the server: retry once
+        # with a new connection.
+        for attempt in range(2):
+            if not self.connection or attempt > 0:
+                self.connect(location)
+            try:
+                self.connection.request(method, path)
+                return self.connection.getresponse()
+            except (httplib.HTTPException, socket.error):
+                if attempt > 0:
+                    raise
+
+    def remoteSize(self,inputURL):
+        """Return the size of the remote RPM (HTTP HEAD request) or None if unknown"""
+        if urlparse.urlsplit(inputURL).scheme not in ('http','https'):
+            return None
+        response = self.request('HEAD',inputURL)
+        response.read()
+        contentLength = response.getheader('content-length')
+        if response.status != 200 or contentLength is None:
+            return None
+        return int(contentLength)
+
+    def fetchHTTP(self,inputURL,outputFile):
+        """Download inputURL into outputFile using the persistent connection.
+
+        Returns the number of bytes downloaded.
+        """
+        response = self.request('GET',inputURL)
+        if response.status in (301,302,303,307):
+            # Let urllib follow redirections
+            response.read()
+            return self.fetchURL(inputURL,outputFile)
+        elif response.status != 200:
+            response.read()
+            raise IOError("HTTP error %d (%s)" % (response.status,response.reason))
+        size = 0
+        while True:
+            data = response.read(65536)
+            if not data:
+                break
+            outputFile.write(data)
+            size += len(data)
+        return size
+
+    def fetchURL(self,inputURL,outputFile):
+        """Download inputURL into outputFile with urllib (non HTTP protocols)"""
+        inputFile = urllib.urlopen(inputURL)
+        size = 0
+        try:
+            while True:
+                data = inputFile.read(65536)
+                if not data:
+                    break
+                outputFile.write(data)
+                size += len(data)
+        finally:
+            inputFile.close()
+        return size
+
+    def isUpToDate(self,inputURL,outputPath,size,checksumType,checksum):
+        """Check if the local RPM is identical to the remote one.
+
+        The size and checksum from the repository metadata are used if known,
+        else the size is retrieved from the server.
+        """
+        localSize = os.path.getsize(outputPath)
+        if size is None:
+            size = self.remoteSize(inputURL)
+        if size != localSize:
+            return False
+        if checksum:
+            localChecksum = fileChecksum(outputPath,checksumType)
+            if localChecksum and localChecksum != checksum:
+                return False
+        return True
+
+    def run(self):
+        while True:
+            try:
+                (location,size,checksumType,checksum) = self.downloadQueue.get_nowait()
+            except Queue.Empty:
+                break
+            rpmName = os.path.basename(location)
+            inputURL = urlparse.urljoin(self.url + '/', location)
+            outputPath = self.repository + '/' + rpmName
+            if self.incremental and os.path.isfile(outputPath):
+                try:
+                    if self.isUpToDate(inputURL,outputPath,size,checksumType,checksum):
+                        self.progress.skipped(rpmName,os.path.getsize(outputPath))
+                        continue
+                except Exception, detail:
+                    self.progress.failed(rpmName,detail)
+                    continue
+            for attempt in range(downloadTimeoutRetries + 1):
+                tempPath = None
+                try:
+                    # Inside the try block: a failure (e.g. ENOSPC) is reported for this RPM
+                    (tempFd,tempPath) = tempfile.mkstemp(prefix='.' + rpmName + '.', dir=self.repository)
+                    outputFile = os.fdopen(tempFd,'wb')
+                    try:
+                        if urlparse.urlsplit(inputURL).scheme in ('http','https'):
+                            downloadedSize = self.fetchHTTP(inputURL,outputFile)
+                        else:
+                            downloadedSize = self.fetchURL(inputURL,outputFile)
+                    finally:
+                        outputFile.close()
+                    if checksum and fileChecksum(tempPath,checksumType) not in (None,checksum):
+                        raise IOError("%s checksum mismatch" % (checksumType))
+                    os.chmod(tempPath,0644)
+                    os.rename(tempPath,outputPath)
+                    self.progress.done(rpmName,downloadedSize)
+                    break
+                except socket.timeout, detail:
+                    if tempPath and os.path.exists(tempPath):
+                        os.remove(tempPath)
+                    # The response was not read completely: the connection cannot be reused
+                    if self.connection:
+                        self.connection.close()
+                        self.connection = None
+                    if attempt < downloadTimeoutRetries:
+                        logger.debug("Timeout downloading %s: retrying" % (rpmName))
+                    else:
+                        self.progress.failed(rpmName,"timed out (%d attempts)" % (attempt + 1))
+                except Exception, detail:
+                    if tempPath and os.path.exists(tempPath):
+                        os.remove(tempPath)
+                    self.progress.failed(rpmName,detail)
+                    break
+        if self.connection:
+            self.connection.close()
+
+class DownloadProgress:
+    """Thread-safe progress reporting and statistics of RPM downloads"""
+
+    def __init__(self,total):
+        self.lock = threading.Lock()
+        self.total = total
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.skippedCount = 0
+        self.skippedBytes = 0
+        self.startTime = time.time()
+
+    def done(self,rpmName,size):
+        self.lock.acquire()
+        try:
+            self.count += 1
+            self.bytes += size
+            logger.debug("[%i/%i] Fetched %s (%i bytes)" % (self.count,self.total,rpmName,size))
+        finally:
+            self.lock.release()
+
+    def skipped(self,rpmName,size):
+        self.lock.acquire()
+        try:
+            self.count += 1
+            self.skippedCount += 1
+            self.skippedBytes += size
+            logger.debug("[%i/%i] %s already present, skipped" % (self.count,self.total,rpmName))
+        finally:
+            self.lock.release()
+
+    def failed(self,rpmName,detail):
+        self.lock.acquire()
+        try:
+            self.count += 1
+            self.errors += 1
+            logger.error("[%i/%i] Error: failed to fetch %s: %s" % (self.count,self.total,rpmName,detail))
+        finally:
+            self.lock.release()
+
+    def summary(self):
+        elapsed = max(time.time() - self.startTime, 0.001)
+        summary = "%i RPM packages downloaded (%i errors): %.1f MB in %.1f s (%.2f MB/s)" % \
+                  (self.count - self.errors - self.skippedCount,self.errors,self.bytes/1048576.,elapsed,self.bytes/1048576./elapsed)
+        if self.skippedCount:
+            summary += "\n%i RPM packages already present skipped (%.1f MB)" % (self.skippedCount,self.skippedBytes/1048576.)
+        return summary
+
+def downloadRPMs(url,rpmList,repository,jobs,incremental=False,timeout=None):
+    """Download the RPMs in rpmList from url into repository using jobs concurrent downloaders.
+
+    rpmList is a list of tuples as returned by getRPMList(). If incremental is
+    true, RPMs already present with the same size are not downloaded. timeout
+    is the network timeout in seconds (None for no timeout).
+
+    Returns the number of RPMs that failed to download.
+    """
+    downloadQueue = Queue.Queue()
+    for rpmEntry in rpmList:
+        downloadQueue.put(rpmEntry)
+    progress = DownloadProgress(len(rpmList))
+    downloaders = []
+    for i in range(min(jobs,len(rpmList))):
+        downloader = RPMDownloader(url,repository,downloadQueue,progress,incremental,timeout)
+        downloader.start()
+        downloaders.append(downloader)
+    for downloader in downloaders:
+        # Use a timeout to allow the main thread to handle Ctrl-C.
+        while downloader.isAlive():
+            downloader.join(1)
+    logger.info(progress.summary())
+    return progress.errors
+
 def main():
     program = os.path.basename(sys.argv[0])
-    usage = "[-h] [-V] [-u URL] [-n DATE] rpm_directory\n\n" \
-           + "STDOUT must be redirected to produce the template. It is recommended to\n" \
+    usage = "[-h] [-V] [-q] [-u URL [--download-jobs JOBS] [--timeout SECONDS] [--incremental]] [-n DATE] [--cache [--cache-file FILE]]\n" \
+           + "       [--from-repodata] [-o OUTPUT_FILE] rpm_directory\n\n" \
+           + "Without -o, STDOUT must be redirected to produce the template. It is recommended to\n" \
            + "redirect STDERR to another file as it can produce a lot of output, especially\n" \
-           + "if downloading is done at the same time."
+           + "if downloading is done at the same time, or to use -q to only print a summary\n" \
+           + "(-qq to print only warnings and errors)."
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('-V', '--version',
                       help='show version',
                       action='store_true', dest='version', default=False)
+    parser.add_option('-q', '--quiet',
+                      help='Print only a summary (twice: only warnings and errors)',
+                      action='count', dest='quiet', default=0)
     parser.add_option('-u', '--url',
                       help='download RPM from a repository',
                       dest='repository_url',
                       metavar="URL")
+    parser.add_option('--download-jobs',
+                      help='Number of concurrent downloads (default: 4)',
+                      dest='downloadJobs', type='int', default=4,
+                      metavar="JOBS")
+    parser.add_option('--timeout',
+                      help='Network timeout in seconds when downloading RPMs (default: 60)',
+                      dest='timeout', type='int', default=60,
+                      metavar="SECONDS")
+    parser.add_option('--incremental',
+                      help='Download only RPMs missing or whose size or checksum differs from the remote one',
+                      action='store_true', dest='incremental', default=False)
     parser.add_option('-n', '--not-after',
                       help='Restrict the template to RPMs with a build time older than DATE',
                       dest='notAfterDate',
                       metavar="DATE")
+    parser.add_option('--cache',
+                      help='Use a cache of RPM headers to read only new or modified RPMs',
+                      action='store_true', dest='cache', default=False)
+    parser.add_option('--no-cache',
+                      help='Read all RPM headers (default)',
+                      action='store_false', dest='cache')
+    parser.add_option('--cache-file',
+                      help='RPM header cache location (default: rpm_directory/%s)' % (headerCacheDefault),
+                      dest='cacheFile',
+                      metavar="FILE")
+    parser.add_option('--from-repodata',
+                      help='Use yum repository metadata (repodata) rather than RPM headers when available',
+                      action='store_true', dest='fromRepodata', default=False)
+    parser.add_option('-o', '--output',
+                      help='Write the template in OUTPUT_FILE instead of STDOUT',
+                      dest='outputFile',
+                      metavar="OUTPUT_FILE")
     (options, args) = parser.parse_args(sys.argv)
 
+    logHandler = logging.StreamHandler(sys.stderr)
+    logHandler.setFormatter(logging.Formatter('%(message)s'))
+    for scriptLogger in (logger,rpmCommon.logger):
+        scriptLogger.addHandler(logHandler)
+        scriptLogger.setLevel(quietLevels[min(options.quiet,len(quietLevels) - 1)])
+
     if options.version:
         sys.stdout.write(versionString)
         sys.exit(0)
@@ -87,19 +532,19 @@ def main():
     repository = args[1]
 
     if not os.path.isdir(repository):
-        sys.stderr.write("Error: No such directory: %s\n" % (repository))
+        logger.error("Error: No such directory: %s" % (repository))
         sys.exit(1)
 
     # Check if the notAfterDate variable is valid
     if options.notAfterDate:
         notAfterDate = options.notAfterDate.split('-')
         if len(notAfterDate) != 3:
-            sys.stderr.write("Error: the date (%s) has not a valid format. Please use the following format: YYYY-MM-DD.\n" % (options.notAfterDate))
+            logger.error("Error: the date (%s) has not a valid format. Please use the following format: YYYY-MM-DD." % (options.notAfterDate))
             sys.exit(1)
         try:
             notAfterTime = time.mktime((int(notAfterDate[0]),int(notAfterDate[1]),int(notAfterDate[2]),0,0,0,0,0,0))
         except:
-            sys.stderr.write("Error: the date (%s) is not a valid date. Please use the following date format: YYYY-MM-DD.\n" % (options.notAfterDate))
+            logger.error("Error: the date (%s) is not a valid date. Please use the following date format: YYYY-MM-DD." % (options.notAfterDate))
             sys.exit(1)
     else:
         notAfterTime = None
@@ -107,58 +552,119 @@ def main():
     # Update RPM in repository if an URL is provided
     if options.repository_url:
         if not os.access(repository, os.W_OK):
-            sys.stderr.write("Error: The %s directory is not writable.\n" % repository)
+            logger.error("Error: The %s directory is not writable." % repository)
             sys.exit(1)
-        sys.stderr.write("Loading new RPMs from %s (may take a while)...\n" % (options.repository_url))
+        if options.timeout < 1:
+            logger.error("Error: the network timeout (%d) must be greater than 0." % (options.timeout))
+            sys.exit(1)
+        # Also applies to RPM list retrieval and non HTTP downloads (urllib)
+        socket.setdefaulttimeout(options.timeout)
+        logger.info("Loading new RPMs from %s (may take a while)..." % (options.repository_url))
         rpmList = getRPMList(options.repository_url)
         if not rpmList:
-            sys.stderr.write("Error: the %s url does not contain a list of RPM\n" % (options.repository_url))
+            logger.error("Error: the %s url does not contain a list of RPM" % (options.repository_url))
+            sys.exit(1)
+        if options.downloadJobs < 1:
+            logger.error("Error: the number of download jobs (%d) must be greater than 0." % (options.downloadJobs))
             sys.exit(1)
-        sys.stderr.write("%i RPM packages to download\n" % len(rpmList))
-        for i in range(0,len(rpmList)):
-            sys.stderr.write("[%i] Fetching %s ...\n" % (i+1,rpmList[i]))
-            inputURL = options.repository_url + '/' + rpmList[i]
-            outputURL = repository + '/' + rpmList[i]
-            urllib.urlretrieve(inputURL,outputURL)
-
-    fileList = os.listdir(repository)
+        logger.info("%i RPM packages to download" % len(rpmList))
+        if downloadRPMs(options.repository_url,rpmList,repository,options.downloadJobs,options.incremental,options.timeout) > 0:
+            logger.error("Error: some RPM packages could not be downloaded")
+            sys.exit(1)
+
+    fileList = [filename for filename in os.listdir(repository) if filename[-4:] == '.rpm']
  
     rpmVersionDict = {}
+    # Version sort key of each RPM in rpmVersionDict
+    versionKeys = {}
  
+    headerCache = None
+    if options.cache:
+        if options.cacheFile:
+            cacheFile = options.cacheFile
+        else:
+            cacheFile = repository + os.path.sep + headerCacheDefault
+        try:
+            headerCache = RPMHeaderCache(cacheFile)
+        except sqlite3.Error, detail:
+            logger.warning("Warning: failed to open RPM header cache %s (%s). Cache disabled." % (cacheFile,detail))
+
+    # Use repository metadata, if requested and available, for RPMs not
+    # modified since the metadata was generated.
+    repodataHeaders = None
+    if options.fromRepodata:
+        (repodataHeaders,repodataTime) = readRepodata(repository)
+        if repodataHeaders is None:
+            logger.warning("Warning: no usable repository metadata in %s, reading RPM headers" % (repository))
+
     transactionSet =  rpm.TransactionSet()
     transactionSet.setVSFlags(rpm._RPMVSF_NOSIGNATURES) 
-    sys.stdout.write("# Template to add update RPMs to base configuration\n\n")
-    sys.stdout.write("template updates/rpms;\n\n")
- 
-    # Process each rpm present in the repository
+    # Process each rpm present in the repository.
+    # Headers found in the repository metadata or in the cache are not read
+    # again from the RPM.
+    headersRead = 0
     for filename in fileList:
-        if filename[-4:] == '.rpm':
-            sys.stderr.write("Processing %s... " % (filename))
-            fileObject = os.open(repository + os.path.sep + filename, os.O_RDONLY)
-            rpmHeader = transactionSet.hdrFromFdno(fileObject)
-            rpmInfo = rpmHeader.sprintf('%{name},%{version},%{release},%{arch}').split(',')
-            rpmBuildTime = rpmHeader.sprintf('%{buildtime}')
-            os.close(fileObject)
-            internalName = "%s-%s-%s.%s.rpm" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3])
-            rpmKey = "%s-%s" % (rpmInfo[0],rpmInfo[3])
-            if internalName != filename:
-                sys.stderr.write("RPM %s internal name (%s) doesn't match RPM file name. Skipped.\n" % (filename,internalName))
+        message = "Processing %s... " % (filename)
+        rpmPath = repository + os.path.sep + filename
+        rpmHeader = None
+        if repodataHeaders and repodataHeaders.has_key(filename) and os.path.getmtime(rpmPath) <= repodataTime:
+            rpmHeader = repodataHeaders[filename]
+        elif headerCache:
+            identity = fileIdentity(rpmPath)
+            rpmHeader = headerCache.get(filename,identity)
+        if not rpmHeader:
+            rpmHeader = readRPMHeader(transactionSet,rpmPath)
+            headersRead += 1
+            if headerCache:
+                headerCache.set(filename,identity,rpmHeader)
+        rpmInfo = rpmHeader[0:4]
+        rpmBuildTime = rpmHeader[4]
+        rpmEpoch = rpmHeader[5]
+        internalName = "%s-%s-%s.%s.rpm" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3])
+        rpmKey = "%s-%s" % (rpmInfo[0],rpmInfo[3])
+        if internalName != filename:
+            message += "RPM %s internal name (%s) doesn't match RPM file name. Skipped." % (filename,internalName)
+        elif notAfterTime and int(rpmBuildTime) > int(notAfterTime):
+            # Do not include the RPM if its build time is newer than the specified date.
+            message += "RPM %s is newer than the specified date (%s). Skipped." % (filename, options.notAfterDate)
+        else:
+            versionKey = rpmVersionKey((rpmEpoch,rpmInfo[1],rpmInfo[2]))
+            if not rpmVersionDict.has_key(rpmKey) or versionKey > versionKeys[rpmKey]:
+                message += "added (replacing older versions)"
+                rpmVersionDict[rpmKey] = rpmInfo
+                versionKeys[rpmKey] = versionKey
             else:
-                if notAfterTime:
-                    # Do not include the RPM if its build time is newer than the specified date.
-                    if int(rpmBuildTime) > int(notAfterTime):
-                        sys.stderr.write("RPM %s is newer than the specified date (%s). Skipped.\n" % (filename, options.notAfterDate))
-                        continue
-                if not rpmVersionDict.has_key(rpmKey) or (rpmCompareVersion(rpmInfo[0:3],rpmVersionDict[rpmKey][0:3]) > 0):
-                    sys.stderr.write("added (replacing older versions)\n")
-                    rpmVersionDict[rpmKey] = rpmInfo
-                else:
-                    sys.stderr.write("skipped (newer version present)\n")
+                message += "skipped (newer version present)"
+        logger.debug(message)
+
+    if headerCache:
+        try:
+            headerCache.save(fileList)
+        except sqlite3.Error, detail:
+            logger.warning("Warning: failed to update RPM header cache %s (%s)." % (headerCache.path,detail))
+
+    # Assemble the template in memory and write it in one go, atomically
+    # when written to a file.
+    outputBuffer = StringIO()
+    outputBuffer.write("# Template to add update RPMs to base configuration\n\n")
+    outputBuffer.write("template updates/rpms;\n\n")
 
     # Add an entry for the most recent version of every RPM.
     for (key,rpmInfo) in rpmVersionDict.items():
-        sys.stderr.write("Adding entry for %s version %s-%s arch %s\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3]))
-        sys.stdout.write("'/software/packages'=pkg_ronly('%s','%s-%s','%s');\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3]))
+        logger.debug("Adding entry for %s version %s-%s arch %s" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3]))
+        outputBuffer.write("'/software/packages'=pkg_ronly('%s','%s-%s','%s');\n" % (rpmInfo[0],rpmInfo[1],rpmInfo[2],rpmInfo[3]))
+
+    if options.outputFile:
+        try:
+            writeFileAtomically(options.outputFile,outputBuffer.getvalue())
+        except (IOError,OSError), detail:
+            logger.error("Error: failed to write template %s (%s)" % (options.outputFile,detail))
+            sys.exit(1)
+    else:
+        sys.stdout.write(outputBuffer.getvalue())
+        sys.stdout.flush()
+    logger.info("Template updates/rpms: %d RPM files in %s (%d headers read), %d entries" % \
+                (len(fileList),repository,headersRead,len(rpmVersionDict)))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2014 CNRS. All rights reserved.
+
+"""rpmVersionCheck - Differential check of the RPM version sort keys
+
+rpmErrata.py and rpmUpdates.py select the newest version of each RPM by
+comparing the keys returned by rpmCommon.rpmVersionKey() instead of calling
+rpm.labelCompare() for each comparison. This script checks that both give
+the same result:
+
+ * on a list of known cases (numeric and alphabetic segments, separators,
+   '~' and '^'), whose expected result is also checked,
+ * on random (epoch,version,release) pairs built from segments that are
+   handled differently by rpmvercmp().
+
+'~' and '^' cases are skipped with a warning if the installed rpm library
+doesn't support them. Exits with status 1 if a mismatch is found.
+"""
+
+import os
+import sys
+import optparse
+import random
+import rpm
+from rpmCommon import rpmVersionKey
+
+_version = "1.0"
+
+versionString = "rpmVersionCheck -- Differential check of the RPM version sort keys (v%s)\n" % (_version)
+
+# Known cases: (version1,version2,expected result of the comparison)
+knownCases = [
+    (('0','1.0','1'),('0','1.0','1'),0),
+    (('0','1.0','1'),('0','1.0','2'),-1),
+    (('1','1.0','1'),('0','2.0','1'),1),
+    ((None,'1.0','1'),('0','1.0','1'),0),
+    (('0',None,'1'),('0','1.0','1'),-1),
+    (('0','1.01','1'),('0','1.1','1'),0),
+    (('0','1.10','1'),('0','1.9','1'),1),
+    (('0','1.a','1'),('0','1.1','1'),-1),
+    (('0','2.0','1'),('0','2_0','1'),0),
+    (('0','1e','1'),('0','1.e','1'),0),
+    (('0','1.0','1'),('0','1.0.0','1'),-1),
+    (('0','1.0~rc1','1'),('0','1.0','1'),-1),
+    (('0','1.0~rc1','1'),('0','1.0~rc2','1'),-1),
+    (('0','1.0~~','1'),('0','1.0~','1'),-1),
+    (('0','1.0~rc1','1'),('0','1.0~rc1^x','1'),-1),
+    (('0','1.0^git1','1'),('0','1.0','1'),1),
+    (('0','1.0^git1','1'),('0','1.0.1','1'),-1),
+    (('0','1.0^','1'),('0','1.0','1'),1),
+]
+
+# Segments used to build random versions
+segments = ['0','1','2','9','00','010','10','a','b','Z','rc','.','-','_','+','~','^','']
+
+def compare(version1,version2):
+    """Return the results of rpm.labelCompare() and of the comparison of the sort keys"""
+    return (rpm.labelCompare(version1,version2),cmp(rpmVersionKey(version1),rpmVersionKey(version2)))
+
+def unsupportedSegments():
+    """Return the list of special characters not supported by the rpm library"""
+    unsupported = []
+    for (character,version) in (('~',('0','1.0~rc1','1')),('^',('0','1.0^git1','1'))):
+        expected = {'~':-1, '^':1}[character]
+        if rpm.labelCompare(version,('0','1.0','1')) != expected:
+            unsupported.append(character)
+    return unsupported
+
+def randomVersion(segmentList):
+    return ''.join([random.choice(segmentList) for i in range(random.randint(0,6))])
+
+def randomEVR(segmentList):
+    return (random.choice([None,'0','1',randomVersion(segmentList)]),
+            random.choice([None,randomVersion(segmentList)]),
+            random.choice([None,randomVersion(segmentList)]))
+
+def main():
+    program = os.path.basename(sys.argv[0])
+    usage = "[-h] [-V] [-n COUNT] [--seed SEED]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-V', '--version',
+                      help='Display version information and exit',
+                      action='store_true', dest='version', default=False)
+    parser.add_option('-n', '--count',
+                      help='Number of random comparisons (default: 100000)',
+                      dest='count', type='int', default=100000,
+                      metavar="COUNT")
+    parser.add_option('--seed',
+                      help='Random seed (default: 0)',
+                      dest='seed', type='int', default=0)
+    (options, args) = parser.parse_args(sys.argv)
+
+    if options.version:
+        sys.stdout.write(versionString)
+        sys.exit(0)
+
+    if len(args) != 1:
+        sys.stderr.write("usage: %s %s\n" % (program, usage))
+        sys.exit(1)
+
+    unsupported = unsupportedSegments()
+    for character in unsupported:
+        sys.stderr.write("Warning: '%s' not supported by the rpm library, cases using it are skipped\n" % (character))
+
+    errors = 0
+    for (version1,version2,expected) in knownCases:
+        if [character for character in unsupported if character in ''.join([value or '' for value in version1 + version2])]:
+            continue
+        (labelResult,keyResult) = compare(version1,version2)
+        if labelResult != expected or keyResult != expected:
+            sys.stdout.write("Mismatch: %s %s: expected %d, labelCompare %d, sort key %d\n" % (version1,version2,expected,labelResult,keyResult))
+            errors += 1
+
+    random.seed(options.seed)
+    segmentList = [segment for segment in segments if segment not in unsupported]
+    for i in range(options.count):
+        version1 = randomEVR(segmentList)
+        version2 = randomEVR(segmentList)
+        # Often compare versions differing only by the release
+        if random.random() < 0.3:
+            version2 = (version1[0],version1[1],version2[2])
+        (labelResult,keyResult) = compare(version1,version2)
+        if labelResult != keyResult:
+            sys.stdout.write("Mismatch: %s %s: labelCompare %d, sort key %d\n" % (version1,version2,labelResult,keyResult))
+            errors += 1
+
+    sys.stdout.write("%d known cases and %d random comparisons: %d mismatches\n" % (len(knownCases),options.count,errors))
+    if errors > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()